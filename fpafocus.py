@@ -7,27 +7,18 @@ import instrument.actuators.XPS_C8_drivers as xps
 import time
 import math
 import instrument.actuators.newport as new
+from instrument.actuators.fpa import FocalPlane
+from instrument.actuators.xpspool import XPSConnectionPool
+from instrument.component import InstrumentError
 from gui.overviewtab.fpapanel import FPAPanel
-from threadtools import timeout, TimeoutError
 
 x = xps.XPS()
 
-@timeout(10)
-def socket_list():
-    s = []
-    for i in range(5):
-        s.append(x.TCP_ConnectToServer('192.168.0.254',5001,1))
-   
-    for i in range(5):
-        if s[i] == -1:
-            print 'XPS socet connections failed.'
-            sys.exit()
-    return s
-
 try:
-    s = socket_list()
-except TimeoutError:
-    print "XPS connection timed out."
+    pool = XPSConnectionPool(x, '192.168.0.254', 5001, timeout=1, size=4)
+    fpa = FocalPlane(None, x, pool)
+except InstrumentError:
+    print 'XPS socet connections failed.'
     sys.exit()
     
 
@@ -44,7 +35,7 @@ class FPAFrame(wx.Frame):
     def __init__(self,*args,**kwargs):
         super(FPAFrame,self).__init__(*args,**kwargs)
         p = wx.Panel(self)
-        self.panel0 = FPAPanel(self,'array', x,s[1:])
+        self.panel0 = FPAPanel(self, fpa)
         self.panel1 = Emergency(self)
         self.__DoLayout()
         self.SetInitialSize()
@@ -81,10 +72,11 @@ class Emergency(wx.Panel):
         self.SetSizer(sizer)
     
     def OnButton(self,event):
-        kill=x.KillAll(s[2])
-        if kill[0] != 0:
-            new.XPSErrorHandler(x, s[0], kill[0], 'KillAll')
-        else:
+        with pool.socket() as socket:
+            kill=x.KillAll(socket)
+            if kill[0] != 0:
+                new.XPSErrorHandler(x, socket, kill[0], 'KillAll')
+        if kill[0] == 0:
             result=wx.MessageBox('All groups killed.\nMotors must be reinitialized',style=wx.CENTER|wx.ICON_EXCLAMATION|wx.OK) 
  
 if __name__ == '__main__':
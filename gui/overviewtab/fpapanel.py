@@ -1,26 +1,17 @@
 import wx
 import logging
-import instrument.actuators.newport as new
 import wx.lib.agw.floatspin as FS
 import math
 from threadtools import run_async
+from instrument.component import InstrumentError
 
 class FPAPanel(wx.Panel):
-    def __init__(self, parent, motor, controller, socket):
+    def __init__(self, parent, fpa):
         #wx.Panel.__init__(self, parent, *args, **kwargs)
         super(FPAPanel, self).__init__(parent)
 
-        self.controller = controller
-        self.socket = socket
-        self.motor = motor
-
-        try:
-            new.NewportInitialize(self.controller, self.motor, self.socket[0], 0)
-            new.NewportFocusHome(self.controller, self.socket[0], self.motor)
-        except TypeError:
-            pass
-        else:
-            self.pa = 0
+        # The FocalPlane is initialized and homed when it is built.
+        self.fpa = fpa
 
         self.new_pa_text = wx.StaticText(self, label="New Pos "+u"\u00B5"+"m:")
 
@@ -69,75 +60,58 @@ class FPAPanel(wx.Panel):
         # Add the grid bag to the static box and make everything fit
         self.SetSizer(sizer)
         
-    @run_async
+    def start(self, future):
+        """Disables the motion controls until the motion of future is
+        over.  The FPA moves return at once, so no thread is needed.
+        """
+        for child in self.GetChildren():
+            if child != self.stop_button: child.Enable(False)
+        future.add_done_callback(self.on_done)
+
+    def on_done(self, future):
+        if future.exception() is not None:
+            logging.error('FPA motion failed: %s' % future.exception())
+        for child in self.GetChildren():
+            wx.CallAfter(child.Enable, True)
+
     def on_set(self, event):
-        try: 
-            move = self.pa-self.position.GetValue()
-            if move == 0:
-                pass
-            else:
-                speed = 10**math.floor(math.log10(math.fabs(move))) 
-                direction = math.copysign(1,move)           
-                travel = new.NewportFocusMove(self.controller, self.socket[0],
-                                              self.motor, move, speed, 
-                                              direction)
-                self.pa = self.pa + travel
-
-        except ValueError:
-            pass
+        move = self.position.GetValue() - self.fpa.position
+        if move == 0:
+            return
+        speed = 10**math.floor(math.log10(math.fabs(move)))
+        direction = math.copysign(1, move)
+        self.start(self.fpa.moveAsync(math.fabs(move), speed, direction))
 
-    @run_async     
+    @run_async
     def on_stop(self, event):
         try:
-            new.NewportStop(self.controller, self.socket[1:], self.motor) 
-        except:
-            pass        
-        children = self.GetChildren()
-        for child in children:
-            wx.CallAfter(child.Enable, True)
-    
-    @run_async
-    def on_step(self, event):
-        """
-"""
-        children = self.GetChildren()
-        for child in children:
-            if child != self.stop_button: wx.CallAfter(child.Enable, False)
-        #wx.CallAfter(self.Enable, False)
-        move = self.step_size.GetValue()
+            self.fpa.stop()
+        except InstrumentError:
+            pass
 
+    def on_step(self, event):
         if event.GetId() == 1:
-            dierection = 1
+            direction = 1
         elif event.GetId() == 2:
             direction = -1
         else:
             return
 
-        try:
-            step = self.step_size.GetValue()
-            speed = 10**math.floor(math.log10(math.fabs(step)))   
-            travel = new.NewportFocusMove(self.controller, self.socket[0],
-                                          self.motor, step, speed, direction)
-            self.pa = self.pa + travel
-        except ValueError:
-            pass
-        for child in children:
-            wx.CallAfter(child.Enable, True)
+        step = self.step_size.GetValue()
+        if step == 0:
+            return
+        speed = 10**math.floor(math.log10(math.fabs(step)))
+        self.start(self.fpa.moveAsync(step, speed, direction))
 
-    @run_async
     def on_home(self, event):
-        try:
-            new.NewportFocusHome(self.controller, self.socket[0], self.motor)
-        except:
-            raise
+        self.start(self.fpa.homeAsync())
 
+    @run_async
     def on_cal(self, event):
-        work = True 
-        travel = 0       
-        while work:
+        travel = 0
+        while True:
             try:
-                travel = travel + new.NewportFocusMove(self.controller, self.socket[0],
-                                          self.motor, 1, 10, 1)
+                travel = self.fpa.move(1, 10, 1)
                 print travel
-            except:
-                work = False
+            except InstrumentError:
+                break
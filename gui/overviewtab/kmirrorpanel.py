@@ -1,5 +1,4 @@
 import logging
-from time import sleep
 from threading import Event
 
 import wx
@@ -205,19 +204,22 @@ class KmirrorPanel(wx.Panel):
         if selected_mode is 0:
             self.DiscreteTracking(1, user_angle, self._track_event)
         if selected_mode is 1:
-            self.VelocityTracking(1, self._track_event)
+            self.VelocityTracking(1, user_angle, self._track_event)
 
-    @run_async(daemon=True)
     def DiscreteTracking(self, cadence, ua, stop_event):
-        while not stop_event.isSet():
-            self.kmirror.moveToUserAngle(ua)
-            sleep(cadence)
+        #The k-mirror samples at its [kmirror] discrete period and only
+        #moves outside the deadband.
+        try:
+            self.kmirror.trackDiscrete(ua, stop_event)
+        except InstrumentError:
+            self.StopTracking()
 
-    @run_async(daemon=True)
-    def VelocityTracking(self, cadence, stop_event):
-        while not stop_event.isSet():
-            self.kmirror.setVelocity()
-            sleep(cadence)
+    def VelocityTracking(self, cadence, ua, stop_event):
+        #The derotator servos the k-mirror jog velocity in closed loop.
+        try:
+            self.kmirror.track(ua, stop_event)
+        except InstrumentError:
+            self.StopTracking()
 
 
     def StopTracking(self):
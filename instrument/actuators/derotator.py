@@ -0,0 +1,370 @@
+"""
+.. module:: derotator
+   :platform: Unix
+   :synopsis: Closed-loop k-mirror derotation with rate feedforward.
+
+"""
+
+import logging
+import math
+import threading
+import time
+
+import instrument.actuators.newport as np
+from instrument.component import InstrumentError
+
+#Sidereal rate of the sky, degrees per second
+SIDEREAL = 360.0 / 86164.0905
+
+#Supported loop rates, Hz
+RATES = (5.0, 20.0)
+
+
+def target(user_angle, altitude, parallactic_angle, mode):
+    """K-mirror angle derotating the field to user_angle, as
+    KMirror.userAngleToPositionAngle.
+    """
+    return 0.5 * ((user_angle - parallactic_angle) - mode * altitude)
+
+
+def rate(altitude, azimuth, latitude, mode):
+    """Analytic rate of target(), degrees per second.
+
+    The parallactic angle turns at -W cos(lat) cos(az) / cos(alt) and the
+    altitude at W cos(lat) sin(az), W the sidereal rate, with the azimuth
+    from north through east.
+
+    Arguments:
+        altitude, azimuth, latitude -- Degrees -> float
+        mode                        -- [kmirror] direction -> +-1
+    """
+    alt = math.radians(altitude)
+    az  = math.radians(azimuth)
+    lat = math.radians(latitude)
+    parallactic = -SIDEREAL * math.cos(lat) * math.cos(az) / math.cos(alt)
+    elevation   = SIDEREAL * math.cos(lat) * math.sin(az)
+    return -0.5 * (parallactic + mode * elevation)
+
+
+class TrackingStats(object):
+    """Running statistics of a derotation loop.
+
+    Attributes:
+        ticks -- Number of loop iterations.
+    """
+
+    def __init__(self, period):
+        self.period  = period
+        self.ticks   = 0
+        self._jitter = [0.0, 0.0]   #sum of squares, max
+        self._error  = [0.0, 0.0]
+
+    def add(self, period, error):
+        """Account one iteration, period seconds after the previous one,
+        with a tracking error in degrees.
+        """
+        self.ticks += 1
+        for stat, value in ((self._jitter, period - self.period),
+                            (self._error, error)):
+            stat[0] += value * value
+            stat[1]  = max(stat[1], abs(value))
+
+    def summary(self):
+        """RMS and max of the loop jitter (s) and of the tracking error
+        (degrees) -> dict
+        """
+        ticks = max(self.ticks, 1)
+        return {'ticks'      : self.ticks,
+                'jitter rms' : math.sqrt(self._jitter[0] / ticks),
+                'jitter max' : self._jitter[1],
+                'error rms'  : math.sqrt(self._error[0] / ticks),
+                'error max'  : self._error[1]}
+
+
+class Derotator(object):
+    """Closed-loop derotation of the k-mirror.
+
+    Every tick the k-mirror jog velocity is set to the analytic derotator
+    rate (feedforward, see rate) plus a PI correction of the error between
+    the derotation angle (see target) and the measured motor angle.
+
+    Only the altitude, azimuth and parallactic angle are read from the
+    telescope, once per pointing period; between two reads the target is
+    carried forward at the feedforward rate. The motor angle is read on the
+    query lane of the k-mirror and the jog velocity set on its motion lane.
+
+    The loop stops when stop() is called, when the stop event is set, or on
+    an error, and then ends the jog.
+
+    Attributes:
+        rate  -- Loop rate, Hz.
+        kp    -- Proportional gain, 1/s.
+        ki    -- Integral gain, 1/s^2.
+        error -- Exception that ended the loop, None otherwise.
+        stats -- TrackingStats of the loop.
+    """
+
+    def __init__(self, kmirror, user_angle, stop_event=None, rate=None,
+                 kp=None, ki=None):
+        """Set up the loop, start() runs it.
+
+        Arguments:
+            kmirror    -- K-mirror to derotate -> KMirror
+            user_angle -- Position angle to hold -> float
+            stop_event -- Event ending the loop when set -> threading.Event
+            rate       -- Loop rate, defaults to [kmirror] track rate
+                          -> float
+            kp, ki     -- PI gains, default to [kmirror] track kp and
+                          track ki -> float
+
+        Raises:
+            InstrumentError
+        """
+        motor    = np.settings[kmirror.motor]
+        tracking = motor.tracking
+        if kmirror.instrument is None or \
+           kmirror.instrument.telescope is None:
+            raise InstrumentError('The K-Mirror can not track without the'
+                                  ' telescope!')
+        self.kmirror    = kmirror
+        self.telescope  = kmirror.instrument.telescope
+        self.user_angle = user_angle
+        self.mode       = motor.direction
+        self.rate       = float(rate if rate is not None else tracking.rate)
+        self.kp         = float(kp if kp is not None else tracking.kp)
+        self.ki         = float(ki if ki is not None else tracking.ki)
+        self.max_speed  = tracking.max_speed
+        self.refresh    = tracking.pointing_period
+        if not RATES[0] <= self.rate <= RATES[1]:
+            logging.warning('K-Mirror track rate %s Hz is out of %s-%s Hz.'
+                            % ((self.rate,) + RATES))
+            self.rate = min(max(self.rate, RATES[0]), RATES[1])
+
+        self.error  = None
+        self.stats  = TrackingStats(1.0 / self.rate)
+        self._stop  = stop_event if stop_event is not None else \
+                      threading.Event()
+        self._thread = threading.Thread(name='KMirrorDerotator',
+                                        target=self._run)
+        self._thread.daemon = True
+
+    @property
+    def running(self):
+        return self._thread.is_alive()
+
+    def start(self):
+        """Slew to the derotation angle and start tracking."""
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        """Stop tracking and wait for the jog to end."""
+        self._stop.set()
+        if threading.current_thread() is not self._thread and \
+           self._thread.ident is not None:
+            self._thread.join(timeout)
+
+    def pointing(self):
+        """Target angle and its rate now, from one read of the telescope.
+
+        Returns:
+            (time, angle, rate) -> (float, float, float)
+        """
+        altitude = float(self.telescope.altitude)
+        azimuth  = float(self.telescope.azimuth)
+        pa       = float(self.telescope.parallactic_angle)
+        return (time.time(),
+                target(self.user_angle, altitude, pa, self.mode),
+                rate(altitude, azimuth, self.telescope.latitude, self.mode))
+
+    def _run(self):
+        kmirror    = self.kmirror
+        controller = kmirror.controller
+        motor      = kmirror.motor
+        period     = 1.0 / self.rate
+        #Integral term limited to the top speed, against windup
+        limit      = self.max_speed / self.ki if self.ki else 0.0
+        integral   = 0.0
+        try:
+            #The field turns during the slew, a second short move
+            #catches up with it.
+            for attempt in range(2):
+                reference, angle, feedforward = self.pointing()
+                kmirror.move(angle)
+            kmirror.dispatch.move(
+                lambda socket: np.NewportKmirrorJog(controller, socket, motor,
+                                                    feedforward, True))
+            kmirror.track_status = True
+            last = None
+            tick = time.time()
+            while not self._stop.is_set():
+                now = time.time()
+                if now - reference >= self.refresh:
+                    reference, angle, feedforward = self.pointing()
+                desired  = angle + feedforward * (now - reference)
+                measured = kmirror.dispatch.read(
+                    lambda socket: np.NewportPositionGet(controller, socket,
+                                                         motor))
+                error    = desired - measured
+                if last is not None:
+                    self.stats.add(now - last, error)
+                    integral = min(max(integral + error * (now - last),
+                                       -limit), limit)
+                velocity = feedforward + self.kp * error + self.ki * integral
+                velocity = min(max(velocity, -self.max_speed),
+                               self.max_speed)
+                kmirror.dispatch.move(
+                    lambda socket: np.NewportKmirrorJog(controller, socket,
+                                                        motor, velocity))
+                last = now
+
+                #Fixed rate; a late tick is not made up for.
+                tick = max(tick + period, time.time())
+                self._stop.wait(tick - time.time())
+        except Exception as e:
+            self.error = e
+            logging.error('K-Mirror tracking stopped: %r' % e)
+        finally:
+            kmirror.track_status = False
+            try:
+                kmirror.dispatch.move(
+                    lambda socket: np.NewportKmirrorJogEnd(controller, socket,
+                                                           motor))
+            except InstrumentError:
+                pass
+            logging.info(self._report())
+
+    def _report(self):
+        summary = self.stats.summary()
+        return ('K-Mirror tracking: %d ticks at %.1f Hz, jitter rms %.4f s'
+                ' max %.4f s, error rms %.4f deg max %.4f deg.'
+                % (summary['ticks'], self.rate, summary['jitter rms'],
+                   summary['jitter max'], summary['error rms'],
+                   summary['error max']))
+
+
+class DiscreteTracker(object):
+    """Derotation of the k-mirror by absolute moves.
+
+    Once per period the derotation angle (see target) is computed from one
+    read of the telescope altitude and parallactic angle. The k-mirror is
+    only moved when the angle is more than the deadband away from the last
+    commanded angle, and at most once per interval. A move still running
+    when the next one is due is not queued behind; the next cycle moves to
+    the angle of its own time instead.
+
+    No controller query is made between moves: the last commanded angle is
+    the reference, and NewportKmirrorMove only sends the jog mode and
+    profile settings when they changed.
+
+    Attributes:
+        period   -- Seconds between two pointing samples.
+        deadband -- Degrees the derotation angle may drift from the
+                    k-mirror before it moves.
+        interval -- Minimum seconds between two moves.
+        samples  -- Number of pointing samples taken.
+        moves    -- Number of moves sent.
+        error    -- Exception that ended the tracking, None otherwise.
+    """
+
+    def __init__(self, kmirror, user_angle, stop_event=None, period=None,
+                 deadband=None, interval=None):
+        """Set up the tracking, start() runs it.
+
+        Arguments:
+            kmirror    -- K-mirror to derotate -> KMirror
+            user_angle -- Position angle to hold -> float
+            stop_event -- Event ending the tracking when set
+                          -> threading.Event
+            period, deadband, interval -- Default to [kmirror] discrete
+                          period, discrete deadband and discrete interval
+                          -> float
+
+        Raises:
+            InstrumentError
+        """
+        motor    = np.settings[kmirror.motor]
+        tracking = motor.tracking
+        if kmirror.instrument is None or \
+           kmirror.instrument.telescope is None:
+            raise InstrumentError('The K-Mirror can not track without the'
+                                  ' telescope!')
+        self.kmirror    = kmirror
+        self.telescope  = kmirror.instrument.telescope
+        self.user_angle = user_angle
+        self.mode       = motor.direction
+        self.period     = float(period if period is not None else
+                                tracking.discrete_period)
+        self.deadband   = float(deadband if deadband is not None else
+                                tracking.discrete_deadband)
+        self.interval   = float(interval if interval is not None else
+                                tracking.discrete_interval)
+        self.samples    = 0
+        self.moves      = 0
+        self.error      = None
+
+        self._stop   = stop_event if stop_event is not None else \
+                       threading.Event()
+        self._thread = threading.Thread(name='KMirrorDiscrete',
+                                        target=self._run)
+        self._thread.daemon = True
+
+    @property
+    def running(self):
+        return self._thread.is_alive()
+
+    def start(self):
+        """Move to the derotation angle and start tracking."""
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        """Stop tracking and wait for the last move to end."""
+        self._stop.set()
+        if threading.current_thread() is not self._thread and \
+           self._thread.ident is not None:
+            self._thread.join(timeout)
+
+    def angle(self):
+        """Derotation angle now, from one read of the telescope."""
+        self.samples += 1
+        return target(self.user_angle, float(self.telescope.altitude),
+                      float(self.telescope.parallactic_angle), self.mode)
+
+    def _run(self):
+        kmirror    = self.kmirror
+        controller = kmirror.controller
+        motor      = kmirror.motor
+        running    = None
+        commanded  = None
+        moved      = 0.0
+        tick       = time.time()
+        try:
+            kmirror.track_status = True
+            while not self._stop.is_set():
+                if running is not None and running.done():
+                    running.result()
+                    running = None
+                angle = self.angle()
+                now   = time.time()
+                if running is None and (commanded is None or
+                   abs(angle - commanded) > self.deadband and
+                   now - moved >= self.interval):
+                    running = kmirror.dispatch.motion.submit(
+                        lambda socket, angle=angle: np.NewportKmirrorMove(
+                            controller, socket, motor, angle))
+                    commanded = angle
+                    moved     = now
+                    self.moves += 1
+                    with kmirror.lock.write():
+                        kmirror.current_pos = angle
+                tick = max(tick + self.period, time.time())
+                self._stop.wait(tick - time.time())
+            if running is not None:
+                running.result()
+        except Exception as e:
+            self.error = e
+            logging.error('K-Mirror discrete tracking stopped: %r' % e)
+        finally:
+            kmirror.track_status = False
+            logging.info('K-Mirror discrete tracking: %d samples, %d moves'
+                         ' with a %.3f deg deadband.'
+                         % (self.samples, self.moves, self.deadband))
@@ -1,24 +1,28 @@
 import newport as np
+from dispatcher import XPSDispatcher
 from instrument.component import InstrumentComponent, InstrumentError, logCall
 
 class DewarWheel(InstrumentComponent):
     """Represents a Newport controlled wheel in the dewar.
 
     Methods:
+        calibrate
         home
+        homeAsync
         initialize
         kill
         move
+        moveAsync
     """
 
-    def __init__(self, instrument, name, sockets, positions):
+    def __init__(self, instrument, name, pool, positions):
         """Connects to, initializes, and homes a specified wheel in 
         the dewar. 
 
         Arguments:
             instrument -- Copy of the NESSI instrument -> Instrument
             name       -- Name of the wheel to control -> str 
-            sockets    -- List of integers representing TCP sockets ->[Int]
+            pool       -- Pool of XPS sockets -> XPSConnectionPool
             positions  -- Possible positions for the wheel -> [str]
 ;
         Raises:
@@ -30,12 +34,19 @@ class DewarWheel(InstrumentComponent):
         self.instrument  = instrument
         self.name        = name
         self.controller  = instrument.newport
-        self.sockets     = sockets
+        self.pool        = pool
         self.home_pos    = 0
         self.current_pos = 0
         self.positions   = positions
+        self.dispatch    = XPSDispatcher(self.controller, pool, name,
+                                         np.settings[name].group)
 
-        self.initialize()
+        #The dispatcher holds two pool sockets and two lane threads.
+        try:
+            self.initialize()
+        except:
+            self.dispatch.close()
+            raise
         #self.home()
 
     def __str__(self):
@@ -43,9 +54,11 @@ class DewarWheel(InstrumentComponent):
 
     @property
     def position(self):
-        """Returns the name of the current position."""
-
-        return self.positions[self.current_pos]
+        """Returns the name of the current position. Does not wait for a
+        move in flight, it returns the position the wheel left from.
+        """
+        with self.lock.read():
+            return self.positions[self.current_pos]
 
     @logCall(msg='Moving Dewar Wheel.')
     def move(self, selected_pos):
@@ -61,12 +74,7 @@ class DewarWheel(InstrumentComponent):
             self.current_pos -- The current position of the wheel. -> int
         """
         try:
-            with self.lock:
-                self.current_pos = np.NewportWheelMove(self.controller, 
-                                                   self.name, self.sockets[0],
-                                                   self.current_pos, 
-                                                   selected_pos)
-                return self.current_pos
+            return self.dispatch.move(self._move, selected_pos)
 
         except Exception as e:
             raise InstrumentError('An error occured during a movement of'
@@ -87,16 +95,80 @@ class DewarWheel(InstrumentComponent):
             None
         """
         try:
-            with self.lock:
-                np.NewportWheelHome(self.controller, 
-                                                   self.name, self.sockets[0])
-                self.current_pos = 0
+            self.dispatch.move(self._home)
 
         except Exception as e:
             raise InstrumentError('An error occured during a homing of'
                                   ' the' + self.name + '\n The following '
                                   ' error was raised...\n %s' % repr(e))       
     
+    @logCall(msg='Calibrating Dewar Wheel.')
+    def calibrate(self):
+        """Records the encoder position of every slot, so that later moves
+        go straight to the slot. The wheel ends on its home position.
+
+        Arguments:
+            None
+
+        Raises:
+            InstrumentError
+
+        Returns:
+            Encoder position of each slot, from the home slot. -> [float]
+        """
+        try:
+            return self.dispatch.move(self._calibrate)
+
+        except Exception as e:
+            raise InstrumentError('An error occured during a calibration of'
+                                  ' the' + self.name + '\n The following '
+                                  ' error was raised...\n %s' % repr(e))
+
+    def moveAsync(self, selected_pos, progress=None):
+        """Starts moving the wheel to a selected position and returns at
+        once.
+
+        Arguments:
+            selected_pos -- Which position to move to. -> int
+            progress     -- Called as progress(future, position) while the
+                            wheel turns. -> callable
+
+        Returns:
+            MotionFuture, whose result is the new position. -> MotionFuture
+        """
+        return self.dispatch.start(self._move, selected_pos,
+                                   progress=progress)
+
+    def homeAsync(self, progress=None):
+        """Starts homing the wheel and returns at once.
+
+        Arguments:
+            progress -- Called as progress(future, position) while the
+                        wheel turns. -> callable
+
+        Returns:
+            MotionFuture -> MotionFuture
+        """
+        return self.dispatch.start(self._home, progress=progress)
+
+    def _move(self, socket, selected_pos):
+        position = np.NewportWheelMove(self.controller, self.name, socket,
+                                       self.current_pos, selected_pos)
+        with self.lock.write():
+            self.current_pos = position
+        return position
+
+    def _calibrate(self, socket):
+        offsets = np.NewportWheelCalibrate(self.controller, self.name, socket)
+        with self.lock.write():
+            self.current_pos = 0
+        return offsets
+
+    def _home(self, socket):
+        np.NewportWheelHome(self.controller, self.name, socket)
+        with self.lock.write():
+            self.current_pos = 0
+
     def kill(self):
         """Stops motion. Called by a kill_all.
             
@@ -110,7 +182,8 @@ class DewarWheel(InstrumentComponent):
             None
         """
         try:
-            np.NewportKill(self.controller, self.name, self.sockets[1])
+            with self.pool.socket() as socket:
+                np.NewportKill(self.controller, self.name, socket)
 
         except Exception as e:
             raise InstrumentError('An error occured during a kill sequence of'
@@ -118,7 +191,8 @@ class DewarWheel(InstrumentComponent):
                                   ' error was raised...\n %s' % repr(e))
 
     def initialize(self):
-        """Initializes the motor.
+        """Initializes the motor, keeping the position saved by the last run
+        when the switches agree with it, and homing it otherwise.
             
         Arguments:
             None
@@ -129,10 +203,14 @@ class DewarWheel(InstrumentComponent):
         Returns:
             None
         """
+        def initialize(socket):
+            position = np.NewportWheelStart(self.controller, self.name,
+                                            socket, self.home_pos)
+            with self.lock.write():
+                self.current_pos = position
+
         try:
-            with self.lock:
-                np.NewportInitialize(self.controller, self.name,
-                                     self.sockets[0], self.home_pos)
+            self.dispatch.move(initialize)
         #TODO: We shouldn't have a catchall here!
         except Exception as e:
             raise InstrumentError('An error occured during initialization of'
@@ -0,0 +1,319 @@
+"""
+.. module:: dispatcher
+   :platform: Unix
+   :synopsis: Per-component XPS command lanes, each bound to its own socket.
+
+"""
+
+import logging
+import Queue
+import sys
+import threading
+
+from xpsasync import XPSTimeoutError
+from instrument.component import InstrumentError
+
+
+class Command(object):
+    """A call submitted to a CommandLane. Waits for, and hands back, the
+    result or the exception of the call, like XPSFuture does for a single
+    XPS function.
+    """
+
+    def __init__(self, func, args, kwargs):
+        self.func       = func
+        self.args       = args
+        self.kwargs     = kwargs
+        self.started    = threading.Event()
+        self._done      = threading.Event()
+        self._result    = None
+        self._error     = None
+        self._callbacks = []
+        self._lock      = threading.Lock()
+
+    def done(self):
+        """True once the call has returned or raised."""
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Wait for the call to finish. Returns done()."""
+        self._done.wait(timeout)
+        return self.done()
+
+    def result(self, timeout=None):
+        """Wait for the call and return its result, or raise its exception
+        in the calling thread.
+
+        Raises:
+            XPSTimeoutError if the call did not finish within timeout.
+        """
+        if not self.wait(timeout):
+            raise XPSTimeoutError('%s did not finish within %s s!'
+                                  % (self.func.__name__, timeout))
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._result
+
+    def exception(self):
+        """Exception raised by the finished call, None if it returned."""
+        return None if self._error is None else self._error[1]
+
+    def add_done_callback(self, fn):
+        """Call fn(command) once the call finishes. Callbacks run in the
+        lane thread and must not block.
+        """
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _run(self, socket):
+        self.started.set()
+        try:
+            self._result = self.func(socket, *self.args, **self.kwargs)
+        except Exception:
+            self._error = sys.exc_info()
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                logging.exception('Command callback failed.')
+
+
+class MotionFuture(Command):
+    """Command of a motion started with XPSDispatcher.start.
+
+    While the motion runs, the dispatcher polls the group on its query
+    socket and passes the position to the progress callbacks.
+
+    Attributes:
+        group    -- XPS group being moved.
+        position -- Last polled position, None before the first poll.
+        moving   -- Last polled GroupMotionStatusGet, None before the
+                    first poll.
+    """
+
+    def __init__(self, func, args, kwargs, group):
+        super(MotionFuture, self).__init__(func, args, kwargs)
+        self.group     = group
+        self.position  = None
+        self.moving    = None
+        self._progress = []
+
+    def add_progress_callback(self, fn):
+        """Call fn(future, position) after every poll of the motion, and
+        once more with the final position. Callbacks run in the monitor
+        thread and must not block.
+        """
+        self._progress.append(fn)
+
+    def _update(self, moving, position):
+        self.moving   = moving
+        self.position = position
+        for fn in list(self._progress):
+            try:
+                fn(self, position)
+            except Exception:
+                logging.exception('Motion progress callback failed.')
+
+
+class CommandLane(object):
+    """One worker thread owning one XPS socket. Calls submitted to the lane
+    run in order, one at a time, on that socket.
+
+    Attributes:
+        name   -- Name of the lane, used for the thread name.
+        socket -- XPS socket id the lane owns.
+    """
+
+    def __init__(self, pool, name):
+        """Check a socket out of the pool and start the worker.
+
+        Arguments:
+            pool -- Socket pool -> XPSConnectionPool
+            name -- Name of the lane -> str
+
+        Raises:
+            InstrumentError
+        """
+        self.name   = name
+        self.pool   = pool
+        self.socket = pool.checkout()
+        self._queue = Queue.Queue()
+        self._ping  = None
+
+        self._thread = threading.Thread(name=name, target=self._work)
+        self._thread.daemon = True
+        self._thread.start()
+        pool.attach(self)
+
+    def __repr__(self):
+        return 'lane %s' % self.name
+
+    @property
+    def pending(self):
+        """Number of calls waiting in the lane."""
+        return self._queue.qsize()
+
+    def submit(self, func, *args, **kwargs):
+        """Queue func(socket, *args, **kwargs) and return at once.
+
+        Returns:
+            Command of the call -> Command
+        """
+        return self.queue(Command(func, args, kwargs))
+
+    def queue(self, command):
+        """Queue a Command built by the caller. Returns the command."""
+        self._queue.put(command)
+        return command
+
+    def run(self, func, *args, **kwargs):
+        """Queue func(socket, *args, **kwargs) and wait for its result."""
+        if threading.current_thread() is self._thread:
+            #Already on the lane, queueing would wait on ourselves.
+            return func(self.socket, *args, **kwargs)
+        return self.submit(func, *args, **kwargs).result()
+
+    def ping(self):
+        """Queue a TCP_Ping of the lane socket, unless the last one is
+        still waiting, e.g. behind a long motion. Called by the pool
+        heartbeat.
+        """
+        if self._ping is None or self._ping.done():
+            self._ping = self.submit(self._pingSocket)
+
+    def _pingSocket(self, socket):
+        if not self.pool.controller.TCP_Ping(socket):
+            logging.warning('XPS lane %s socket was dead.' % self.name)
+
+    def close(self):
+        """Finish the queued calls, stop the worker and give the socket
+        back to the pool.
+        """
+        self.pool.detach(self)
+        self._queue.put(None)
+
+    def _work(self):
+        while True:
+            command = self._queue.get()
+            if command is None:
+                break
+            command._run(self.socket)
+        self.pool.checkin(self.socket)
+        logging.debug('XPS lane %s closed.' % self.name)
+
+
+class XPSDispatcher(object):
+    """Command dispatcher of a Newport component.
+
+    Motion commands (moves, homing, initialization) block their socket until
+    the motion is over. They run in the motion lane, in order. Status and
+    position reads run in the query lane, on a second socket, so they are
+    answered while a motion is in flight.
+
+    start() queues a motion and returns a MotionFuture at once. The motion
+    is over when its call returns (the controller answers a move once the
+    motion is done); meanwhile a monitor thread polls GroupMotionStatusGet
+    and GroupPositionCurrentGet through the query lane for the progress
+    callbacks.
+
+    Stopping calls (kill, stop) must not wait behind the motion they stop,
+    they take a socket from the pool directly.
+
+    Attributes:
+        controller -- XPS instance of the component.
+        group      -- XPS group of the component.
+        period     -- Seconds between two polls of a running motion.
+        motion     -- CommandLane of the motion commands.
+        query      -- CommandLane of the status reads.
+    """
+
+    def __init__(self, controller, pool, name, group, period=0.2):
+        """Open the two lanes.
+
+        Arguments:
+            controller -- XPS instance -> XPS_C8_drivers.XPS
+            pool       -- Socket pool -> XPSConnectionPool
+            name       -- Name of the component -> str
+            group      -- XPS group of the component -> str
+            period     -- Seconds between two polls of a motion -> float
+
+        Raises:
+            InstrumentError
+        """
+        self.controller = controller
+        self.group      = group
+        self.period     = period
+        self.motion = CommandLane(pool, '%s-motion' % name)
+        try:
+            self.query = CommandLane(pool, '%s-query' % name)
+        except InstrumentError:
+            self.motion.close()
+            raise
+
+    def move(self, func, *args, **kwargs):
+        """Run func(socket, ...) in the motion lane and wait for it."""
+        return self.motion.run(func, *args, **kwargs)
+
+    def read(self, func, *args, **kwargs):
+        """Run func(socket, ...) in the query lane and wait for it."""
+        return self.query.run(func, *args, **kwargs)
+
+    def start(self, func, *args, **kwargs):
+        """Queue func(socket, ...) in the motion lane and return at once.
+
+        The keyword argument progress, if given, is added as a progress
+        callback (see MotionFuture.add_progress_callback).
+
+        Returns:
+            MotionFuture
+        """
+        progress = kwargs.pop('progress', None)
+        future   = MotionFuture(func, args, kwargs, self.group)
+        if progress is not None:
+            future.add_progress_callback(progress)
+        self.motion.queue(future)
+
+        thread = threading.Thread(name='%s-monitor' % self.motion.name,
+                                  target=self._monitor, args=(future,))
+        thread.daemon = True
+        thread.start()
+        return future
+
+    def status(self, socket):
+        """Motion status and position of the group, in one round trip.
+
+        Returns:
+            (moving, position), None for a value that could not be read
+            -> (bool, float)
+        """
+        status, position = self.controller.TCP_Pipeline(
+            socket, [('GroupMotionStatusGet', (self.group, 1)),
+                     ('GroupPositionCurrentGet', (self.group, 1))])
+        return (bool(status[1]) if status[0] == 0 else None,
+                position[1] if position[0] == 0 else None)
+
+    def _monitor(self, future):
+        #Wait for the motions queued before this one.
+        while not future.started.wait(self.period):
+            if future.done():
+                break
+        while True:
+            finished = future.wait(self.period)
+            try:
+                future._update(*self.read(self.status))
+            except Exception as e:
+                logging.error('Unable to poll the motion of %s: %s'
+                              % (self.group, e))
+            if finished:
+                break
+
+    def close(self):
+        """Close both lanes."""
+        self.motion.close()
+        self.query.close()
@@ -0,0 +1,184 @@
+import threading
+
+import instrument.actuators.newport as np
+from instrument.actuators.dispatcher import XPSDispatcher
+from instrument.component import InstrumentComponent, InstrumentError, logCall
+
+
+class FocalPlane(InstrumentComponent):
+    """Represents the Newport controlled focal plane array (FPA) stage.
+
+    Methods:
+        home
+        homeAsync
+        initialize
+        kill
+        move
+        moveAsync
+        stop
+    """
+
+    def __init__(self, instrument, controller, pool, motor='array'):
+        """Connects to, initializes, and homes the FPA stage.
+
+        Arguments:
+            instrument -- Copy of the NESSI instrument
+            controller -- XPS instance to use for control
+            pool       -- Pool of XPS sockets (XPSConnectionPool)
+            motor      -- Config section of the stage
+
+        Raises:
+             InstrumentError
+        """
+
+        super(FocalPlane, self).__init__(instrument)
+
+        self.motor      = motor
+        self.controller = controller
+        self.pool       = pool
+        self.travel     = 0.0
+        self._stop_home = threading.Event()
+        self.dispatch   = XPSDispatcher(controller, pool, motor,
+                                        np.settings[motor].group)
+
+        #The dispatcher holds two pool sockets and two lane threads.
+        try:
+            self.initialize()
+        except:
+            self.dispatch.close()
+            raise
+
+    @property
+    def position(self):
+        """Micrometers moved up from the lower limit, as counted by the
+        completed moves.
+        """
+        with self.lock.read():
+            return self.travel
+
+    def initialize(self):
+        """Initializes the motor and homes it on the lower limit switch.
+
+        Raises:
+            InstrumentError
+        """
+        def initialize(socket):
+            np.NewportInitialize(self.controller, self.motor, socket, 0)
+            self._home(socket)
+
+        try:
+            self.dispatch.move(initialize)
+
+        except InstrumentError as e:
+            raise InstrumentError('An error occured during initialization of'
+                                  ' the FPA.\n The following '
+                                  ' error was raised...\n %s' % repr(e))
+
+    @logCall(msg='Moving FPA.')
+    def move(self, distance, speed, direction):
+        """Moves the FPA by a distance.
+
+        Arguments:
+            distance  -- How far to move, in micrometers. -> float
+            speed     -- Velocity of the motion. -> float
+            direction -- Which direction to move. -> +-1
+
+        Raises:
+            InstrumentError
+
+        Returns:
+            The new position. -> float
+        """
+        try:
+            return self.dispatch.move(self._move, distance, speed, direction)
+
+        except InstrumentError as e:
+            raise InstrumentError('An error occured during a movement of'
+                                  ' the FPA. \n The following '
+                                  ' error was raised...\n %s' % repr(e))
+
+    def moveAsync(self, distance, speed, direction, progress=None):
+        """Starts moving the FPA by a distance and returns at once.
+
+        Arguments:
+            distance  -- How far to move, in micrometers. -> float
+            speed     -- Velocity of the motion. -> float
+            direction -- Which direction to move. -> +-1
+            progress  -- Called as progress(future, position) during the
+                         move, with the motor position in degrees.
+
+        Returns:
+            MotionFuture, whose result is the new position.
+        """
+        return self.dispatch.start(self._move, distance, speed, direction,
+                                   progress=progress)
+
+    @logCall(msg='Homeing the FPA.')
+    def home(self):
+        """Moves the FPA down to the lower limit switch.
+
+        Raises:
+            InstrumentError
+        """
+        try:
+            self.dispatch.move(self._home)
+
+        except InstrumentError as e:
+            raise InstrumentError('An error occured during a homing of'
+                                  ' the FPA. \n The following '
+                                  ' error was raised...\n %s' % repr(e))
+
+    def homeAsync(self, progress=None):
+        """Starts homing the FPA and returns at once.
+
+        Returns:
+            MotionFuture
+        """
+        return self.dispatch.start(self._home, progress=progress)
+
+    def kill(self):
+        """Stops motion. Called by a kill_all.
+
+        Raises:
+            InstrumentError
+        """
+        try:
+            with self.pool.socket() as socket:
+                np.NewportKill(self.controller, self.motor, socket)
+
+        except InstrumentError as e:
+            raise InstrumentError('An error occured during a kill sequence of'
+                                  ' the FPA.\n The following '
+                                  ' error was raised...\n %s' % repr(e))
+
+    @logCall(msg='Stopping FPA.')
+    def stop(self):
+        """Aborts a move, or stops the homing spin and ends the homing.
+
+        Raises:
+            InstrumentError
+        """
+        with self.pool.socket() as socket:
+            abort = self.controller.GroupMoveAbort(
+                socket, np.settings[self.motor].group)
+            if abort[0] != 0:
+                np.NewportStop(self.controller, socket, self.motor)
+                #The home lane waits for a lower switch that never comes.
+                self._stop_home.set()
+
+    def _move(self, socket, distance, speed, direction):
+        travel = np.NewportFocusMove(self.controller, [socket, socket],
+                                     self.motor, distance, speed, direction)
+        if travel == 'ERROR':
+            raise InstrumentError('The FPA move was stopped by a limit'
+                                  ' switch!')
+        with self.lock.write():
+            self.travel += direction * travel
+            return self.travel
+
+    def _home(self, socket):
+        self._stop_home.clear()
+        np.NewportFocusHome(self.controller, socket, self.motor,
+                            self._stop_home)
+        with self.lock.write():
+            self.travel = 0.0
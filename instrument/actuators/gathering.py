@@ -0,0 +1,203 @@
+"""
+.. module:: gathering
+   :platform: Unix
+   :synopsis: Servo rate trajectory capture with the XPS Gathering.
+
+The controller samples the requested quantities itself, at up to the servo
+rate, into its gathering buffer; nothing is polled while the motion runs.
+Afterwards the buffer is read back in large multi-line chunks and returned
+as a NumPy record array:
+
+    capture = GatheringCapture(controller, pool, ['M.P1'])
+    data    = capture.record(10, rate=1000, during=lambda: kmirror.move(20))
+    data['M.P1.FollowingError'].std()
+    capture.save('kmirror-move.npy', data)
+"""
+
+import logging
+import time
+
+import numpy
+
+from instrument.component import InstrumentError
+
+#Rate of the XPS-C8 corrector loop, the fastest gathering rate [Hz]
+SERVO_RATE = 8000.0
+
+#Short names of the gathering types of one positioner
+QUANTITIES = {'position'     : 'CurrentPosition',
+              'setpoint'     : 'SetpointPosition',
+              'error'        : 'FollowingError',
+              'velocity'     : 'CurrentVelocity',
+              'setpoint_vel' : 'SetpointVelocity'}
+
+#Reply size aimed at by one GatheringDataMultipleLinesGet [bytes]
+CHUNK_BYTES = 60000
+
+#Seconds record() waits past its duration for the buffer to fill
+RECORD_MARGIN = 5.0
+
+
+class GatheringCapture(object):
+    """Configures, runs and reads back the XPS Gathering.
+
+    The gathering buffer belongs to the controller, so only one capture can
+    run at a time.
+
+    Attributes:
+        controller -- XPS instance.
+        pool       -- XPSConnectionPool the sockets are taken from.
+        types      -- Gathering types, i.e. the columns of the capture.
+        rate       -- Sampling rate of the last start() [Hz].
+    """
+
+    def __init__(self, controller, pool, positioners,
+                 quantities=('position', 'setpoint', 'error')):
+        """
+        Arguments:
+            controller  -- XPS instance -> XPS_C8_drivers.XPS
+            pool        -- Socket pool -> XPSConnectionPool
+            positioners -- Positioners to sample, e.g. ['M.P1'] -> [str]
+            quantities  -- Keys of QUANTITIES to sample for each
+                           positioner -> [str]
+        """
+        self.controller = controller
+        self.pool       = pool
+        self.types      = ['%s.%s' % (positioner, QUANTITIES[quantity])
+                           for positioner in positioners
+                           for quantity in quantities]
+        self.rate       = None
+
+    def _call(self, name, *args):
+        with self.pool.socket() as socket:
+            ret = getattr(self.controller, name)(socket, *args)
+        if ret[0] != 0:
+            raise InstrumentError('%s failed with XPS error %d.'
+                                  % (name, ret[0]))
+        return ret
+
+    def start(self, samples, rate=1000.0):
+        """Configure the gathering and start sampling.
+
+        Arguments:
+            samples -- Number of samples to take -> int
+            rate    -- Sampling rate, rounded to SERVO_RATE / n [Hz] -> float
+
+        Raises:
+            InstrumentError
+        """
+        divisor   = max(1, int(round(SERVO_RATE / rate)))
+        self.rate = SERVO_RATE / divisor
+        self._call('GatheringConfigurationSet', self.types)
+        self._call('GatheringRun', int(samples), divisor)
+        logging.debug('Gathering %d samples of %s at %g Hz.'
+                      % (samples, ', '.join(self.types), self.rate))
+
+    def stop(self):
+        """Stop sampling before the buffer is full."""
+        self._call('GatheringStop')
+
+    def progress(self):
+        """
+        Returns:
+            (samples gathered so far, buffer capacity) -> (int, int)
+        """
+        ret = self._call('GatheringCurrentNumberGet')
+        return ret[1], ret[2]
+
+    def read(self, chunk=None):
+        """Read the gathered samples back.
+
+        Arguments:
+            chunk -- Lines per GatheringDataMultipleLinesGet. By default
+                     as many as fit in CHUNK_BYTES; halved whenever the
+                     controller refuses a chunk.
+
+        Raises:
+            InstrumentError
+
+        Returns:
+            Record array with a 'time' field [s] and one float field per
+            gathering type -> numpy.ndarray
+        """
+        count   = self.progress()[0]
+        columns = len(self.types)
+        if chunk is None:
+            chunk = max(1, CHUNK_BYTES // (16 * columns))
+
+        values = numpy.empty((count, columns))
+        start  = time.time()
+        index  = 0
+        with self.pool.socket() as socket:
+            while index < count:
+                lines = min(chunk, count - index)
+                ret   = self.controller.GatheringDataMultipleLinesGet(
+                    socket, index, lines)
+                if ret[0] != 0:
+                    if lines == 1:
+                        raise InstrumentError('GatheringDataMultipleLinesGet'
+                                              ' failed with XPS error %d.'
+                                              % ret[0])
+                    chunk = lines // 2
+                    continue
+                # Lines are separated by newlines, values by semicolons
+                block = numpy.fromstring(ret[1].strip().replace('\n', ';'),
+                                      sep=';')
+                values[index:index + lines] = block.reshape(lines, columns)
+                index += lines
+        logging.debug('Read %d gathering samples in %.3f s.'
+                      % (count, time.time() - start))
+
+        data = numpy.empty(count, dtype=[('time', float)] +
+                                     [(name, float) for name in self.types])
+        data['time'] = numpy.arange(count) / (self.rate or SERVO_RATE)
+        for i, name in enumerate(self.types):
+            data[name] = values[:, i]
+        return data
+
+    def record(self, duration, rate=1000.0, during=None):
+        """Capture for a fixed duration.
+
+        Arguments:
+            duration -- Seconds to capture -> float
+            rate     -- Sampling rate [Hz] -> float
+            during   -- Called once sampling has started, e.g. to start a
+                        move -> callable
+
+        Raises:
+            InstrumentError, also if the buffer is not full RECORD_MARGIN
+            seconds after the duration. The gathering is then stopped.
+
+        Returns:
+            See read()
+        """
+        samples  = int(duration * rate) or 1
+        self.start(samples, rate)
+        deadline = time.time() + duration + RECORD_MARGIN
+        full     = False
+        try:
+            if during is not None:
+                during()
+            while True:
+                current = self.progress()[0]
+                if current >= samples:
+                    break
+                if time.time() > deadline:
+                    raise InstrumentError('Gathering took %d of %d samples'
+                                          ' in %g s.' % (current, samples,
+                                          duration + RECORD_MARGIN))
+                time.sleep(max(0.05, min(float(samples - current) / self.rate,
+                                         deadline - time.time())))
+            full = True
+        finally:
+            if not full:
+                try:
+                    self.stop()
+                except InstrumentError as e:
+                    logging.error('Unable to stop the gathering: %s' % e)
+        return self.read()
+
+    @staticmethod
+    def save(path, data):
+        """Save a capture as a .npy file (field names are kept)."""
+        numpy.save(path, data)
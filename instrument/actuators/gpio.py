@@ -0,0 +1,283 @@
+"""
+.. module:: gpio
+   :platform: Unix
+   :synopsis: Shared sampler of the GPIO4.DI home, position and limit switches.
+
+"""
+
+import collections
+import logging
+import threading
+import time
+
+from instrument.component import InstrumentError
+
+#GPIO word holding the home, position and limit switches
+SWITCHES = 'GPIO4.DI'
+
+#Switch subsections of a motor section in nessisettings.ini
+SWITCH_NAMES = ('home', 'position', 'lower', 'upper')
+
+
+class Switch(collections.namedtuple('Switch', 'motor name bit mask on')):
+    """One switch with its precomputed GPIO4.DI test.
+
+    Attributes:
+        motor -- nessisettings.ini section, e.g. mask.
+        name  -- Switch name, one of SWITCH_NAMES.
+        bit   -- GPIO4.DI bit the switch is wired to.
+        mask  -- 1 << bit.
+        on    -- word & mask when the switch reads its configured val.
+    """
+    __slots__ = ()
+
+    def test(self, word):
+        """True if the switch reads its configured value in word."""
+        return word & self.mask == self.on
+
+
+def switch(motor, name, bit, val):
+    """Build the Switch of a bit that is set when it reads val."""
+    mask = 1 << int(bit)
+    return Switch(motor, name, int(bit), mask, mask if int(val) else 0)
+
+
+def switches(motors):
+    """Every switch of the compiled motor sections.
+
+    Arguments:
+        motors -- {motor: motorconfig.Motor}
+
+    Returns:
+        {(motor, name): Switch}
+    """
+    found = {}
+    for motor in motors.values():
+        for name in SWITCH_NAMES:
+            if getattr(motor, name) is not None:
+                found[(motor.motor, name)] = getattr(motor, name)
+    return found
+
+
+class GPIOSampler(object):
+    """Background reader of GPIO4.DI, shared by every switch consumer.
+
+    One GPIODigitalGet per tick, on a socket of its own, serves all the
+    wheels, homing routines and limit checks, and the ControllerSnapshot:
+    concurrent consumers cost one controller query per tick instead of one
+    each. The switches are tested against masks precomputed from
+    nessisettings.ini (see Switch), rebuilt when the settings are reloaded.
+
+    The sampler only ticks while a consumer waits in read, state or wait,
+    and at most `rate` times per second. A lone read after an idle spell is
+    answered by the next round trip, so it costs no more than its own
+    GPIODigitalGet would.
+
+    A sample is stamped with the time its request was sent, so read(since)
+    only returns a word read after `since`, e.g. after a motion stopped.
+
+    The socket stays checked out, so the pool heartbeat asks the sampler to
+    ping it (see ping).
+
+    Attributes:
+        rate     -- Samples per second.
+        settings -- nessisettings.ini -> motorconfig.Settings
+    """
+
+    def __init__(self, controller, pool, settings, rate=None):
+        """Start sampling.
+
+        Arguments:
+            controller -- XPS instance -> XPS_C8_drivers.XPS
+            pool       -- Socket pool -> XPSConnectionPool
+            settings   -- NESSI settings -> motorconfig.Settings
+            rate       -- Samples per second, defaults to
+                          [general] gpio rate -> float
+
+        Raises:
+            InstrumentError
+        """
+        self.controller = controller
+        self.pool       = pool
+        self.settings   = settings
+        self.rate       = float(rate if rate is not None else
+                                settings.cfg['general'].get('gpio rate', 50))
+
+        self._motors   = None
+        self._switches = None
+        self._word     = None
+        self._time     = 0.0
+        self._waiters  = 0
+        self._cond     = threading.Condition()
+        self._stop     = threading.Event()
+        self._failing  = False
+        self._ping     = False
+        self._socket   = pool.checkout()
+
+        self._thread   = threading.Thread(name='GPIOSampler',
+                                          target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        pool.attach(self)
+
+    def __repr__(self):
+        return 'the %s sampler' % SWITCHES
+
+    @property
+    def switches(self):
+        """{(motor, name): Switch} of nessisettings.ini, rebuilt after
+        Settings.reload() replaced the motors.
+        """
+        motors = self.settings.motors
+        if motors is not self._motors:
+            self._switches = switches(motors)
+            self._motors   = motors
+        return self._switches
+
+    @property
+    def word(self):
+        """Most recent GPIO4.DI word, None until the first sample. It may be
+        old, the sampler does not tick without consumers.
+        """
+        return self._word
+
+    def read(self, since=None, timeout=1):
+        """GPIO4.DI word of a sample requested after `since`.
+
+        Arguments:
+            since   -- time.time() the sample must be newer than, None for
+                       any sample -> float
+            timeout -- Seconds to wait -> float
+
+        Raises:
+            InstrumentError
+
+        Returns:
+            GPIO4.DI word -> int
+        """
+        word = self.poll(since, timeout)
+        if word is None:
+            raise InstrumentError(self._failure(timeout))
+        return word
+
+    def poll(self, since=None, timeout=1):
+        """Like read, but None instead of an error, e.g. for the
+        ControllerSnapshot, which samples while the controller is down.
+
+        Returns:
+            GPIO4.DI word, None if no sample came within timeout -> int
+        """
+        since = 0.0 if since is None else since
+        if not self._until(lambda: self._word is not None and
+                           self._time > since, timeout):
+            return None
+        return self._word
+
+    def state(self, motor, name, since=None, timeout=1):
+        """Whether a switch of nessisettings.ini reads its configured value.
+
+        Arguments:
+            motor -- Section of the switch, e.g. mask -> str
+            name  -- Switch name, e.g. home -> str
+            since, timeout -- See read.
+
+        Returns:
+            bool
+        """
+        return self.switches[(motor, name)].test(self.read(since, timeout))
+
+    def wait(self, switch, timeout=None):
+        """Block until a switch reads its configured value.
+
+        Arguments:
+            switch  -- Switch, or (motor, name) of nessisettings.ini
+            timeout -- Seconds to wait, None waits forever -> float
+
+        Raises:
+            InstrumentError
+
+        Returns:
+            GPIO4.DI word of the sample that satisfied the wait -> int
+        """
+        if not isinstance(switch, Switch):
+            switch = self.switches[switch]
+        if not self._until(lambda: self._word is not None and
+                           switch.test(self._word), timeout):
+            raise InstrumentError(self._failure(timeout))
+        return self._word
+
+    def ping(self):
+        """Ping the socket at the next idle tick, a tick with consumers
+        checks it anyway. Called by the pool heartbeat.
+        """
+        with self._cond:
+            self._ping = True
+            self._cond.notify_all()
+
+    def stop(self, timeout=2):
+        """Stop sampling and give the socket back."""
+        self.pool.detach(self)
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+        if threading.current_thread() is not self._thread:
+            self._thread.join(timeout)
+
+    def _failure(self, timeout):
+        if self._stop.is_set():
+            return 'The %s sampler is stopped!' % SWITCHES
+        return 'No usable %s sample within %s s!' % (SWITCHES, timeout)
+
+    def _until(self, predicate, timeout):
+        """False if the sampler stopped or the timeout passed first."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            self._waiters += 1
+            self._cond.notify_all()
+            try:
+                while not predicate():
+                    remaining = None if deadline is None else \
+                                deadline - time.time()
+                    if remaining is not None and remaining <= 0 or \
+                       self._stop.is_set():
+                        return False
+                    self._cond.wait(remaining)
+                return True
+            finally:
+                self._waiters -= 1
+
+    def _run(self):
+        period = 1.0 / self.rate
+        start  = 0.0
+        while True:
+            #Keep the ticks at least a period apart, which also gives the
+            #consumers of the last sample time to stop waiting.
+            if self._stop.wait(max(0, start + period - time.time())):
+                break
+            with self._cond:
+                while not self._waiters and not self._ping and \
+                      not self._stop.is_set():
+                    self._cond.wait()
+                ping, self._ping = self._ping and not self._waiters, False
+            if self._stop.is_set():
+                break
+            if ping:
+                if not self.controller.TCP_Ping(self._socket):
+                    logging.warning('GPIO sampler socket was dead.')
+                continue
+            start = time.time()
+            value = self.controller.GPIODigitalGet(self._socket, SWITCHES)
+            if value[0] != 0:
+                if not self._failing:
+                    logging.error('GPIO sampler could not read %s: error %d'
+                                  % (SWITCHES, value[0]))
+                self._failing = True
+            else:
+                self._failing = False
+                with self._cond:
+                    self._word = value[1]
+                    self._time = start
+                    self._cond.notify_all()
+        with self._cond:
+            self._cond.notify_all()
+        self.pool.checkin(self._socket)
@@ -1,6 +1,7 @@
-from threadtools import run_async
-import math
 import instrument.actuators.newport as np
+from instrument.actuators.derotator import Derotator, DiscreteTracker
+from instrument.actuators.dispatcher import XPSDispatcher
+from instrument.actuators.pvt import PVTDerotator
 from instrument.component import InstrumentComponent, InstrumentError, logCall
 
 
@@ -11,17 +12,18 @@ class KMirror(InstrumentComponent):
         initialize
         kill
         move
+        moveAsync
         stop
         track
     """
 
-    def __init__(self, instrument, controller, sockets):
+    def __init__(self, instrument, controller, pool):
         """Connects to, initializes, and homes a specified wheel in the dewar. 
 
         Arguments:
             instrument -- Copy of the NESSI instrument
             controller -- XPS instance to use for control 
-            sockets    -- List of integers representing TCP sockets
+            pool       -- Pool of XPS sockets (XPSConnectionPool)
 
         Raises:
              InstrumentError
@@ -34,12 +36,20 @@ class KMirror(InstrumentComponent):
         
         self.motor = 'kmirror'
         self.controller = controller
-        self.sockets = sockets
+        self.pool = pool
         self.home_pos = 0
         self.current_pos = 0
         self.track_status = False
+        self.derotator = None
+        self.dispatch = XPSDispatcher(controller, pool, self.motor,
+                                      np.settings[self.motor].group)
 
-        self.initialize()
+        #The dispatcher holds two pool sockets and two lane threads.
+        try:
+            self.initialize()
+        except:
+            self.dispatch.close()
+            raise
 
     def initialize(self):
         """Initializes the motor.
@@ -53,13 +63,16 @@ class KMirror(InstrumentComponent):
         Returns:
             None
         """
-        try:
-            with self.lock:
-                self.track_status = False
-                np.NewportInitialize(self.controller, self.motor,
-                                     self.sockets[0], self.home_pos)
+        def initialize(socket):
+            self.track_status = False
+            np.NewportInitialize(self.controller, self.motor,
+                                 socket, self.home_pos)
+            with self.lock.write():
                 self.current_pos = 0
 
+        try:
+            self.dispatch.move(initialize)
+
         except InstrumentError as e:
             raise InstrumentError('An error occured during initialization of'
                                   ' the K-Mirror.\n The following '
@@ -79,7 +92,10 @@ class KMirror(InstrumentComponent):
         """
         try:
             self.track_status = False
-            np.NewportKill(self.controller, self.motor, self.sockets[1])
+            if self.derotator is not None:
+                self.derotator.stop(timeout=0)
+            with self.pool.socket() as socket:
+                np.NewportKill(self.controller, self.motor, socket)
 
         except InstrumentError as e:
             raise InstrumentError('An error occured during a kill sequence of'
@@ -88,14 +104,31 @@ class KMirror(InstrumentComponent):
 
     @property
     def positionAngle(self):
-        return np.NewportStatusGet(self.controller, self.sockets[1], 
-                                   self.motor)[0]
+        """Current angle, from the controller snapshot when it is
+        running and recent (no controller round trip), otherwise read
+        directly.
+        """
+        snapshot = self.instrument.snapshot
+        latest   = snapshot.fresh() if snapshot is not None else None
+        if latest is not None:
+            position = latest.motor(self.motor).position
+            if position is not None:
+                return position
+        return self.readPositionAngle()
+
+    def readPositionAngle(self):
+        """Reads the current angle from the controller, through the query
+        lane so it is answered during a move.
+        """
+        return self.dispatch.read(
+            lambda socket: np.NewportStatusGet(self.controller, socket,
+                                               self.motor)[0])
 
     def userAngleToPositionAngle(self, userAngle):
         if self.instrument.telescope:
             parallactic_angle = self.instrument.telescope.parallactic_angle
             altitude      = self.instrument.telescope.altitude
-            tmode         = int(self.instrument.cfg['kmirror']['direction'])
+            tmode         = np.settings[self.motor].direction
             positionAngle = 0.5 * ((userAngle - parallactic_angle) 
                                  - tmode * (altitude))
             return positionAngle
@@ -118,44 +151,38 @@ class KMirror(InstrumentComponent):
             None
         """
         try:
-            with self.lock:
-                np.NewportKmirrorMove(self.controller, self.sockets[0], 
-                                   self.motor, position)
-                self.current_pos = self.positionAngle
+            self.dispatch.move(self._move, position)
 
         except InstrumentError as e:
             raise InstrumentError('An error occured during a movement of'
                                   ' the K-Mirror. \n The following '
                                   ' error was raised...\n %s' % repr(e))
 
+    def moveAsync(self, position, progress=None):
+        """Starts moving to a selected position and returns at once.
+
+        Arguments:
+            position -- Which position [float] to move to. Limited to +-170.
+            progress -- Called as progress(future, angle) during the move.
+
+        Returns:
+            MotionFuture, whose result is the reached angle.
+        """
+        return self.dispatch.start(self._move, position, progress=progress)
+
+    def _move(self, socket, position):
+        np.NewportKmirrorMove(self.controller, socket, self.motor, position)
+        angle = np.NewportStatusGet(self.controller, socket, self.motor)[0]
+        with self.lock.write():
+            self.current_pos = angle
+        return angle
+
     def moveToUserAngle(self, userAngle):
         pa = self.userAngleToPositionAngle(userAngle)
-        if not pa:
+        if pa is None:
             raise InstrumentError('Unable to produce Position Angle from'
                                   'user angle!')
-        self.move(self.userAngleToPositionAngle(userAngle))
-
-
-    def setVelocity(self):
-        vel = self.calculateVelocity()
-        if not vel:
-            raise InstrumentError('Unable to produce new velocity for'
-                                  'tracking.')
-        self.updateVelocity(self.calculateVelocity())
-        
-
-    def calculateVelocity():
-        if self.instrument.telescope:
-            phi = math.radians(33.984861)
-            azimuth   = self.instrument.telescope.azimuth
-            altitude  = self.instrument.telescope.altitude
-            vel       = ((-.262)*(.5)*180*math.cos(phi)*math.cos(azimuth))/\
-                        (math.cos(altitude)*3600*math.pi)
-            return vel
-        else:
-            return None
-        
-    
+        self.move(pa)
 
     @logCall(msg='Stepping KMirror.')   
     def step(self, offset):
@@ -170,7 +197,7 @@ class KMirror(InstrumentComponent):
         Returns:
             None
         """
-        self.move(offset + self.positionAngle)
+        self.move(offset + self.readPositionAngle())
 
     @logCall(msg='Homeing the Kmirror.')
     def home(self):
@@ -200,17 +227,22 @@ class KMirror(InstrumentComponent):
             None
         """
         try:
+            if self.derotator is not None and self.derotator.running:
+                #The derotator ends its own jog.
+                self.derotator.stop()
+                return
             self.track_status = False
-            np.NewportStop(self.controller, self.sockets[2], self.motor)
+            with self.pool.socket() as socket:
+                np.NewportStop(self.controller, socket, self.motor)
         
         except InstrumentError as e:
             raise InstrumentError('An error occured during a stop sequence of'
                                   ' the K-Mirror.\n The following '
                                   ' error was raised...\n %s' % repr(e))    
     @logCall(msg='Tracking KMirror')
-    @run_async(daemon=True)
     def track(self, t_angle, track_event):
-        """Starts the K-Mirror tracking loop.
+        """Starts derotating the field (see Derotator) and returns at once.
+        Tracking runs until track_event is set or stop is called.
             
         Arguments:
             t_angle -- A user defined value specific to the tracking target.
@@ -221,15 +253,60 @@ class KMirror(InstrumentComponent):
             InstrumentError
         
         Returns:
-            None
+            The running Derotator -> Derotator
         """
-        try:
-            np.NewportKmirrorTracking(self, self.controller, self.sockets[0],
-                                      self.motor, t_angle, track_event)        
-        except InstrumentError as e:
-            raise InstrumentError('An error occured during a stop sequence of'
-                                  ' the K-Mirror.\n The following '
-                                  ' error was raised...\n %s' % repr(e))
+        if self.derotator is not None and self.derotator.running:
+            self.derotator.stop()
+        self.derotator = Derotator(self, t_angle, track_event)
+        self.derotator.start()
+        return self.derotator
+
+    @logCall(msg='Tracking KMirror with discrete moves')
+    def trackDiscrete(self, t_angle, track_event):
+        """Starts derotating the field with absolute moves outside a
+        deadband (see DiscreteTracker) and returns at once. Tracking runs
+        until track_event is set or stop is called.
+
+        Arguments:
+            t_angle -- A user defined value specific to the tracking target.
+            track_event --- threading.Event object to signal when tracking
+                            is finished.
+
+        Raises:
+            InstrumentError
+
+        Returns:
+            The running DiscreteTracker -> DiscreteTracker
+        """
+        if self.derotator is not None and self.derotator.running:
+            self.derotator.stop()
+        self.derotator = DiscreteTracker(self, t_angle, track_event)
+        self.derotator.start()
+        return self.derotator
+
+    @logCall(msg='Tracking KMirror with PVT trajectories')
+    def trackPVT(self, t_angle, track_event):
+        """Starts derotating the field with trajectories planned ahead and
+        run by the controller (see PVTDerotator), and returns at once.
+        Tracking runs until track_event is set or stop is called.
+
+        Arguments:
+            t_angle -- A user defined value specific to the tracking target.
+            track_event --- threading.Event object to signal when tracking
+                            is finished.
+
+        Raises:
+            InstrumentError
+
+        Returns:
+            The running PVTDerotator -> PVTDerotator
+        """
+        if self.derotator is not None and self.derotator.running:
+            self.derotator.stop()
+        self.derotator = PVTDerotator(self, t_angle, track_event)
+        self.derotator.start()
+        return self.derotator
+
     @logCall(msg='Updating KMirror velocity.')
     def updateVelocity(self, vel):
         """Moves the KMirror at a set velocity.
@@ -244,9 +321,10 @@ class KMirror(InstrumentComponent):
             None
         """
         try:
-            with self.lock:
-                np.NewportKmirrorRotate(self.controller, self.sockets[0], 
-                                   self.motor, vel)
+            self.dispatch.move(
+                lambda socket: np.NewportKmirrorRotate(self.controller,
+                                                       socket, self.motor,
+                                                       vel))
         except InstrumentError as e:
             raise InstrumentError('An error occured during a velocity set of'
                                   ' the K-Mirror. \n The following '
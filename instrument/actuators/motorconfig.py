@@ -0,0 +1,228 @@
+"""
+.. module:: motorconfig
+   :platform: Unix
+   :synopsis: Motor sections of nessisettings.ini, validated and compiled once.
+
+"""
+
+import collections
+import logging
+import os
+import threading
+import time
+
+from configobj import ConfigObj
+
+import gpio
+from instrument.component import InstrumentError
+
+
+class Tracking(collections.namedtuple('Tracking', 'rate kp ki max_speed'
+                                      ' pointing_period discrete_period'
+                                      ' discrete_deadband discrete_interval'
+                                      ' pvt_duration pvt_step pvt_ramp'
+                                      ' pvt_lead')):
+    """Derotation settings of a motor section, only used by the k-mirror.
+    A motor that does not track gets the defaults.
+
+    Attributes:
+        rate, kp, ki, max_speed -- track rate, track kp, track ki and
+                        track max speed, see derotator.Derotator.
+        pointing_period -- pointing period.
+        discrete_period, discrete_deadband, discrete_interval -- See
+                        derotator.DiscreteTracker.
+        pvt_duration, pvt_step, pvt_ramp, pvt_lead -- See pvt.PVTDerotator.
+    """
+    __slots__ = ()
+
+
+class Motor(collections.namedtuple('Motor', 'motor name kind group positioner'
+                                   ' direction slots reverse_gap backlash'
+                                   ' search_margin switch_depth home position'
+                                   ' lower upper tracking')):
+    """One motor section, converted and checked.
+
+    Attributes:
+        motor        -- nessisettings.ini section, e.g. mask.
+        name         -- Display name.
+        kind         -- type of the section, None if not given.
+        group        -- XPS group.
+        positioner   -- XPS positioner.
+        direction    -- +-1.
+        slots        -- Number of wheel slots, None for other motors.
+        reverse_gap  -- Wheel reverse gap, None if the wheel only moves
+                        forward.
+        backlash     -- Wheel backlash.
+        search_margin, switch_depth -- Direct wheel move settings.
+        home, position, lower, upper -- gpio.Switch, None if not wired.
+        tracking     -- Tracking.
+    """
+    __slots__ = ()
+
+
+def compile_motor(motor, section):
+    """Build the Motor of a section of nessisettings.ini.
+
+    Raises:
+        InstrumentError if a setting is missing or invalid.
+    """
+    def get(key, convert, default=None):
+        if key not in section:
+            if default is KeyError:
+                raise InstrumentError('[%s] %s is missing!' % (motor, key))
+            return default
+        try:
+            return convert(section[key])
+        except (TypeError, ValueError, KeyError) as e:
+            raise InstrumentError('[%s] %s is invalid: %s' % (motor, key, e))
+
+    def switch(name):
+        return get(name, lambda sub: gpio.switch(motor, name, sub['bit'],
+                                                 sub['val']))
+
+    direction = get('direction', int, 1)
+    if direction not in (-1, 1):
+        raise InstrumentError('[%s] direction must be 1 or -1!' % motor)
+    slots = get('slots', int)
+    if slots is not None and slots < 1:
+        raise InstrumentError('[%s] slots must be positive!' % motor)
+    tracking = Tracking(rate              = get('track rate', float, 10.0),
+                        kp                = get('track kp', float, 0.5),
+                        ki                = get('track ki', float, 0.05),
+                        max_speed         = get('track max speed', float, 2.0),
+                        pointing_period   = get('pointing period', float, 1.0),
+                        discrete_period   = get('discrete period', float, 1.0),
+                        discrete_deadband = get('discrete deadband', float,
+                                                0.01),
+                        discrete_interval = get('discrete interval', float,
+                                                5.0),
+                        pvt_duration      = get('pvt duration', float, 600.0),
+                        pvt_step          = get('pvt step', float, 1.0),
+                        pvt_ramp          = get('pvt ramp', float, 1.0),
+                        pvt_lead          = get('pvt lead', float, 5.0))
+    return Motor(motor         = motor,
+                 name          = get('name', str, motor),
+                 kind          = get('type', str),
+                 group         = get('group', str, KeyError),
+                 positioner    = get('positioner', str),
+                 direction     = direction,
+                 slots         = slots,
+                 reverse_gap   = get('reverse gap', float),
+                 backlash      = get('backlash', float, 0.0),
+                 search_margin = get('search margin', float, 20.0),
+                 switch_depth  = get('switch depth', float, 0.0),
+                 home          = switch('home'),
+                 position      = switch('position'),
+                 lower         = switch('lower'),
+                 upper         = switch('upper'),
+                 tracking      = tracking)
+
+
+def compile_motors(cfg):
+    """Every motor section, the sections with a group, of nessisettings.ini.
+
+    Returns:
+        {motor: Motor}
+    """
+    return dict((motor, compile_motor(motor, cfg[motor]))
+                for motor in cfg.sections if 'group' in cfg[motor])
+
+
+class Settings(object):
+    """nessisettings.ini, shared by the whole process, see load.
+
+    cfg is the ConfigObj every module reads; motors holds the compiled
+    motor sections for the hot paths. reload() re-reads the file when it
+    changed: the new file is compiled first, and only a valid file replaces
+    the settings. cfg is updated in place, section by section, so the
+    modules holding it see the new values; motors is replaced as a whole.
+
+    Attributes:
+        path   -- Settings file.
+        cfg    -- ConfigObj of the file.
+        motors -- {motor: Motor} of the file.
+    """
+
+    def __init__(self, path):
+        """Read and compile the settings.
+
+        Raises:
+            InstrumentError
+        """
+        self.path    = path
+        self._stamp  = self._modified()
+        self.cfg     = ConfigObj(infile=path)
+        self.motors  = compile_motors(self.cfg)
+        self._lock   = threading.Lock()
+        self._watch  = None
+
+    def __getitem__(self, motor):
+        return self.motors[motor]
+
+    def _modified(self):
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def reload(self, force=False):
+        """Re-read the file if it changed since it was read.
+
+        Raises:
+            InstrumentError if the new file is invalid, the settings are
+            then left as they were.
+
+        Returns:
+            True if the settings were reloaded.
+        """
+        with self._lock:
+            stamp = self._modified()
+            if not force and stamp == self._stamp:
+                return False
+            self._stamp = stamp
+            fresh  = ConfigObj(infile=self.path)
+            motors = compile_motors(fresh)
+            for key in fresh:
+                self.cfg[key] = fresh[key]
+            for key in [key for key in self.cfg if key not in fresh]:
+                del self.cfg[key]
+            self.motors = motors
+        logging.info('Reloaded %s.' % self.path)
+        return True
+
+    def watch(self, period):
+        """Reload the file whenever it changes, checking every period
+        seconds. Only the first call starts watching.
+        """
+        if self._watch is not None or period <= 0:
+            return
+        self._watch = threading.Thread(name='SettingsWatch',
+                                       target=self._run, args=(period,))
+        self._watch.daemon = True
+        self._watch.start()
+
+    def _run(self, period):
+        while True:
+            time.sleep(period)
+            try:
+                self.reload()
+            except Exception as e:
+                logging.error('Unable to reload %s: %s' % (self.path, e))
+
+
+#Settings of every file loaded, by absolute path
+_loaded      = {}
+_loaded_lock = threading.Lock()
+
+
+def load(path='nessisettings.ini'):
+    """Settings of a file, read once per process.
+
+    Raises:
+        InstrumentError
+    """
+    key = os.path.abspath(path)
+    with _loaded_lock:
+        if key not in _loaded:
+            _loaded[key] = Settings(path)
+        return _loaded[key]
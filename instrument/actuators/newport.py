@@ -2,6 +2,7 @@
 
 from configobj import ConfigObj
 import math
+import os
 import time
 from time import clock
 import threading
@@ -9,12 +10,45 @@ import logging
 from wx.lib.pubsub import Publisher
 
 import XPS_C8_drivers as xps
+import motorconfig
 from threadtools import run_async, timeout, TimeoutError
 from instrument.component import InstrumentError
 
 
-cfg = ConfigObj(infile="nessisettings.ini")
-fpa_limit_flag = threading.Event()
+# Process-wide nessisettings.ini, see motorconfig.  settings[motor] is the 
+# compiled Motor of a section, read by the motion functions.
+settings = motorconfig.load("nessisettings.ini")
+cfg = settings.cfg
+
+# Controller side twin of the wheel algorithms, see tcl/nessiwheel.tcl.
+WHEEL_SCRIPT = "nessiwheel.tcl"
+# Whether WHEEL_SCRIPT is installed, per controller instance.
+wheel_script_ready = {}
+
+# Shared GPIOSampler of each controller instance, see NewportSwitchWord.
+gpio_samplers = {}
+
+# Encoder position of every slot switch, relative to the home slot, per wheel.
+# Written by NewportWheelCalibrate, see NewportWheelDirect.
+calibration = ConfigObj(infile=cfg["general"].get("wheel calibration", 
+                                                   "autosave/wheelcal.ini"))
+calibration_lock = threading.Lock()
+# Encoder position of the home slot switch of each wheel, as found by a forward
+# search.  It is learnt by every move ending on such a search, see 
+# NewportWheelAnchor, and lost by NewportInitialize, which resets the encoder.
+wheel_reference = {}
+
+# Slot each dewar wheel was left at, kept across restarts, see NewportWheelSave.
+wheel_state = ConfigObj(infile=cfg["general"].get("wheel positions", 
+                                                  "autosave/wheels.ini"))
+wheel_state_lock = threading.Lock()
+
+# Motion settings last sent to the controller, per motor, so they are not sent
+# again while unchanged: the SGamma profile of the positioner and whether jog 
+# mode is on.  A motor missing from a dict is in an unknown state.  They are 
+# forgotten by NewportInitialize and NewportKill.
+motion_profile = {}
+jog_mode = {}
 
 def XPSErrorHandler(controller, socket, code, name):
     """This is a general error handling function for the newport controller 
@@ -59,27 +93,250 @@ def XPSErrorHandler(controller, socket, code, name):
     
         fatality = True
         if code == -2:
-            errstr = name + " : TCP timeout"
+            errstr = name + " : TCP timeout or lost connection. The socket" + \
+                            " reconnects by itself but the command was not" + \
+                            " retried; check the motor state"
         elif code == -108:
             errstr = name + " : The TCP/IP connection was closed by an" + \
                             "administrator"
         
     raise InstrumentError(errstr)
 
+def NewportSwitchWord(controller, socket, since=None):
+    """This function returns the GPIO4.DI word holding every switch.  When a 
+    GPIOSampler is registered for the controller in gpio_samplers the word 
+    comes from its next sample, shared with every other switch check, instead
+    of a GPIODigitalGet of our own.
+
+        Arguments: controller, socket, since.
+
+            controller: [xps]   Which instance of the XPS controller to use.
+            socket:     [int]   Which socket to use to communicate with the XPS 
+                                controller.
+            since:      [float] time.time() the word must be read after.  
+                                Defaults to now.
+
+        Returns: word.
+
+            word:       [int]   The GPIO4.DI word.
+
+        Raises: InstrumentError.
+    """
+    sampler = gpio_samplers.get(controller)
+    if sampler is not None:
+        return sampler.read(time.time() if since is None else since)
+    value = controller.GPIODigitalGet(socket, "GPIO4.DI")
+    if value[0] != 0:
+        XPSErrorHandler(controller, socket, value[0], "GPIODigitalGet")
+    return value[1]
+
+
+def NewportMotor(motor):
+    """Returns the Motor of a section of nessisettings.ini, given its name or 
+    the Motor itself.  Every motion function takes either and reads it once 
+    per call, handing it down to the functions it calls, so a reload of the 
+    settings can not change them in the middle of a move and the hot paths 
+    (e.g. the derotator loop) use attributes instead of ConfigObj lookups.
+    """
+    if isinstance(motor, motorconfig.Motor):
+        return motor
+    return settings[motor]
+
+
+def NewportSwitchIs(controller, socket, motor, name):
+    """Returns whether a switch of nessisettings.ini, e.g. the home switch of
+    the mask wheel, reads its configured value.  motor is the section name or
+    its Motor.  See NewportSwitchWord.
+    """
+    return getattr(NewportMotor(motor), name).test(NewportSwitchWord(
+                                                       controller, socket))
+
+
+def NewportSwitchWait(controller, socket, switch, timeout=None, 
+                      stop_event=None):
+    """This function blocks until a GPIO4.DI switch reaches its value.  
+    Instead of polling GPIODigitalGet the controller is given an extended 
+    event on the switch edge and the socket blocks on EventExtendedWait, so 
+    the return happens within a servo cycle (plus one network trip) of the 
+    switch flipping.  That wait can not be interrupted and has no Timeout, 
+    so with a timeout or a stop event the switch is polled instead, through
+    NewportSwitchWord.
+
+        Arguments: controller, socket, switch, timeout, stop_event.
+
+            controller: [xps]   Which instance of the XPS controller to use.
+            socket:     [int]   Which socket to use to communicate with the XPS 
+                                controller.  It is blocked while waiting.
+            switch:     [Switch] The switch, from settings.
+            timeout:    [float] Seconds to wait, None waits forever.
+            stop_event: [Event] Ends the wait when set.
+
+        Returns: None.
+
+        Raises: InstrumentError.
+
+            InstrumentError:    Also raised when the timeout expires or the 
+                                stop event is set.
+    """
+    if timeout is not None or stop_event is not None:
+        deadline = None if timeout is None else time.time() + timeout
+        while not switch.test(NewportSwitchWord(controller, socket)):
+            if stop_event is not None and stop_event.is_set():
+                raise InstrumentError("Stopped while waiting for the %s %s"
+                                      " switch." % (switch.motor, switch.name))
+            if deadline is not None and time.time() > deadline:
+                raise InstrumentError("The %s %s switch was not reached"
+                                      " within %s s." % (switch.motor, 
+                                                         switch.name, timeout))
+            # A GPIOSampler paces the loop by itself.
+            if controller not in gpio_samplers:
+                time.sleep(0.02)
+        return
+
+    # The edge event is configured before the switch is read, so a flip 
+    # between the two calls can not be missed.
+    trigger = controller.EventExtendedConfigurationTriggerSet(socket,
+                                  [NewportSwitchEvent(switch)], [switch.bit], 
+                                  [0], [0], [0])
+    if trigger[0] != 0:
+        XPSErrorHandler(controller, socket, trigger[0],
+                        "EventExtendedConfigurationTriggerSet")
+
+    if switch.test(NewportSwitchWord(controller, socket)):
+        return
+
+    wait = controller.EventExtendedWait(socket)
+    if wait[0] != 0:
+        XPSErrorHandler(controller, socket, wait[0], "EventExtendedWait")
+
+
+def NewportSwitchAbort(controller, socket, group, switch):
+    """This function arms the controller to abort the motion of a group by 
+    itself as soon as a GPIO4.DI switch reaches a value.  The motion command 
+    of the group then returns the error -27 (motion aborted).  The event stays
+    armed until it is removed with EventExtendedRemove.
+
+        Arguments: controller, socket, group, switch.
+
+            controller: [xps]   Which instance of the XPS controller to use.
+            socket:     [int]   Which socket to use to communicate with the XPS 
+                                controller.
+            group:      [str]   Which group to abort, e.g. G5.
+            switch:     [Switch] The switch that aborts the motion, from 
+                                switches.
+
+        Returns: event.
+
+            event:      [int]   The event ID, for EventExtendedRemove.
+
+        Raises: InstrumentError.
+    """
+    trigger = controller.EventExtendedConfigurationTriggerSet(socket,
+                                  [NewportSwitchEvent(switch)], [switch.bit], 
+                                  [0], [0], [0])
+    if trigger[0] != 0:
+        XPSErrorHandler(controller, socket, trigger[0],
+                        "EventExtendedConfigurationTriggerSet")
+
+    action = controller.EventExtendedConfigurationActionSet(socket,
+                                  [group + ".MoveAbort"], [0], [0], [0], [0])
+    if action[0] != 0:
+        XPSErrorHandler(controller, socket, action[0],
+                        "EventExtendedConfigurationActionSet")
+
+    start = controller.EventExtendedStart(socket)
+    if start[0] != 0:
+        XPSErrorHandler(controller, socket, start[0], "EventExtendedStart")
+    return start[1]
+
+
+def NewportSwitchEvent(switch):
+    """Returns the name of the GPIO4.DI edge event on which a switch reaches 
+    its value.  The bit is passed as the first event parameter.
+    """
+    if switch.on:
+        return "GPIO4.DI.DILowHigh"
+    else:
+        return "GPIO4.DI.DIHighLow"
+
+
+def NewportSpinToSwitch(controller, socket, group, speed, switch):
+    """This function spins a group slowly until a GPIO4.DI switch reaches its
+    value and then stops it.  The switch is watched with NewportSwitchWait.
+
+        Arguments: controller, socket, group, speed, switch.
+
+            controller: [xps]   Which instance of the XPS controller to use.
+            socket:     [int]   Which socket to use to communicate with the XPS 
+                                controller.
+            group:      [str]   Which group to spin.
+            speed:      [int]   Spin velocity (signed).
+            switch:     [Switch] The switch to stop at, from settings.
+
+        Returns: None.
+
+        Raises: InstrumentError.
+    """
+    Gset = controller.GroupSpinParametersSet(socket, group, speed, 800)
+    if Gset[0] != 0:
+        XPSErrorHandler(controller ,socket, Gset[0],
+                        "GroupSpinParametersSet")
+    try:
+        NewportSwitchWait(controller, socket, switch)
+    finally:
+        stop=controller.GroupSpinModeStop(socket, group, 1200)
+    if stop[0] != 0:
+        XPSErrorHandler(controller, socket, stop[0], "GroupSpinModeStop")
+
+
 def NewportWheelHome(controller, wheel, socket):
-    """This function homes a dewar wheel.  This function will call the 
-    XPSErrorHandler function if any of the newport commands fail. Information
-    about the specific homing of the motors is contained in the nessisettings
-    configuration file.  This function does not have a Timeout and can run 
-    indefinitely if there are problems with the switches. 
+    """This function homes a dewar wheel.  The homing runs on the controller 
+    as the WHEEL_SCRIPT TCL script, in a single round trip, when the script is
+    installed and [general] tcl wheels is on.  Otherwise it runs from Python 
+    with NewportWheelHomeSteps.  The time taken by either path is logged.
+
+        Arguments: controller, wheel, socket.
+
+            controller: [xps]   Which instance of the XPS controller to use.
+            wheel:      [str]   The name of the wheel, or its Motor from 
+                                settings.
+            socket:     [int]   Which socket to use to communicate with the XPS 
+                                controller.
+
+        Returns: None.
+
+        Raises: InstrumentError.
+    """
+    motor = NewportMotor(wheel)
+    wheel = motor.motor
+    start = time.time()
+    NewportWheelSave(wheel, None)
+    if NewportWheelScriptReady(controller, socket):
+        # The Python path gives up after 8 slots too.
+        NewportWheelScript(controller, socket, motor, "home", 8)
+        path = "TCL"
+    else:
+        NewportWheelHomeSteps(controller, motor, socket)
+        path = "Python"
+    NewportWheelSave(wheel, 0)
+    logging.info("%s wheel homed (%s) in %.2f s." % (wheel, path, 
+                                                     time.time() - start))
+
+
+def NewportWheelHomeSteps(controller, motor, socket):
+    """This function homes a dewar wheel from Python, one controller command 
+    at a time.  This function will call the XPSErrorHandler function if any 
+    of the newport commands fail. Information about the specific homing of
+    the motors is contained in the nessisettings configuration file.  This
+    function does not have a Timeout and can run indefinitely if there are
+    problems with the switches.
     
-        Arguments: controller, socket, wheel.
+        Arguments: controller, motor, socket.
 
             controller: [xps]   Which instance of the XPS controller to use.
+            motor:      [Motor] The wheel settings, from settings.
             socket:     [int]   Which socket to use to communicate with the XPS 
                                 controller.
-            wheel:      [str]   The name of the function that called this 
-                                function.
 
         Returns: None.
 
@@ -88,54 +345,23 @@ def NewportWheelHome(controller, wheel, socket):
             InstrumentError:    This is raised if the wheel fails to home.
     """
     # Config-file based variables.
-    group     = cfg[wheel]["group"]
-    speed     = int(cfg[wheel]["direction"])*30
-    wheel_gap = int(cfg[wheel]["direction"])*340
-    homeval   = int(cfg[wheel]["home"]["val"])
-    homebit   = int(cfg[wheel]["home"]["bit"])
-    posval    = int(cfg[wheel]["position"]["val"])
-    posbit    = int(cfg[wheel]["position"]["bit"])  
-
-    # Start of the algorithm.  If the wheel is not at a position it goes to one. 
-    value = controller.GPIODigitalGet(socket, "GPIO4.DI")
-
-    # This part of the if statement checks for an error reading the the GPIO.
-    if value[0] != 0:
-        XPSErrorHandler(controller, socket, value[0], "GPIODigitalGet")
-
-    # This portion initiates a slow move forward to find the next position if it
-    # is not already at one.  If it is then it passes to the next part of the 
-    # function.
-    elif int(format(value[1], "016b")[::-1][posbit]) != posval:
-        Gset = controller.GroupSpinParametersSet(socket, group, speed, 800)
-        while True:
-            time.sleep(.1)
-            value = controller.GPIODigitalGet(socket, "GPIO4.DI") 
-            if value[0] != 0:
-                XPSErrorHandler(controller, socket, value[0], 
-                                "GPIODigitalGet")
-            elif int(format(value[1], "016b")[::-1][posbit]) == posval:
-                stop=controller.GroupSpinModeStop(socket, group, 1200)
-                if stop[0] != 0:
-                    XPSErrorHandler(controller, socket, stop[0],
-                                    "GroupSpinModeStop")
-                break
-            else:
-                pass
-    else:
-        pass
+    wheel     = motor.motor
+    group     = motor.group
+    speed     = motor.direction*30
+    wheel_gap = motor.direction*340
+    position  = motor.position
+
+    # Start of the algorithm.  If the wheel is not at a position it goes to one
+    # with a slow move forward.  If it is then it passes to the next part of 
+    # the function.
+    if not NewportSwitchIs(controller, socket, motor, "position"):
+        NewportSpinToSwitch(controller, socket, group, speed, position)
 
     # This section of the function checks to see if the wheel is already homed.
     # If so then the function returns otherwise it begins moving to each 
     # successive position until it finds the home position. 
-    value = controller.GPIODigitalGet(socket, "GPIO4.DI")
-    if value[0] != 0:
-        XPSErrorHandler(controller, socket, value[0], 
-                        "GPIODigitalGet")
-    elif int(format(value[1], "016b")[::-1][homebit]) == homeval:
+    if NewportSwitchIs(controller, socket, motor, "home"):
         return
-    else:
-        pass
 
     # This section controls motion between positions.  First it moves the motor
     # a known distance to be close to the next position, then the motor is moved
@@ -151,47 +377,15 @@ def NewportWheelHome(controller, wheel, socket):
             if GMove[0] != 0:
                 XPSErrorHandler(controller, socket, GMove[0], 
                                 "GroupMoveRelative")
-        # Starting slow motion to the next position.
-        Gset = controller.GroupSpinParametersSet(socket, group, speed, 
-                                                 800)
-        # Checking if the motion command was sent correctly.
-        # If so then the GPIO checking begins.
-        if Gset[0] != 0:
-            XPSErrorHandler(controller ,socket, Gset[0],
-                            "GroupSpinParametersSet")
-        else:
-            # The while loop checks for a position switch to open.
-            while True:
-                time.sleep(.1)
-                value = controller.GPIODigitalGet(socket, "GPIO4.DI")
-                if value[0] != 0:
-                    XPSErrorHandler(controller, socket, value[0],
-                                    "GPIODigitalGet")
-                elif int(format(value[1], "016b")[::-1][posbit]) == posval:
-                    stop=controller.GroupSpinModeStop(socket, group, 1200)
-                    if stop[0] != 0:
-                        XPSErrorHandler(controller, socket, stop[0],
-                                        "GroupSpinModeStop")
-                    break
-                else:
-                    pass
+        # Slow motion to the next position, stopped by its switch.
+        NewportSpinToSwitch(controller, socket, group, speed, position)
         # Once at a position, the home switch is checked to see if it is the 
         # home position.  If so then the function returns, otherwise this 
         # iteration of the loop passes.
-        value = controller.GPIODigitalGet(socket, "GPIO4.DI")
-        if value[0] != 0:
-            XPSErrorHandler(controller, socket, value[0], 
-                            "GPIODigitalGet")
-        elif int(format(value[1], "016b")[::-1][homebit]) == homeval:
+        if NewportSwitchIs(controller, socket, motor, "home"):
             return
-        else:
-            pass
 
-    value = controller.GPIODigitalGet(socket, "GPIO4.DI")
-    if value[0] != 0:
-        XPSErrorHandler(controller, socket, value[0], 
-                            "GPIODigitalGet")
-    elif int(format(value[1], "016b")[::-1][homebit]) == homeval:
+    if NewportSwitchIs(controller, socket, motor, "home"):
         return
     else:
         message = "Error: Homing of " + str(wheel) + \
@@ -200,17 +394,420 @@ def NewportWheelHome(controller, wheel, socket):
 
 
 def NewportWheelMove(controller, wheel, socket, current, position):
-    """This function moves a dewar wheel to a selected position.  Since the 
+    """This function moves a dewar wheel to a selected position.  A calibrated
+    wheel goes straight to the slot with NewportWheelDirect.  Otherwise the 
+    wheel walks the slots the shorter way round: backwards 
+    (NewportWheelBackSteps) when that passes fewer slots and the wheel has a 
+    "reverse gap" in the config file, forwards (NewportWheelMoveSteps) 
+    otherwise.  Like NewportWheelHome the 
+    move runs on the controller as the WHEEL_SCRIPT TCL script when possible.
+    The arrival is checked against the switches with NewportWheelCheck and 
+    the time taken is logged.
+
+        Arguments: controller, name, socket, current, position.
+
+            controller: [xps]   Which instance of the XPS controller to use.
+            wheel:      [str]   The name of the motor that is being used, or 
+                                its Motor from settings.
+            socket:     [int]   Which socket to use to communicate with the XPS 
+                                controller.
+            current:    [int]   What position the motor is currently at.
+            position:   [int]   What position the motor should move to.
+        
+        Returns: position
+            
+            position:   [int]   The position the motor moved to.
+    
+        Raises: InstrumentError.
+    """
+    if current == position:
+        return position
+
+    motor    = NewportMotor(wheel)
+    wheel    = motor.motor
+    slots    = motor.slots
+    forward  = (slots - current + position) % slots
+    backward = slots - forward
+    reverse  = motor.reverse_gap is not None and backward < forward
+
+    start = time.time()
+    NewportWheelSave(wheel, None)
+    if NewportWheelDirect(controller, motor, socket, position):
+        path = "direct"
+    elif NewportWheelScriptReady(controller, socket):
+        if reverse:
+            NewportWheelScript(controller, socket, motor, "back", backward)
+        else:
+            NewportWheelScript(controller, socket, motor, "move", forward)
+        path = "TCL"
+    else:
+        if reverse:
+            NewportWheelBackSteps(controller, motor, socket, backward)
+        else:
+            NewportWheelMoveSteps(controller, motor, socket, current, 
+                                  position)
+        path = "Python"
+    NewportWheelCheck(controller, socket, motor, position)
+    if path != "direct":
+        NewportWheelAnchor(controller, socket, motor, position)
+        path = ("backward, " if reverse else "forward, ") + path
+    NewportWheelSave(wheel, position)
+    logging.info("%s wheel moved %d -> %d (%s) in %.2f s." 
+                 % (wheel, current, position, path, time.time() - start))
+    return position
+
+
+def NewportWheelDirect(controller, motor, socket, position):
+    """This function moves a calibrated dewar wheel straight to a slot with a 
+    single GroupMoveAbsolute to the encoder position recorded for it by 
+    NewportWheelCalibrate, taking the nearest turn of the wheel.  The target
+    is "switch depth" past the recorded position, which is where a forward 
+    search stops, on the edge of the switch.  The arrival is checked against 
+    the switches.  If they disagree the wheel is backed off by "search 
+    margin" and the slot switch is searched slowly forwards.  Nothing is done
+    for a wheel without a calibration, or which has not stopped on a slot 
+    since the last NewportInitialize.
+
+        Arguments: controller, motor, socket, position.
+
+            controller: [xps]   Which instance of the XPS controller to use.
+            motor:      [Motor] The wheel settings, from settings.
+            socket:     [int]   Which socket to use to communicate with the XPS 
+                                controller.
+            position:   [int]   What position the wheel should move to.
+
+        Returns: moved
+
+            moved:      [bool]  Whether the wheel was moved.
+
+        Raises: InstrumentError.
+    """
+    wheel = motor.motor
+    # One read, a concurrent NewportWheelCalibrationSave replaces the section.
+    section = calibration.get(wheel)
+    if section is None or wheel not in wheel_reference:
+        return False
+    offsets    = [float(offset) for offset in section["offsets"]]
+    revolution = float(section["revolution"])
+    group      = motor.group
+    direction  = motor.direction
+
+    target = wheel_reference[wheel] + offsets[position] + \
+             direction*motor.switch_depth
+    here   = NewportWheelEncoder(controller, socket, motor)
+    target = target + revolution * round((here - target) / revolution)
+    GMove = controller.GroupMoveAbsolute(socket, group, [target])
+    if GMove[0] != 0:
+        XPSErrorHandler(controller, socket, GMove[0], "GroupMoveAbsolute")
+    if NewportWheelAt(controller, socket, motor, position):
+        return True
+
+    logging.warning("%s wheel missed slot %d at %.2f, searching for it." 
+                    % (wheel, position, target))
+    margin = direction*motor.search_margin
+    GMove = controller.GroupMoveAbsolute(socket, group, [target - margin])
+    if GMove[0] != 0:
+        XPSErrorHandler(controller, socket, GMove[0], "GroupMoveAbsolute")
+    NewportSpinToSwitch(controller, socket, group, direction*30, 
+                        motor.position)
+    NewportWheelAnchor(controller, socket, motor, position)
+    return True
+
+
+def NewportWheelCalibrate(controller, wheel, socket):
+    """This function homes a dewar wheel, walks it forwards once round from 
+    slot 1 and records the encoder position of every slot switch, relative to
+    the home slot, in the wheel calibration file ([general] wheel 
+    calibration).  The positions are all taken where a forward search stops, 
+    as NewportWheelDirect needs.  The wheel then goes straight back home.
+
+        Arguments: controller, wheel, socket.
+
+            controller: [xps]   Which instance of the XPS controller to use.
+            wheel:      [str]   The name of the wheel, or its Motor from 
+                                settings.
+            socket:     [int]   Which socket to use to communicate with the XPS 
+                                controller.
+
+        Returns: offsets
+
+            offsets:    [list]  Encoder position of each slot, forwards from
+                                the home slot.
+
+        Raises: InstrumentError.
+
+            InstrumentError:    This is raised if the wheel is not back home
+                                after its number of slots.
+    """
+    motor = NewportMotor(wheel)
+    wheel = motor.motor
+    slots = motor.slots
+    NewportWheelHome(controller, motor, socket)
+    NewportWheelSave(wheel, None)
+    # positions[slot] for slots 1 .. slots, then slot 1 again.
+    positions = [None]
+    for slot in range(slots + 1):
+        NewportWheelMoveSteps(controller, motor, socket, slot % slots, 
+                              (slot + 1) % slots)
+        positions.append(NewportWheelEncoder(controller, socket, motor))
+        if NewportSwitchIs(controller, socket, motor, "home") != \
+           ((slot + 1) % slots == 0):
+            raise InstrumentError(wheel + " wheel home switch found at the"
+                                  " wrong slot, check its slots setting.")
+
+    home       = positions[slots]
+    revolution = positions[slots + 1] - positions[1]
+    offsets    = [0.0] + [positions[slot] - home + revolution 
+                          for slot in range(1, slots)]
+    NewportWheelCalibrationSave(wheel, offsets, revolution)
+    wheel_reference[wheel] = home + revolution
+    NewportWheelDirect(controller, motor, socket, 0)
+    NewportWheelCheck(controller, socket, motor, 0)
+    NewportWheelSave(wheel, 0)
+    logging.info("%s wheel calibrated, %.2f per turn, slots at %s." 
+                 % (wheel, revolution, 
+                    ", ".join("%.2f" % offset for offset in offsets)))
+    return offsets
+
+
+def NewportWheelCalibrationSave(wheel, offsets, revolution):
+    """This function records the calibration of a dewar wheel and saves the 
+    wheel calibration file ([general] wheel calibration).  The file is 
+    replaced atomically, like in NewportWheelSave, so wheels calibrated 
+    concurrently or a crash mid-write can not leave it truncated.  A failed 
+    write is only logged, the calibration is still used until the next run.
+
+        Arguments: wheel, offsets, revolution.
+
+            wheel:      [str]   The name of the wheel.  This is for config 
+                                file purposes.
+            offsets:    [list]  Encoder position of each slot, forwards from
+                                the home slot.
+            revolution: [float] Encoder travel of one turn of the wheel.
+
+        Returns: None.
+
+        Raises: None.
+    """
+    with calibration_lock:
+        calibration[wheel] = {"offsets": offsets, "revolution": revolution}
+        temporary = calibration.filename + ".tmp"
+        try:
+            with open(temporary, "w") as outfile:
+                calibration.write(outfile)
+            os.rename(temporary, calibration.filename)
+        except (IOError, OSError) as e:
+            logging.warning("Unable to save the %s wheel calibration: %s" 
+                            % (wheel, e))
+
+
+def NewportWheelStart(controller, wheel, socket, home_pos):
+    """This function readies a dewar wheel at start-up without turning it when
+    possible.  A group that is still ready from the last run is not 
+    initialized again, otherwise NewportInitialize runs.  The slot saved by 
+    NewportWheelSave is then trusted if the switches agree with it (see 
+    NewportWheelAt).  Only on a mismatch, or without a saved slot, is the 
+    wheel homed with NewportWheelHome.  The time taken is logged.
+
+        Arguments: controller, wheel, socket, home_pos.
+
+            controller: [xps]   Which instance of the XPS controller to use.
+            wheel:      [str]   The name of the wheel, or its Motor from 
+                                settings.
+            socket:     [int]   Which socket to use to communicate with the XPS 
+                                controller.
+            home_pos:   [int]   Passed to NewportInitialize.
+
+        Returns: position
+
+            position:   [int]   The slot the wheel stands at.
+
+        Raises: InstrumentError.
+    """
+    motor  = NewportMotor(wheel)
+    wheel  = motor.motor
+    start  = time.time()
+    status = controller.GroupStatusGet(socket, motor.group)
+    # XPS group states 10 to 18 are the READY states.
+    ready  = status[0] == 0 and 10 <= status[1] <= 18
+    if not ready:
+        NewportInitialize(controller, wheel, socket, home_pos)
+
+    state = wheel_state.get(wheel, {})
+    if "slot" in state and \
+       NewportWheelAt(controller, socket, motor, int(state["slot"])):
+        position = int(state["slot"])
+        # The encoder was not reset, the slots are where they were.
+        if ready and "reference" in state:
+            wheel_reference[wheel] = float(state["reference"])
+        how = "warm"
+    else:
+        if "slot" in state:
+            logging.warning("%s wheel switches disagree with its saved slot"
+                            " %s, homing it." % (wheel, state["slot"]))
+        NewportWheelHome(controller, motor, socket)
+        position = 0
+        how = "homed"
+    logging.info("%s wheel ready at %d (%s) in %.2f s." 
+                 % (wheel, position, how, time.time() - start))
+    return position
+
+
+def NewportWheelSave(wheel, position):
+    """This function saves the slot a dewar wheel stands at, with its home 
+    slot encoder position if known, to the wheel positions file ([general] 
+    wheel positions) for NewportWheelStart.  The file is replaced atomically.
+    A position of None marks the wheel as moving, so that a run stopped 
+    mid-move homes it at the next start-up.  A failed write is only logged.
+
+        Arguments: wheel, position.
+
+            wheel:      [str]   The name of the wheel.  This is for config 
+                                file purposes.
+            position:   [int]   The slot the wheel stands at, or None.
+
+        Returns: None.
+
+        Raises: None.
+    """
+    state = {}
+    if position is not None:
+        state["slot"] = position
+        if wheel in wheel_reference:
+            state["reference"] = wheel_reference[wheel]
+    with wheel_state_lock:
+        wheel_state[wheel] = state
+        temporary = wheel_state.filename + ".tmp"
+        try:
+            with open(temporary, "w") as outfile:
+                wheel_state.write(outfile)
+            os.rename(temporary, wheel_state.filename)
+        except (IOError, OSError) as e:
+            logging.warning("Unable to save the %s wheel position: %s" 
+                            % (wheel, e))
+
+
+def NewportWheelAnchor(controller, socket, motor, position):
+    """Learns the home slot encoder position of a calibrated dewar wheel (its
+    Motor) that a forward search just stopped on a slot.
+    """
+    wheel = motor.motor
+    if wheel in calibration:
+        wheel_reference[wheel] = NewportWheelEncoder(controller, socket, 
+                                                     motor) - \
+            float(calibration[wheel]["offsets"][position])
+
+
+def NewportWheelEncoder(controller, socket, motor):
+    """Returns the encoder position of a dewar wheel, given its Motor."""
+    GPosition = controller.GroupPositionCurrentGet(socket, motor.group, 1)
+    if GPosition[0] != 0:
+        XPSErrorHandler(controller, socket, GPosition[0], 
+                        "GroupPositionCurrentGet")
+    return GPosition[1]
+
+
+def NewportWheelAt(controller, socket, motor, position):
+    """Returns whether a dewar wheel (its Motor) stands on a position switch,
+    and on the home switch exactly when position is 0.
+    """
+    word = NewportSwitchWord(controller, socket)
+    return (motor.position.test(word) and
+            motor.home.test(word) == (position == 0))
+
+
+def NewportWheelCheck(controller, socket, motor, position):
+    """This function checks that a dewar wheel stands where it should, see 
+    NewportWheelAt.
+
+        Arguments: controller, socket, motor, position.
+
+            controller: [xps]   Which instance of the XPS controller to use.
+            socket:     [int]   Which socket to use to communicate with the XPS 
+                                controller.
+            motor:      [Motor] The wheel settings, from settings.
+            position:   [int]   The position the wheel should be at.
+
+        Returns: None.
+
+        Raises: InstrumentError.
+
+            InstrumentError:    This is raised if the switches disagree.
+    """
+    if not NewportWheelAt(controller, socket, motor, position):
+        raise InstrumentError(motor.motor + " wheel switches disagree with"
+                              " position " + str(position) + ", it may now be"
+                              " out of sync.  Home wheel and try again.")
+
+
+def NewportWheelScriptReady(controller, socket):
+    """Returns whether the wheel algorithms can run on the controller: [general]
+    tcl wheels is on and WHEEL_SCRIPT answers a probe.  The probe runs once 
+    per controller.
+    """
+    general = cfg.get("general", {})
+    if str(general.get("tcl wheels", "False")).lower() not in ("true", "1", 
+                                                                "yes", "on"):
+        return False
+    if controller not in wheel_script_ready:
+        probe = controller.TCLScriptExecuteAndWait(socket, WHEEL_SCRIPT,
+                                                   "nessiprobe", "probe")
+        wheel_script_ready[controller] = probe[0] == 0
+        if probe[0] != 0:
+            logging.warning("%s is not installed on the controller (error %d),"
+                            " the wheels are moved from Python." 
+                            % (WHEEL_SCRIPT, probe[0]))
+    return wheel_script_ready[controller]
+
+
+def NewportWheelScript(controller, socket, motor, mode, count):
+    """This function runs WHEEL_SCRIPT on the controller and waits for it to 
+    end.  Only the group, the switch masks and the slot count are sent.
+
+        Arguments: controller, socket, motor, mode, count.
+
+            controller: [xps]   Which instance of the XPS controller to use.
+            socket:     [int]   Which socket to use to communicate with the XPS 
+                                controller.
+            motor:      [Motor] The wheel settings, from settings.
+            mode:       [str]   "home", "move" or "back".
+            count:      [int]   Most slots to walk looking for home ("home"), 
+                                or slots to walk forwards ("move") or 
+                                backwards ("back").
+
+        Returns: None.
+
+        Raises: InstrumentError.
+    """
+    group     = motor.group
+    direction = motor.direction
+    if mode == "back":
+        gap  = -direction*motor.reverse_gap
+        lash = -direction*motor.backlash
+    else:
+        gap, lash = direction*340, 0
+    arguments = [mode, group, direction*30, gap,
+                 motor.position.mask, int(bool(motor.position.on)),
+                 motor.home.mask, int(bool(motor.home.on)), count, lash]
+    run = controller.TCLScriptExecuteAndWait(socket, WHEEL_SCRIPT, 
+                                             "nessi" + group,
+                                             ",".join(map(str, arguments)))
+    if run[0] != 0:
+        XPSErrorHandler(controller, socket, run[0], "TCLScriptExecuteAndWait")
+
+
+def NewportWheelMoveSteps(controller, motor, socket, current, position):
+    """This function moves a dewar wheel to a selected position from Python, 
+    one controller command at a time.  Since the 
     positions are identical this is done by moving a determined number of 
     positions from the current (known) position.  If the position is not known
     then the wheel should be homed first.  This function does not have a
     Timeout and can run indefinitely if there are problems with the switches.
 
-        Arguments: controller, name, socket, current, position.
+        Arguments: controller, motor, socket, current, position.
 
             controller: [xps]   Which instance of the XPS controller to use.
-            wheel:      [str]   The name of the motor that is being used.  
-                                This is for config file purposes.
+            motor:      [Motor] The wheel settings, from settings.
             socket:     [int]   Which socket to use to communicate with the XPS 
                                 controller.
             current:    [int]   What position the motor is currently at.
@@ -224,14 +821,13 @@ def NewportWheelMove(controller, wheel, socket, current, position):
         Raises: None
     """
     # Initializing config-file specific variables.
-    group     = cfg[wheel]["group"]
-    speed     = int(cfg[wheel]["direction"])*30
-    wheel_gap = int(cfg[wheel]["direction"])*340
-    val       = int(cfg[wheel]["position"]["val"])
-    bit       = int(cfg[wheel]["position"]["bit"])
+    wheel     = motor.motor
+    group     = motor.group
+    speed     = motor.direction*30
+    wheel_gap = motor.direction*340
+    switch    = motor.position
     # diff is how many positions away from current the target position is.
-    diff      = (int(cfg[wheel]["slots"]) - current + position) % \
-                int(cfg[wheel]["slots"])
+    diff      = (motor.slots - current + position) % motor.slots
 
     # First there is a check to see if the motor is already at the current 
     # position. This check is only a check of inputs.  It does not check to see
@@ -244,30 +840,10 @@ def NewportWheelMove(controller, wheel, socket, current, position):
         # moves forward slowly until it finds a switch and sets the movement 
         # counter down by one.  This is because it is a known error that the 
         # motor can detect a switch being flipped but not stop in time.
-        value = controller.GPIODigitalGet(socket, "GPIO4.DI")
-        if value[0] != 0:
-            XPSErrorHandler(controller, socket, value[0], "GPIODigitalGet")
-        elif int(format(value[1], "016b")[::-1][bit]) != val:
+        if not NewportSwitchIs(controller, socket, motor, "position"):
             logging.info("Slow motion due to previous switch passed.")
-            Gset = controller.GroupSpinParametersSet(socket, group, speed,
-                                                     800)
-            while True:
-                time.sleep(.1)
-                value = controller.GPIODigitalGet(socket, "GPIO4.DI")
-                if value[0] != 0:
-                    XPSErrorHandler(controller, socket, value[0], 
-                                    "GPIODigitalGet")
-                elif int(format(value[1], "016b")[::-1][bit]) == val:
-                    stop=controller.GroupSpinModeStop(socket, group, 1200)
-                    if stop[0] != 0:
-                        XPSErrorHandler(controller, socket, stop[0],
-                                        "GroupSpinModeStop")
-                    diff = diff - 1
-                    break
-                else:
-                    pass
-        else:
-            pass
+            NewportSpinToSwitch(controller, socket, group, speed, switch)
+            diff = diff - 1
 
         # This loop moves the wheel forward one position each iteration and runs
         # until it reaches the specified position.
@@ -289,7 +865,7 @@ def NewportWheelMove(controller, wheel, socket, current, position):
             else:
                 logging.info("Slow due to position search.")
                 try:
-                    wheelcheck(controller, socket, bit, val, group)
+                    wheelcheck(controller, socket, switch, group)
                 except TimeoutError:
                     stop=controller.GroupSpinModeStop(socket, group, 1200)
                     if stop[0] != 0:
@@ -305,31 +881,60 @@ def NewportWheelMove(controller, wheel, socket, current, position):
         return position
                 
 
+def NewportWheelBackSteps(controller, motor, socket, count):
+    """This function moves a dewar wheel backwards by count slots from Python,
+    one controller command at a time.  Each slot is passed with two quick 
+    relative moves of "reverse gap" backwards, which overshoot the slot, and 
+    its switch is then searched forwards.  The switch is thus always reached 
+    from the same side as in forward moves, and the wheel stops at the same 
+    place.  The first quick move of each slot is lengthened by "backlash", 
+    taken up by the reversal of the motion.  This function does not have a
+    Timeout and can run indefinitely if there are problems with the switches.
+
+        Arguments: controller, motor, socket, count.
+
+            controller: [xps]   Which instance of the XPS controller to use.
+            motor:      [Motor] The wheel settings, from settings.
+            socket:     [int]   Which socket to use to communicate with the XPS 
+                                controller.
+            count:      [int]   How many slots to move backwards.
+
+        Returns: None.
+
+        Raises: InstrumentError.
+    """
+    group     = motor.group
+    direction = motor.direction
+    speed     = direction*30
+    gap       = -direction*motor.reverse_gap
+    lash      = -direction*motor.backlash
+    switch    = motor.position
+
+    # A wheel that passed its switch is first brought forwards onto the next 
+    # slot, which is one more slot to walk back.
+    if not NewportSwitchIs(controller, socket, motor, "position"):
+        logging.info("Slow motion due to previous switch passed.")
+        NewportSpinToSwitch(controller, socket, group, speed, switch)
+        count = count + 1
+
+    for i in range(count):
+        for move in (gap + lash, gap):
+            GMove = controller.GroupMoveRelative(socket, group, [move])
+            if GMove[0] != 0:
+                XPSErrorHandler(controller, socket, GMove[0], 
+                                "GroupMoveRelative")
+        NewportSpinToSwitch(controller, socket, group, speed, switch)
+
+
 #@timeout(20)
-def wheelcheck(controller, socket, bit, val, group):
-# This loop monitors the position switch to stop the motor when 
+def wheelcheck(controller, socket, switch, group):
+# This waits for the position switch and stops the spinning motor when 
 # it reaches the switch.
-    ##MAX_SEARCH_TIME = 20
-    ##init_time = time.time()
-    ##tmp = 0
-    while True:
-        time.sleep(.1)
-        value = controller.GPIODigitalGet(socket, "GPIO4.DI")
-        if value[0] != 0:
-            XPSErrorHandler(controller, socket, value[0],
-                                        "GPIODigitalGet")
-        elif int(format(value[1], "016b")[::-1][bit]) == val:
-            stop=controller.GroupSpinModeStop(socket, group, 1200)
-            if stop[0] != 0:
-                XPSErrorHandler(controller, socket, stop[0],
-                                            "GroupSpinModeStop")
-            break
-        else:
-            pass
-        ##tmp = time.time() - init_time
-        ##if(tmp >= MAX_SEARCH_TIME):
-        ##    raise TimeoutError()
-        ##print tmp
+    NewportSwitchWait(controller, socket, switch)
+    stop=controller.GroupSpinModeStop(socket, group, 1200)
+    if stop[0] != 0:
+        XPSErrorHandler(controller, socket, stop[0],
+                                    "GroupSpinModeStop")
 
 
 def NewportInitialize(controller, motor, socket, home_pos):
@@ -350,21 +955,27 @@ def NewportInitialize(controller, motor, socket, home_pos):
 
         Raises: None.
     """
+    config = NewportMotor(motor)
+    motor  = config.motor
+    # The encoder is reset, calibrated wheels must find their slots again.
+    wheel_reference.pop(motor, None)
+    NewportForget(motor)
+
     # This function kills any motors that are still active from previous 
     # motions.
-    GKill = controller.GroupKill(socket, cfg[motor]["group"])   
+    GKill = controller.GroupKill(socket, config.group)   
     if GKill[0] != 0:
         XPSErrorHandler(controller, socket, GKill[0], "GroupKill")
 
     # This function initializes the motor so it can be moved.
-    GInit = controller.GroupInitialize(socket, cfg[motor]["group"])
+    GInit = controller.GroupInitialize(socket, config.group)
     if GInit[0] != 0:
         XPSErrorHandler(controller, socket, GInit[0], "GroupInitialize")
 
     # This function homes the motor and then moves the motor to a home position
     # defined by the user.
     GHomeSearch = controller.GroupHomeSearchAndRelativeMove(socket, 
-                                                            cfg[motor]["group"],
+                                                            config.group,
                                                             [home_pos])
     if GHomeSearch[0] != 0:
         XPSErrorHandler(controller, socket, GHomeSearch[0], 
@@ -387,27 +998,66 @@ def NewportKmirrorMove(controller, socket, motor, position):
 
         Raises: None.
     """
-    # This checks to see if the motor is in a continuous rotation state and if 
-    # it is then the function disables continuous rotation. 
-
-    Gmode = controller.GroupJogModeDisable(socket, cfg[motor]["group"])
-    if Gmode[0] != 0 and Gmode[0] != -22:
-        XPSErrorHandler(controller, socket, Gmode[0], "GroupJogModeEnable")
+    config = NewportMotor(motor)
+    motor  = config.motor
+    # This checks to see if the motor may be in a continuous rotation state 
+    # and if it is then the function disables continuous rotation. 
+    if jog_mode.get(motor, True):
+        Gmode = controller.GroupJogModeDisable(socket, config.group)
+        if Gmode[0] != 0 and Gmode[0] != -22:
+            XPSErrorHandler(controller, socket, Gmode[0], "GroupJogModeEnable")
+        jog_mode[motor] = False
 
     # This function sets the motion parameters to be used by the motor.
     # If the parameters are set correctly then an absolute move is made to the 
     # position of choice.
-    Gset = controller.PositionerSGammaParametersSet(socket,
-                                                    cfg[motor]["positioner"], 
-                                                    10 , 200, .005, .05)
+    NewportProfileSet(controller, socket, config, (10, 200, .005, .05))
+    GMove = controller.GroupMoveAbsolute(socket, config.group, 
+                                         [float(position)])
+    if GMove[0] != 0:
+        NewportForget(motor)
+        XPSErrorHandler(controller, socket, GMove[0], "GroupMoveAbsolute")
+
+
+def NewportProfileSet(controller, socket, motor, profile):
+    """This function sets the SGamma motion profile of a motor, unless it is 
+    the profile last set.
+
+        Arguments: controller, socket, motor, profile.
+
+            controller: [xps]   Which instance of the XPS controller to use.
+            socket:     [int]   Which socket to use to communicate with the XPS 
+                                controller.
+            motor:      [str]   Which motor is being controlled.  This is for 
+                                config file purposes.
+            profile:    [tuple] Velocity, acceleration, minimum and maximum 
+                                jerk time.
+
+        Returns: None.
+
+        Raises: InstrumentError.
+    """
+    config = NewportMotor(motor)
+    motor  = config.motor
+    if motion_profile.get(motor) == profile:
+        return
+    motion_profile.pop(motor, None)
+    Gset = controller.PositionerSGammaParametersSet(socket, config.positioner,
+                                                    *profile)
     if Gset[0] != 0:
         XPSErrorHandler(controller, socket, Gset[0],
                         "PositionerSGammaParametersSet")
-    else:
-        GMove = controller.GroupMoveAbsolute(socket, cfg[motor]["group"], 
-                                             [float(position)])
-        if GMove[0] != 0:
-            XPSErrorHandler(controller, socket, GMove[0], "GroupMoveAbsolute")
+    motion_profile[motor] = profile
+
+
+def NewportForget(motor=None):
+    """This function forgets the motion settings last sent for a motor, or 
+    for every motor, so that the next move sends them again."""
+    for state in (motion_profile, jog_mode):
+        if motor is None:
+            state.clear()
+        else:
+            state.pop(motor, None)
        
    
 
@@ -431,17 +1081,19 @@ def NewportKmirrorRotate(controller, socket, motor, speed):
     
         Raises: None.
     """
+    config = NewportMotor(motor)
+    motor  = config.motor
     # This checks if the motor is in a continuous rotation state and if not 
     # enables that state.
-    Gmode = controller.GroupJogModeEnable(socket, cfg[motor]["group"])
+    Gmode = controller.GroupJogModeEnable(socket, config.group)
     if Gmode[0] != 0 and Gmode[0] != -22:
         XPSErrorHandler(controller, socket, Gmode[0], "GroupJogModeEnable")
     else:
-        pass
+        jog_mode[motor] = True
     # This sets the rotation rate for the motor. 
     # The motor will rotate until it is stopped or it hits a limit switch.
-    velocity = speed*cfg[motor]["direction"]
-    GJog = controller.GroupJogParametersSet(socket, cfg[motor]["group"],
+    velocity = speed*config.direction
+    GJog = controller.GroupJogParametersSet(socket, config.group,
                                             [velocity],[400])
     if GJog[0] != 0:
         XPSErrorHandler(controller, socket, GJog[0], "GroupJogParametersSet")
@@ -467,10 +1119,12 @@ def NewportStatusGet(controller, socket, motor):
 
         Raises: None.
     """
+    config = NewportMotor(motor)
+    motor  = config.motor
     # Initializing the empty list.
     info = []
     # Retrieving the position of the motor.
-    position = controller.GroupPositionCurrentGet(socket, cfg[motor]["group"], 
+    position = controller.GroupPositionCurrentGet(socket, config.group, 
                                                   1)
     if position[0] != 0:
         XPSErrorHandler(controller, socket, position[0],
@@ -479,7 +1133,7 @@ def NewportStatusGet(controller, socket, motor):
         info.append(position[1])
     # Getting the rest of the information.
     profile = controller.PositionerSGammaParametersGet(socket, 
-                                                       cfg[motor]["positioner"])
+                                                       config.positioner)
     if profile[0] != 0:
         XPSErrorHandler(controller, socket, profile[0],
                         "PositionerSGammaParametersGet")
@@ -507,11 +1161,13 @@ def NewportStop(controller, socket, motor):
 
         Raises: None.
     """
+    config = NewportMotor(motor)
+    motor  = config.motor
     # Checking if the motor is the kmirror motor. If so then it stops the motor
     # and disables jogging. 
     if motor == "kmirror":
         # Stopping.
-        GStop = controller.GroupJogParametersSet(socket, cfg[motor]["group"], 
+        GStop = controller.GroupJogParametersSet(socket, config.group, 
                                                  [0],[200])
         if GStop[0] != 0:
             XPSErrorHandler(controller, socket, GStop[0], 
@@ -519,16 +1175,16 @@ def NewportStop(controller, socket, motor):
         else: 
             pass 
         # Disabling jogging.
-        JDisable = controller.GroupJogModeDisable(socket, cfg[motor]["group"])
+        JDisable = controller.GroupJogModeDisable(socket, config.group)
         if JDisable[0] != 0:
             XPSErrorHandler(controller, socket, JDisable[0],
                             "GroupJogModeDisable")
         else: 
-            pass   
+            jog_mode[motor] = False
     # The case for the other motors.  Only a stop command is required.     
     else:
         # Stopping.
-        GStop = controller.GroupSpinParametersSet(socket, cfg[motor]["group"],
+        GStop = controller.GroupSpinParametersSet(socket, config.group,
                                                   0, 800)
         if GStop[0] != 0:
             XPSErrorHandler(controller, socket, GStop[0], 
@@ -536,80 +1192,69 @@ def NewportStop(controller, socket, motor):
         else:
             pass
 
-@run_async
 def NewportFocusLimit(controller, socket, motor):
-    """This function is an asynchronus function that monitors the switches for 
-    the FPA.  If the FPA reaches one of its limits then the motor is stopped 
-    immediately.  If a polite stop fails then a kill all command is sent. 
+    """This function arms the FPA limit switches.  The controller aborts the 
+    FPA motion by itself, within a servo cycle, when either limit switch is 
+    reached; the running GroupMoveRelative then returns -27.  The events must 
+    be removed with NewportFocusRelease once the motion is over.
     
         Arguments: controller, socket, motor.
     
             controller: [xps]   Which instance of the XPS controller to use.
             socket:     [int]   Which socket to use to communicate with the XPS
                                 controller.
-            motor:      [str]   Which Motor is being controlled.  This is for 
-                                config file purposes.
+            motor:      [str]   Which Motor is being controlled, by name or
+                                its Motor from settings.
     
-        Returns: None.
+        Returns: events.
 
-        Raises: None.
+            events:     [list]  The IDs of the armed events.
+
+        Raises: InstrumentError.
 
     """
-    # Setting config-file variables.
-    bitup = cfg[motor]["upper"]["bit"]
-    bitdown = cfg[motor]["lower"]["bit"]
-    valup = cfg[motor]["upper"]["val"]
-    valdown = cfg[motor]["lower"]["val"]
-    stop = False
-    limit = False
-
-    # This while loop runs until the motor is stopped by a different function or
-    # it runs into a limit switch. 
-    while stop == False:
-        # Polling the controller for motor info.
-        value = controller.GPIODigitalGet(socket, "GPIO4.DI")
-        velocity = controller.GroupVelocityCurrentGet(socket, 
-                                                      cfg[motor]["group"])
-        
-        # If either of the polls fails then the loop and the motor are stopped.
-        if value[0] != 0 or velocity[0] != 0:
-            fpa_limit_flag.clear()
-            limit = True
-            stop = True
-            if value[0] != 0:
-                XPSErrorHandler(controller, socket, value[0], "GPIODigitalGet")
-            else:
-                XPSErrorHandler(controller, socket, velocity[0], 
-                                "GroupVelocityCurrentGet")
+    config = NewportMotor(motor)
+    events = []
+    try:
+        for limit in ("upper", "lower"):
+            events.append(NewportSwitchAbort(controller, socket, config.group,
+                                             getattr(config, limit)))
+    except InstrumentError:
+        NewportFocusRelease(controller, socket, events)
+        raise
+    return events
 
-        # Checking if either of the switches are reached.
-        elif int(format(value[1], "016b")[::-1][bitup]) == valup or \
-             int(format(value[1], "016b")[::-1][bitdown]) == valdown:
-            fpa_limit_flag.clear()
-            limit = True
-            stop = True
 
-        # Checking if the motor was stopped.
-        elif fpa_limit_flag.is_set() == False:
-            stop = True
+def NewportFocusRelease(controller, socket, events):
+    """This function removes the limit events armed by NewportFocusLimit.
 
-        else:
-            pass 
+        Arguments: controller, socket, events.
 
-    if limit == True:
-        # Stopping the motor politely.
-        kill = controller.GroupKill(socket, cfg[motor]['group'])
-        if kill[0] != 0:
-            # Stopping the motor impolitely.
-            killall = controller.KillAll(socket)
-            if killall[0] != 0:
-                XPSErrorHandler(controller, socket, killall[0], "KillAll")
-            XPSErrorHandler(controller, socket, kill[0], "GroupKill")
+            controller: [xps]   Which instance of the XPS controller to use.
+            socket:     [int]   Which socket to use to communicate with the XPS
+                                controller.
+            events:     [list]  The event IDs returned by NewportFocusLimit.
+
+        Returns: None.
+
+        Raises: None.
+    """
+    for event in events:
+        remove = controller.EventExtendedRemove(socket, event)
+        if remove[0] != 0:
+            logging.error("EventExtendedRemove of FPA limit event %d failed"
+                          " with error %d." % (event, remove[0]))
            
 
 def NewportFocusMove(controller, socket, motor, distance, speed, direction):
     """This function moves the FPA.  The user sets the distance speed and 
-    direction of the motion.  
+    direction of the motion.  The whole distance is a single GroupMoveRelative
+    at the SGamma profile of the speed, so a long move costs one round trip.
+    The controller aborts it by itself when a limit switch is reached (see 
+    NewportFocusLimit), and a GroupMoveAbort from another socket stops it 
+    at once, e.g. FocalPlane.stop.  After an abort the distance actually 
+    moved is read back from the encoder.
+
         Arguments: controller, socket, motor, distance, speed, direction.
 
             controller: [xps]   Which instance of the XPS controller to use.
@@ -624,108 +1269,119 @@ def NewportFocusMove(controller, socket, motor, distance, speed, direction):
         Returns: travel.
 
             travel:     [float] How far the motor moved in micrometers.  In the 
-                                case of an error this will be set to the string 
-                                'ERROR'.
+                                case of a limit switch this will be set to the
+                                string 'ERROR'.
     
-        Raises: None.
+        Raises: InstrumentError.
 """
-    # Initializing variables of motion and setting the fpa_limit_flag to true.
-    fpa_limit_flag.set()
+    # Initializing variables of motion.
     deg_distance = distance*.576
     velocity = speed 
-    true_direction = direction * cfg[motor]['direction']
+    config = settings[motor]
+    true_direction = direction * config.direction
+    group = config.group
     # initializing the motors motion profile and checking to for success.
     SGamma = controller.PositionerSGammaParametersSet(socket[1], 
-                                                      cfg[motor]["positioner"], 
+                                                      config.positioner, 
                                                       velocity, 600, .005, .05)
     if SGamma[0] != 0:
-        fpa_limit_flag.clear()
         XPSErrorHandler(controller, socket[1], SGamma[0], 
                         "PositionerSGammaParametersSet")                
-    
-    # determining how many rotaions to move the motor.
-    count = int(math.floor(deg_distance/360))
-    remainder = true_direction * (deg_distance % 360)
 
-    # Starting the monitoring thread.
-    NewportFocusLimit(controller, socket[0], motor)
-    
-    # This loop checks to be sure the motor is allowed to move.  If so then it 
-    # rotates the motor 360 degrees in the appropriate direction and then 
-    # repeats.
-    for i in range(count):
-        # Check of motor movability.
-        if fpa_limit_flag.is_set() == False:
-            return 'ERROR'
-        
-        else:
-            # Movement.
-            GMove = controller.GroupMoveRelative(socket[1], cfg[motor]["group"], 
-                                             [true_direction * 360])
-            if GMove[0] != 0:
-                XPSErrorHandler(controller, socket[1], Gmove[0], 
-                                "GroupMoveRelative")
-    # A last check to determine if the motor can move.
-    if fpa_limit_flag.is_set() == False:
+    # The limit events only fire on a switch edge, so a move further into a 
+    # limit that is already reached is refused here.
+    limit = "lower" if direction < 0 else "upper"
+    if NewportSwitchIs(controller, socket[0], config, limit):
         return 'ERROR'
-    
-    # Moving the motor the last fraction of a rotation.
-    else:
-        GMove = controller.GroupMoveRelative(socket[1], cfg[motor]["group"], 
-                                             [remainder])
-        if GMove[0] != 0:
-            XPSErrorHandler(controller, socket[1], Gmove[0], 
-                            "GroupMoveRelative")
-
-    # Returning the distance traveled and setting the fpa_limit_flag to false so
-    # that the limit tracking thread stops.
+
+    # The start of the move, to measure an aborted move.
+    start = controller.GroupPositionCurrentGet(socket[0], group, 1)
+    if start[0] != 0:
+        XPSErrorHandler(controller, socket[0], start[0], 
+                        "GroupPositionCurrentGet")
+
+    # Arming the limit switches on the controller, then moving the whole 
+    # distance at once.  A limit switch or a GroupMoveAbort aborts the move 
+    # (-27).
+    events = NewportFocusLimit(controller, socket[0], config)
+    try:
+        GMove = controller.GroupMoveRelative(socket[1], group, 
+                                             [true_direction * deg_distance])
+    finally:
+        NewportFocusRelease(controller, socket[0], events)
+
+    if GMove[0] == -27:
+        if NewportSwitchIs(controller, socket[0], config, limit):
+            logging.info("FPA motion aborted by the %s limit switch." % limit)
+            return 'ERROR'
+        end = controller.GroupPositionCurrentGet(socket[0], group, 1)
+        if end[0] != 0:
+            XPSErrorHandler(controller, socket[0], end[0], 
+                            "GroupPositionCurrentGet")
+        travel = abs(end[1] - start[1]) / .576
+        logging.info("FPA motion stopped after %.2f of %.2f um." 
+                     % (travel, distance))
+        return travel
+    elif GMove[0] != 0:
+        XPSErrorHandler(controller, socket[1], GMove[0], "GroupMoveRelative")
+
+    # Returning the distance traveled.
     travel = distance   
-    fpa_limit_flag.clear()
     return travel 
     
 
-def NewportFocusHome(controller, socket, motor):
+def NewportFocusHome(controller, socket, motor, stop_event=None, 
+                     timeout=120):
     """This function homes the FPA .  It runs the FPA towards the bottom of its
     motion until it hits the lower limit switch.  When it reaches the switch a 
-    stop command is sent.  If that fails then kill commands will be sent.
+    stop command is sent.  If that fails then kill commands will be sent.  The
+    wait for the switch ends when stop_event is set, e.g. by FocalPlane.stop 
+    after it stopped the spin, or after timeout seconds, when the group is 
+    killed.
 
-        Arguments: controller, socket, motor.
+        Arguments: controller, socket, motor, stop_event, timeout.
     
             controller: [xps]   Which instance of the XPS controller to use.
             socket:     [int]   Which socket to use to connect to the XPS 
                                 controller.
             motor:      [str]    Which motor is being controlled.  This is for 
                                 config file purposes. 
+            stop_event: [Event] Ends the homing when set.
+            timeout:    [float] Seconds to wait for the lower limit switch.
 
         Returns: None.
 
-        Raises: None.
+        Raises: InstrumentError.
     """
     # Initializing motor variables.
-    bitdown = cfg[motor]["lower"]["bit"]
-    valdown = cfg[motor]["lower"]["val"]
-    vel = -200*int(cfg[motor]['direction'])
-    group = cfg[motor]['group']
+    config = NewportMotor(motor)
+    lower = config.lower
+    vel = -200*config.direction
+    group = config.group
     
     # Starting motion. 
-    Gset = controller.GroupSpinParametersSet(socket, cfg[motor]["group"], 
+    Gset = controller.GroupSpinParametersSet(socket, group, 
                                              vel, 200)
     if Gset[0] != 0:
         XPSErrorHandler(controller ,socket, Gset[0], "GroupSpinParametersSet")
     else:
-        # This loop watches for the limit switch to be activated.
-        while True:
-            value = controller.GPIODigitalGet(socket, "GPIO4.DI")
-            if int(format(value[1], "016b")[::-1][bitdown]) == valdown:
-                break
+        # Blocking until the limit switch is activated.
+        try:
+            NewportSwitchWait(controller, socket, lower, timeout, stop_event)
+        except InstrumentError:
+            # A stopped homing leaves spin mode so the group is ready again.
+            if stop_event is not None and stop_event.is_set():
+                controller.GroupSpinModeStop(socket, group, 400)
             else:
-                time.sleep(.1)
+                controller.GroupKill(socket, group)
+            raise
     # When the loop terminates a stop command is sent.  If that command fails a
     # group kill command is sent.  If that fails a kill all command is sent. 
     stop = controller.GroupSpinModeStop(socket, group, 400)
     if stop[0] != 0:
         Kill = controller.GroupKill(socket, group)
         if Kill[0] != 0:
+            NewportForget()
             KillAll = controller.KillAll(socket)
             if KillAll[0] != 0:
                 XPSErrorHandler(controller, socket, KillAll[0], "KillAll")            
@@ -735,68 +1391,157 @@ def NewportFocusHome(controller, socket, motor):
         pass
 
 
-def NewportKmirrorTracking(parent, controller, socket, motor, t_angle, track_event):
+def NewportKmirrorJog(controller, socket, motor, velocity, enable=False):
+    """This function sets the jog velocity of the k-mirror during derotation.
+    Unlike NewportKmirrorRotate the velocity is the rate of the motor 
+    position, the config file direction is not applied.  Jog mode is 
+    enabled first when asked.
+
+        Arguments: controller, socket, motor, velocity, enable.
+
+            controller: [xps]   Which instance of the XPS controller to use.
+            socket:     [int]   Which socket to use to communicate with the XPS 
+                                controller.
+            motor:      [str]   Which motor is being controlled.  This is for 
+                                config file purposes.
+            velocity:   [float] Motor velocity in deg/s.
+            enable:     [bool]  Whether to enable jog mode first.
+
+        Returns: None.
+
+        Raises: InstrumentError.
     """
-This function initiates kmirror tracking.  The tracking algorith updates the
-speed of rotation based on feedback from the telescope.  If the telescope is 
-not returning data then the tracking is cancelled.  tracking runs until the 
-user stops it in the NESSI GUI.
-    
-    Inputs: parent, controller, socket, motor.
-    
-    parent:     [???]   The object that called the function.
-    controller: [xps]   Which instance of the XPS controller to use.
-    socket:     [int]   Which socket to be used to communicate with the XPS
-                        controller.
-    motor:      [str]   Which motor is being used.  This is for config file
-                        purposes.
-    t_angle:    [float] User defined angle specific to the target.
-    track_event:[threading.Event] Event to signal end of tracking.
+    config = NewportMotor(motor)
+    motor  = config.motor
+    if enable:
+        Gmode = controller.GroupJogModeEnable(socket, config.group)
+        if Gmode[0] != 0 and Gmode[0] != -22:
+            XPSErrorHandler(controller, socket, Gmode[0], 
+                            "GroupJogModeEnable")
+        jog_mode[motor] = True
+    GJog = controller.GroupJogParametersSet(socket, config.group,
+                                            [velocity], [200])
+    if GJog[0] != 0:
+        XPSErrorHandler(controller, socket, GJog[0], "GroupJogParametersSet")
 
-"""
-    Gmode = controller.GroupJogModeEnable(socket, cfg[motor]["group"])
-    if Gmode[0] != 0 and Gmode[0] != -22:
-        XPSErrorHandler(controller, socket, Gmode[0], "GroupJogModeEnable")
-    phi = math.radians(33.984861)
-    
-    while not track_event.isSet():
-        try:
-            keywords = parent.instrument.keywords
-            A = math.radians(keywords['TELAZ'])
-            H = math.radians(keywords['TELALT'])
-            PA = float(keywords['PA'])
-        except TypeError:
-            track_event.set()
-            time.sleep(1)
-        else:
-            angle = .5*(t_angle - PA - int(cfg[motor]["direction"])*H)
-            vel = ((-.262)*(.5)*180*math.cos(phi)*math.cos(A))/\
-                  (math.cos(H)*3600*math.pi)
-            delta = vel - parent.vel
-            parent.vel = parent.vel + delta
-            velocity = parent.vel*int(cfg[motor]["direction"])
-            GJog = controller.GroupJogParametersSet(socket, cfg[motor]["group"],
-                                                    [velocity],[200])
-            if GJog[0] != 0:
-                XPSErrorHandler(controller, socket, GJog[0],
-                                "GroupJogParametersSet")
-            position = controller.GroupPositionCurrentGet(socket, 
-                                                          cfg[motor]["group"],
-                                                          1)
-            if position[0] != 0:
-                XPSErrorHandler(controller, socket, position[0],
-                                "GroupPositionCurrentGet")
-            diff_angle = position[1] - angle           
-            time.sleep(1)
+
+def NewportKmirrorJogEnd(controller, socket, motor, timeout=2):
+    """This function stops the k-mirror jog and disables jog mode once the 
+    motor stands still, so that absolute moves are accepted again.
+
+        Arguments: controller, socket, motor, timeout.
+
+            controller: [xps]   Which instance of the XPS controller to use.
+            socket:     [int]   Which socket to use to communicate with the XPS 
+                                controller.
+            motor:      [str]   Which motor is being controlled.  This is for 
+                                config file purposes.
+            timeout:    [float] Seconds to wait for the motor to stop.
+
+        Returns: None.
+
+        Raises: InstrumentError.
+    """
+    config = NewportMotor(motor)
+    motor  = config.motor
+    NewportKmirrorJog(controller, socket, config, 0)
+    deadline = time.time() + timeout
+    while True:
+        JDisable = controller.GroupJogModeDisable(socket, config.group)
+        if JDisable[0] == 0:
+            jog_mode[motor] = False
+            return
+        if time.time() > deadline:
+            XPSErrorHandler(controller, socket, JDisable[0], 
+                            "GroupJogModeDisable")
+        time.sleep(0.05)
+
+
+def NewportPositionGet(controller, socket, motor):
+    """Returns the current position of a motor, given its name or its Motor
+    from settings."""
+    position = controller.GroupPositionCurrentGet(socket, 
+                                                  NewportMotor(motor).group, 1)
+    if position[0] != 0:
+        XPSErrorHandler(controller, socket, position[0],
+                        "GroupPositionCurrentGet")
+    return position[1]
         
 
+def NewportPVTVerify(controller, socket, motor, name):
+    """This function checks a PVT trajectory file already on the controller 
+    against the motor limits.  The group of the motor must be a 
+    MultipleAxes group.
+
+        Arguments: controller, socket, motor, name.
+
+            controller: [xps]   Which instance of the XPS controller to use.
+            socket:     [int]   Which socket to use to communicate with the XPS 
+                                controller.
+            motor:      [str]   Which motor is being controlled.  This is for 
+                                config file purposes.
+            name:       [str]   Trajectory file name, in 
+                                /Admin/Public/Trajectories.
+
+        Returns: [list] Minimum and maximum position, maximum velocity and 
+                        maximum acceleration of the trajectory.
+
+        Raises: InstrumentError.
+    """
+    config = NewportMotor(motor)
+    verify = controller.MultipleAxesPVTVerification(socket, config.group, 
+                                                    name)
+    if verify[0] != 0:
+        XPSErrorHandler(controller, socket, verify[0], 
+                        "MultipleAxesPVTVerification")
+    result = controller.MultipleAxesPVTVerificationResultGet(
+        socket, config.positioner)
+    if result[0] != 0:
+        XPSErrorHandler(controller, socket, result[0], 
+                        "MultipleAxesPVTVerificationResultGet")
+    return result[2:]
+
+
+def NewportPVTExecute(controller, socket, motor, name):
+    """This function runs a verified PVT trajectory once.  The controller 
+    answers when the trajectory is over, or when it is aborted by 
+    GroupMoveAbort.
+
+        Arguments: controller, socket, motor, name.
+
+            controller: [xps]   Which instance of the XPS controller to use.
+            socket:     [int]   Which socket to use to communicate with the XPS 
+                                controller.
+            motor:      [str]   Which motor is being controlled.  This is for 
+                                config file purposes.
+            name:       [str]   Trajectory file name, see NewportPVTVerify.
+
+        Returns: [bool] False if the trajectory was aborted.
+
+        Raises: InstrumentError.
+    """
+    execute = controller.MultipleAxesPVTExecution(socket, 
+                                                  NewportMotor(motor).group, 
+                                                  name, 1)
+    if execute[0] == -27:
+        return False
+    if execute[0] != 0:
+        XPSErrorHandler(controller, socket, execute[0], 
+                        "MultipleAxesPVTExecution")
+    return True
+
+
 def NewportKill(controller, motor, socket):
+    config = NewportMotor(motor)
+    motor  = config.motor
+    NewportForget(motor)
     try:
-        kill = controller.GroupKill(socket, cfg[motor]['group'])
+        kill = controller.GroupKill(socket, config.group)
         if kill[0] != 0:
             XPSErrorHandler(controller, socket, kill[0], "GroupKill")
     
     except:
+        NewportForget()
         killall = controller.KillAll(socket)
         if killall[0] != 0:
             XPSErrorHandler(controller, socket, killall[0], "KillAll")
@@ -0,0 +1,248 @@
+"""
+.. module:: pvt
+   :platform: Unix
+   :synopsis: K-mirror derotation planned ahead and run by the XPS as PVT.
+
+"""
+
+import ftplib
+import logging
+import StringIO
+import threading
+import time
+
+import numpy
+
+import instrument.actuators.newport as np
+from instrument.actuators.derotator import SIDEREAL, target
+from instrument.component import InstrumentError
+
+#Controller folder of the PVT trajectory files
+TRAJECTORIES = '/Admin/Public/Trajectories'
+
+
+def plan(user_angle, hour_angle, declination, latitude, mode, duration,
+         step):
+    """Derotation angle and velocity of a target over the coming minutes,
+    as KMirror.userAngleToPositionAngle would give them.
+
+    Arguments:
+        user_angle  -- Position angle to hold -> float
+        hour_angle  -- Hour angle of the target at the start, deg -> float
+        declination -- Declination of the target, deg -> float
+        latitude    -- Site latitude, deg -> float
+        mode        -- [kmirror] direction -> +-1
+        duration    -- Seconds to plan -> float
+        step        -- Seconds between two points -> float
+
+    Returns:
+        (times, angles, velocities) from the start, in s, deg and deg/s
+        -> (numpy.ndarray, numpy.ndarray, numpy.ndarray)
+    """
+    times = numpy.arange(0.0, duration + step / 2.0, step)
+    ha    = numpy.radians(hour_angle + SIDEREAL * times)
+    dec   = numpy.radians(declination)
+    lat   = numpy.radians(latitude)
+
+    alt = numpy.arcsin(numpy.sin(lat) * numpy.sin(dec) +
+                       numpy.cos(lat) * numpy.cos(dec) * numpy.cos(ha))
+    az  = numpy.arctan2(-numpy.cos(dec) * numpy.sin(ha),
+                        numpy.sin(dec) * numpy.cos(lat) -
+                        numpy.cos(dec) * numpy.cos(ha) * numpy.sin(lat))
+    pa  = numpy.unwrap(numpy.arctan2(numpy.sin(ha),
+                                     numpy.tan(lat) * numpy.cos(dec) -
+                                     numpy.sin(dec) * numpy.cos(ha)))
+
+    #Rates as derotator.rate, azimuth from north through east
+    parallactic = -SIDEREAL * numpy.cos(lat) * numpy.cos(az) / numpy.cos(alt)
+    elevation   = SIDEREAL * numpy.cos(lat) * numpy.sin(az)
+
+    angles     = target(user_angle, numpy.degrees(alt), numpy.degrees(pa),
+                        mode)
+    velocities = -0.5 * (parallactic + mode * elevation)
+    return times, angles, velocities
+
+
+def segments(angles, velocities, step, ramp):
+    """PVT segments following a plan. The trajectory starts from rest with
+    a ramp up to the first planned velocity, and ends with a ramp down to
+    rest.
+
+    Arguments:
+        angles, velocities -- Plan, see plan
+        step               -- Seconds between two points of the plan
+        ramp               -- Seconds of the ramps -> float
+
+    Returns:
+        (start, rows): the angle to start the trajectory from, and the
+        (duration, displacement, end velocity) of each segment
+        -> (float, [(float, float, float)])
+    """
+    start = angles[0] - velocities[0] * ramp / 2.0
+    rows  = [(ramp, velocities[0] * ramp / 2.0, velocities[0])]
+    rows += zip([step] * (len(angles) - 1), numpy.diff(angles),
+                velocities[1:])
+    rows.append((ramp, velocities[-1] * ramp / 2.0, 0.0))
+    return float(start), [tuple(float(x) for x in row) for row in rows]
+
+
+def trajectory(rows):
+    """Text of a single positioner PVT trajectory file."""
+    return ''.join('%.4f, %.8f, %.8f\n' % row for row in rows)
+
+
+def upload(name, text):
+    """Copy a trajectory file to the controller by FTP.
+
+    Arguments:
+        name -- File name on the controller -> str
+        text -- Content, see trajectory -> str
+
+    Raises:
+        InstrumentError
+    """
+    general = np.cfg['general']
+    try:
+        ftp = ftplib.FTP(general.get('xps host', '10.90.20.1'),
+                         general.get('ftp user', 'Administrator'),
+                         general.get('ftp password', 'Administrator'))
+        try:
+            ftp.cwd(TRAJECTORIES)
+            ftp.storbinary('STOR ' + name, StringIO.StringIO(text))
+        finally:
+            ftp.quit()
+    except ftplib.all_errors as e:
+        raise InstrumentError('Unable to upload the trajectory %s: %s'
+                              % (name, e))
+
+
+class PVTDerotator(object):
+    """Derotation of the k-mirror run by the controller.
+
+    The derotation over the next [kmirror] pvt duration seconds is planned
+    from one read of the target hour angle and declination, written as a PVT
+    trajectory, verified and executed by the controller. Python only acts
+    between two trajectories, to plan the next one, so the network does not
+    add jitter to the derotation. The k-mirror stands still for the two
+    ramps and the short catch-up move between trajectories.
+
+    The k-mirror group must be a MultipleAxes group on the controller to
+    run PVT trajectories.
+
+    Attributes:
+        duration -- Seconds covered by one trajectory.
+        step     -- Seconds between two points of a trajectory.
+        ramp     -- Seconds of the start and end ramps.
+        lead     -- Seconds from planning to the start of the trajectory,
+                    for the upload, the catch-up move and the verification.
+        error    -- Exception that ended the derotation, None otherwise.
+    """
+
+    def __init__(self, kmirror, user_angle, stop_event=None):
+        """Set up the derotation, start() runs it.
+
+        Arguments:
+            kmirror    -- K-mirror to derotate -> KMirror
+            user_angle -- Position angle to hold -> float
+            stop_event -- Event ending the derotation when set
+                          -> threading.Event
+
+        Raises:
+            InstrumentError
+        """
+        motor    = np.settings[kmirror.motor]
+        tracking = motor.tracking
+        if kmirror.instrument is None or \
+           kmirror.instrument.telescope is None:
+            raise InstrumentError('The K-Mirror can not track without the'
+                                  ' telescope!')
+        self.kmirror    = kmirror
+        self.telescope  = kmirror.instrument.telescope
+        self.user_angle = user_angle
+        self.mode       = motor.direction
+        self.duration   = tracking.pvt_duration
+        self.step       = tracking.pvt_step
+        self.ramp       = tracking.pvt_ramp
+        self.lead       = tracking.pvt_lead
+        self.error      = None
+
+        self._stop   = stop_event if stop_event is not None else \
+                       threading.Event()
+        self._thread = threading.Thread(name='KMirrorPVT', target=self._run)
+        self._thread.daemon = True
+
+    @property
+    def running(self):
+        return self._thread.is_alive()
+
+    def start(self):
+        """Start derotating."""
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        """Abort the running trajectory and stop derotating."""
+        self._stop.set()
+        if self.running:
+            self._abort()
+        if threading.current_thread() is not self._thread and \
+           self._thread.ident is not None:
+            self._thread.join(timeout)
+
+    def _abort(self):
+        with self.kmirror.pool.socket() as socket:
+            self.kmirror.controller.GroupMoveAbort(
+                socket, np.settings[self.kmirror.motor].group)
+
+    def _run(self):
+        kmirror    = self.kmirror
+        controller = kmirror.controller
+        motor      = kmirror.motor
+        count      = 0
+        try:
+            kmirror.track_status = True
+            while not self._stop.is_set():
+                #Two files, so the next upload never replaces the running
+                #trajectory.
+                name  = 'nessikmirror%d.trj' % (count % 2)
+                begin = time.time() + self.lead
+                hour_angle = float(self.telescope.ha) + \
+                             SIDEREAL * (begin - time.time())
+                _, angles, velocities = plan(
+                    self.user_angle, hour_angle, float(self.telescope.dec),
+                    self.telescope.latitude, self.mode, self.duration,
+                    self.step)
+                start, rows = segments(angles, velocities, self.step,
+                                       self.ramp)
+                upload(name, trajectory(rows))
+                kmirror.move(start)
+                result = kmirror.dispatch.move(
+                    lambda socket: np.NewportPVTVerify(controller, socket,
+                                                       motor, name))
+                logging.debug('K-Mirror trajectory %s verified: %s'
+                              % (name, result))
+
+                #The planned motion starts at the end of the ramp.
+                late = time.time() - (begin - self.ramp)
+                if late > 0:
+                    logging.warning('K-Mirror trajectory %s starts %.2f s'
+                                    ' late.' % (name, late))
+                elif self._stop.wait(-late):
+                    break
+                run = kmirror.dispatch.motion.submit(
+                    lambda socket: np.NewportPVTExecute(controller, socket,
+                                                        motor, name))
+                #A stop event set by the caller aborts the trajectory too.
+                while not run.wait(0.2):
+                    if self._stop.is_set():
+                        self._abort()
+                        break
+                if not run.result():
+                    break
+                count += 1
+        except Exception as e:
+            self.error = e
+            logging.error('K-Mirror PVT tracking stopped: %r' % e)
+        finally:
+            kmirror.track_status = False
+            logging.info('K-Mirror PVT tracking ran %d trajectories of'
+                         ' %.0f s.' % (count, self.duration))
@@ -0,0 +1,200 @@
+"""
+.. module:: snapshot
+   :platform: Unix
+   :synopsis: Periodic snapshot of the state of every NESSI motor group.
+
+"""
+
+import collections
+import logging
+import threading
+import time
+
+import motorconfig
+from gpio import SWITCHES
+from instrument.component import InstrumentError
+
+#Motors sampled by the snapshot, in the order of nessisettings.ini
+MOTORS = ('mask', 'filter1', 'filter2', 'grism', 'array', 'kmirror')
+
+
+class GroupState(collections.namedtuple(
+        'GroupState', 'motor group position velocity status')):
+    """State of one XPS group. Fields that could not be read are None."""
+    __slots__ = ()
+
+
+class Snapshot(collections.namedtuple(
+        'Snapshot', 'sequence time gpio groups')):
+    """Immutable state of the controller at one instant.
+
+    Attributes:
+        sequence -- Increases by one with every published snapshot.
+        time     -- time.time() when the burst was answered.
+        gpio     -- GPIO4.DI word, None if it could not be read.
+        groups   -- GroupState of every motor -> (GroupState, ...)
+    """
+    __slots__ = ()
+
+    def motor(self, motor):
+        """GroupState of a motor by its nessisettings.ini name."""
+        for state in self.groups:
+            if state.motor == motor:
+                return state
+        raise KeyError(motor)
+
+    def bit(self, bit):
+        """Value (0/1) of one GPIO4.DI bit, None if the word is unknown."""
+        if self.gpio is None:
+            return None
+        return (self.gpio >> bit) & 1
+
+    @property
+    def age(self):
+        return time.time() - self.time
+
+
+class ControllerSnapshot(object):
+    """Background sampler publishing a Snapshot at a fixed rate.
+
+    Each tick sends GroupPositionCurrentGet, GroupVelocityCurrentGet and
+    GroupStatusGet for every motor plus GPIODigitalGet as one pipelined
+    burst on one socket, so the whole controller state costs a single round
+    trip. Consumers read `latest` instead of querying the controller.
+
+    Given a GPIOSampler, the snapshot takes the GPIO4.DI word of its next
+    sample instead, so the controller has a single GPIO4.DI poller.
+    """
+
+    def __init__(self, controller, pool, cfg, rate=None, gpio=None):
+        """Start sampling.
+
+        Arguments:
+            controller -- XPS instance -> XPS_C8_drivers.XPS
+            pool       -- Socket pool -> XPSConnectionPool
+            cfg        -- NESSI configuration -> ConfigObj
+            rate       -- Snapshots per second, defaults to
+                          [general] snapshot rate -> float
+            gpio       -- Sampler of the switches, None to read GPIO4.DI
+                          in the burst -> gpio.GPIOSampler
+        """
+        self.controller = controller
+        self.pool       = pool
+        self.gpio       = gpio
+        self.rate       = float(rate if rate is not None else
+                                cfg['general'].get('snapshot rate', 5))
+        motors          = motorconfig.compile_motors(cfg)
+        self._groups    = [(motor, motors[motor].group) for motor in MOTORS]
+        self._calls     = [] if gpio is not None else \
+                          [('GPIODigitalGet', (SWITCHES,))]
+        for motor, group in self._groups:
+            self._calls += [('GroupPositionCurrentGet', (group, 1)),
+                            ('GroupVelocityCurrentGet', (group, 1)),
+                            ('GroupStatusGet',          (group,))]
+
+        self._latest  = None
+        self._cond    = threading.Condition()
+        self._stop    = threading.Event()
+        self._failing = False
+
+        self._thread  = threading.Thread(name='ControllerSnapshot',
+                                         target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def latest(self):
+        """Most recent Snapshot, None until the first burst is answered."""
+        return self._latest
+
+    def fresh(self, periods=3):
+        """Most recent Snapshot if it is at most `periods` sampling periods
+        old, None otherwise, e.g. while the controller does not answer.
+        """
+        latest = self._latest
+        if latest is None or latest.age > periods / self.rate:
+            return None
+        return latest
+
+    def wait(self, newer_than=None, timeout=None):
+        """Block until a snapshot newer than the given one is published.
+
+        Arguments:
+            newer_than -- Snapshot (or None for any snapshot).
+            timeout    -- Seconds to wait.
+
+        Raises:
+            InstrumentError
+
+        Returns:
+            Snapshot
+        """
+        sequence = -1 if newer_than is None else newer_than.sequence
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._latest is None or self._latest.sequence <= sequence:
+                remaining = None if deadline is None else \
+                            deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise InstrumentError('No controller snapshot within'
+                                          ' %s s!' % timeout)
+                self._cond.wait(remaining)
+            return self._latest
+
+    def stop(self, timeout=2):
+        """Stop sampling and wait for the running burst to finish."""
+        self._stop.set()
+        if threading.current_thread() is not self._thread:
+            self._thread.join(timeout)
+
+    def sample(self):
+        """Run one burst and return the resulting Snapshot (without
+        publishing it).
+        """
+        start = time.time()
+        with self.pool.socket() as socket:
+            results = self.controller.TCP_Pipeline(socket, self._calls)
+        now = time.time()
+
+        failures = [name for (name, args), result in zip(self._calls, results)
+                    if result[0] != 0]
+        if failures and not self._failing:
+            logging.error('Controller snapshot could not read: %s'
+                          % ', '.join(sorted(set(failures))))
+        self._failing = bool(failures)
+
+        def value(result):
+            return result[1] if result[0] == 0 else None
+
+        if self.gpio is not None:
+            gpio, first = self.gpio.poll(start, 1.0 / self.rate), 0
+        else:
+            gpio, first = value(results[0]), 1
+        groups = []
+        for i, (motor, group) in enumerate(self._groups):
+            position, velocity, status = results[first + 3*i :
+                                                 first + 3 + 3*i]
+            groups.append(GroupState(motor, group, value(position),
+                                     value(velocity), value(status)))
+
+        sequence = 0 if self._latest is None else self._latest.sequence + 1
+        return Snapshot(sequence, now, gpio, tuple(groups))
+
+    def _run(self):
+        period = 1.0 / self.rate
+        while not self._stop.is_set():
+            start = time.time()
+            try:
+                snapshot = self.sample()
+            except InstrumentError:
+                pass
+            except Exception as e:
+                #Keep sampling, a dead thread would leave latest frozen.
+                if not self._failing:
+                    logging.exception('Controller snapshot failed: %r' % e)
+                self._failing = True
+            else:
+                with self._cond:
+                    self._latest = snapshot
+                    self._cond.notify_all()
+            self._stop.wait(max(0, period - (time.time() - start)))
@@ -0,0 +1,142 @@
+# nessiwheel.tcl
+#
+#  NESSI dewar wheel homing and slot moves, run on the XPS-C8 itself so a
+#  whole sequence costs a single TCLScriptExecuteAndWait round trip.  It is
+#  the controller side twin of NewportWheelHome / NewportWheelMove in
+#  instrument/actuators/newport.py and must stay equivalent to them.
+#
+#  Install it in /Admin/Public/Scripts with tools/xpsupload.py.
+#
+#  Arguments (tcl_argv):
+#    mode     home  -- walk at most count slots until the home switch is set
+#             move  -- walk exactly count slots
+#             back  -- walk exactly count slots backwards
+#             probe -- do nothing, used to check the script is installed
+#    group    XPS group, e.g. G1
+#    speed    Signed spin velocity of the switch search (always forwards)
+#    gap      Signed relative move done twice to approach the next slot; in
+#             back mode it overshoots the previous slot, whose switch is then
+#             searched forwards
+#    posmask  GPIO4.DI mask of the position switch
+#    posval   Position switch value (0/1) when on a slot
+#    homemask GPIO4.DI mask of the home switch
+#    homeval  Home switch value (0/1) when on the home slot
+#    count    Slot count, see mode
+#    lash     Signed backlash added to the first gap move of a slot (back)
+#
+#  Any failure raises a TCL error, which fails TCLScriptExecuteAndWait.
+#  A switch search gives up after searchpolls reads searchdelay ms apart
+#  (20 s, the old wheelcheck timeout), with the spin stopped.
+
+set mode [lindex $tcl_argv 0]
+if {$mode == "probe"} {
+    return
+}
+set group    [lindex $tcl_argv 1]
+set speed    [lindex $tcl_argv 2]
+set gap      [lindex $tcl_argv 3]
+set posmask  [lindex $tcl_argv 4]
+set posval   [lindex $tcl_argv 5]
+set homemask [lindex $tcl_argv 6]
+set homeval  [lindex $tcl_argv 7]
+set count    [lindex $tcl_argv 8]
+set lash     [lindex $tcl_argv 9]
+if {$lash == ""} {
+    set lash 0
+}
+set searchdelay 10
+set searchpolls 2000
+
+OpenConnection 5 socketID
+if {$socketID == -1} {
+    error "nessiwheel: could not open a controller connection"
+}
+
+proc check {code name} {
+    global socketID
+    if {$code != 0} {
+        TCP_CloseSocket $socketID
+        error "nessiwheel: $name failed with error $code"
+    }
+}
+
+# switchIs :  1 if the switch of mask reads val
+proc switchIs {mask val} {
+    global socketID
+    check [catch "GPIODigitalGet $socketID GPIO4.DI value"] GPIODigitalGet
+    return [expr {(($value & $mask) != 0) == $val}]
+}
+
+# search :  spin slowly until the position switch is reached, then stop
+proc search {} {
+    global socketID group speed posmask posval searchdelay searchpolls
+    check [catch "GroupSpinParametersSet $socketID $group $speed 800"] \
+        GroupSpinParametersSet
+    set polls 0
+    while {![switchIs $posmask $posval]} {
+        if {$polls == $searchpolls} {
+            catch "GroupSpinModeStop $socketID $group 1200"
+            TCP_CloseSocket $socketID
+            error "nessiwheel: position switch of $group not found"
+        }
+        after $searchdelay
+        incr polls
+    }
+    check [catch "GroupSpinModeStop $socketID $group 1200"] GroupSpinModeStop
+}
+
+# step :  approach the next slot quickly, then search its switch
+proc step {} {
+    global socketID group gap
+    for {set j 0} {$j < 2} {incr j} {
+        check [catch "GroupMoveRelative $socketID $group $gap"] \
+            GroupMoveRelative
+    }
+    search
+}
+
+# backstep :  overshoot the previous slot backwards, then search its switch
+proc backstep {} {
+    global socketID group gap lash
+    check [catch "GroupMoveRelative $socketID $group [expr {$gap + $lash}]"] \
+        GroupMoveRelative
+    check [catch "GroupMoveRelative $socketID $group $gap"] \
+        GroupMoveRelative
+    search
+}
+
+if {$mode == "home"} {
+    if {![switchIs $posmask $posval]} {
+        search
+    }
+    set i 0
+    while {![switchIs $homemask $homeval]} {
+        if {$i == $count} {
+            TCP_CloseSocket $socketID
+            error "nessiwheel: home switch of $group not found"
+        }
+        step
+        incr i
+    }
+} elseif {$mode == "move"} {
+    if {![switchIs $posmask $posval]} {
+        search
+        incr count -1
+    }
+    for {set i 0} {$i < $count} {incr i} {
+        step
+    }
+} elseif {$mode == "back"} {
+    if {![switchIs $posmask $posval]} {
+        search
+        incr count
+    }
+    for {set i 0} {$i < $count} {incr i} {
+        backstep
+    }
+} else {
+    TCP_CloseSocket $socketID
+    error "nessiwheel: unknown mode $mode"
+}
+
+TCP_CloseSocket $socketID
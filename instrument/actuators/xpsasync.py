@@ -0,0 +1,453 @@
+"""
+.. module:: xpsasync
+   :platform: Unix
+   :synopsis: Event driven XPS client running many commands from one thread.
+
+The blocking XPS_C8_drivers.XPS needs one socket *and* one thread per
+concurrent command, because the controller only answers a motion command
+once the motion is over.  XPSAsyncClient keeps several sockets to the
+controller and multiplexes them with select() in a single I/O thread.  Every
+API call returns at once with an XPSFuture; the wheels, the k-mirror and the
+FPA can then all be moved and polled concurrently:
+
+    client = XPSAsyncClient('10.90.20.1', 5001)
+    moves  = [client.GroupMoveAbsolute(group, [0.0])
+              for group in ('G1', 'G2', 'G3', 'G4', 'M')]
+    client.gather(moves, timeout=60)
+
+Commands are built and replies framed and parsed exactly like the blocking
+driver (XPS.signatures and XPSReplyReader), and results are the same lists.
+Per-command timeouts replace the SIGALRM based threadtools.timeout.
+"""
+
+import collections
+import itertools
+import logging
+import os
+import select
+import socket
+import threading
+import time
+
+from XPS_C8_drivers import XPS, XPSReplyReader
+from instrument.component import InstrumentError
+
+
+class XPSTimeoutError(InstrumentError):
+    """Raised when waiting on an XPSFuture times out."""
+
+
+class XPSCancelledError(InstrumentError):
+    """Raised when the result of a cancelled XPSFuture is requested."""
+
+
+class XPSFuture(object):
+    """Result of an XPS command submitted to an XPSAsyncClient.
+
+    Attributes:
+        name    -- API function name.
+        command -- Command string sent to the controller.
+        elapsed -- Seconds between sending the command and its reply.
+    """
+
+    def __init__(self, spec, args, timeout):
+        self.name      = spec.name
+        self.command   = spec.build(args)
+        self.elapsed   = None
+        self._spec     = spec
+        self._args     = args
+        self._timeout  = timeout
+        self._deadline = None
+        self._sent     = None
+        self._result   = None
+        self._done     = threading.Event()
+        self._cancelled = False
+        self._callbacks = []
+        self._lock     = threading.Lock()
+
+    def __repr__(self):
+        state = 'done' if self.done() else 'pending'
+        return '<XPSFuture %s %s>' % (self.command, state)
+
+    def done(self):
+        return self._done.is_set()
+
+    def cancelled(self):
+        return self._cancelled
+
+    def cancel(self):
+        """Cancel the command. If it was already sent, the motion keeps
+        going on the controller (use GroupMoveAbort for that) but its
+        reply is discarded.
+
+        Returns:
+            True unless the command had already finished.
+        """
+        with self._lock:
+            if self.done():
+                return False
+            self._cancelled = True
+        self._finish(None)
+        return True
+
+    def result(self, timeout=None):
+        """Wait for and return the reply, as a list like the blocking
+        driver returns ([error, values...]).
+
+        Raises:
+            XPSTimeoutError, XPSCancelledError
+        """
+        if not self._done.wait(timeout):
+            raise XPSTimeoutError('%s did not complete within %s s!'
+                                  % (self.name, timeout))
+        if self._cancelled:
+            raise XPSCancelledError('%s was cancelled.' % self.name)
+        return self._result
+
+    def add_done_callback(self, fn):
+        """Call fn(future) once the command finishes. Callbacks run in the
+        client I/O thread and must not block.
+        """
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _finish(self, result):
+        with self._lock:
+            if self.done():
+                return
+            self._result = result
+            if self._sent is not None:
+                self.elapsed = time.time() - self._sent
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                logging.exception('XPSFuture callback failed.')
+
+
+class _Channel(object):
+    """One controller socket and the command it is waiting on."""
+
+    def __init__(self, sock):
+        self.sock   = sock
+        self.reader = XPSReplyReader(sock)
+        self.future = None
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+class XPSAsyncClient(object):
+    """Issues XPS commands concurrently from one I/O thread.
+
+    Any function of the XPS_API table is available as a method returning
+    an XPSFuture, e.g. client.GroupPositionCurrentGet('M', 1). The extra
+    keyword argument timeout overrides the default command timeout.
+
+    Each socket carries one command at a time, so up to `sockets` commands
+    run on the controller at once; further ones are queued.
+
+    A lost socket is reconnected in the background, with the backoff of the
+    blocking driver (XPS.RECONNECT_BACKOFF). While every socket is lost the
+    queued commands fail with [-2, ''] instead of waiting for one.
+    """
+
+    def __init__(self, host, port, sockets=8, timeout=None,
+                 connect_timeout=1):
+        """Connect the sockets and start the I/O thread.
+
+        Arguments:
+            host            -- Controller address -> str
+            port            -- Controller port -> int
+            sockets         -- Number of sockets, i.e. commands that may
+                               be in flight at once -> int
+            timeout         -- Default command timeout in seconds, None
+                               for no timeout -> float
+            connect_timeout -- Timeout of a socket connection -> float
+
+        Raises:
+            InstrumentError
+        """
+        self.host            = host
+        self.port            = port
+        self.timeout         = timeout
+        self.connect_timeout = connect_timeout
+
+        self._lock    = threading.Lock()
+        self._pending = collections.deque()
+        self._idle    = []
+        self._busy    = []
+        self._closed  = False
+
+        self._wake_r, self._wake_w = os.pipe()
+        self._thread  = None
+
+        channels = [None] * sockets
+
+        def connect(i):
+            try:
+                channels[i] = _Channel(self._connect())
+            except socket.error:
+                pass
+
+        threads = [threading.Thread(target=connect, args=(i,))
+                   for i in range(sockets)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self._idle = [channel for channel in channels if channel is not None]
+        if len(self._idle) != sockets:
+            self.close()
+            raise InstrumentError('XPS asynchronous client could not connect'
+                                  ' to %s:%d!' % (host, port))
+
+        self._thread = threading.Thread(name='XPSAsyncClient',
+                                        target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port),
+                                        self.connect_timeout)
+        sock.setblocking(1)
+        return sock
+
+    def __getattr__(self, name):
+        spec = XPS.signatures.get(name)
+        if spec is None:
+            raise AttributeError(name)
+
+        def method(*args, **kwargs):
+            timeout = kwargs.pop('timeout', self.timeout)
+            if kwargs:
+                args = spec.bind(args, kwargs)
+            return self.call(name, args, timeout)
+
+        method.__name__ = name
+        method.__doc__  = spec.signature + ' :  ' + spec.description
+        return method
+
+    def call(self, name, args=(), timeout=None):
+        """Submit one API function.
+
+        Arguments:
+            name    -- API function name, e.g. 'GroupMoveRelative' -> str
+            args    -- Its arguments, without the socket -> tuple
+            timeout -- Seconds before the command fails with [-2, ''] -> float
+
+        Returns:
+            XPSFuture
+        """
+        spec = XPS.signatures[name]
+        args = tuple(args)
+        if len(args) != spec.nbParams:
+            raise TypeError('%s() takes %d arguments (%d given)'
+                            % (name, spec.nbParams, len(args)))
+        future = XPSFuture(spec, args, timeout)
+        with self._lock:
+            if self._closed:
+                raise InstrumentError('XPS asynchronous client is closed!')
+            self._pending.append(future)
+        self._wake()
+        return future
+
+    def gather(self, futures, timeout=None):
+        """Wait for several futures.
+
+        Arguments:
+            futures -- XPSFutures to wait for -> [XPSFuture]
+            timeout -- Seconds to wait for all of them -> float
+
+        Raises:
+            XPSTimeoutError
+
+        Returns:
+            Their results, in order -> [list]
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        results  = []
+        for future in futures:
+            remaining = None if deadline is None else \
+                        max(0, deadline - time.time())
+            results.append(future.result(remaining))
+        return results
+
+    def close(self):
+        """Stop the I/O thread and close the sockets. Commands still
+        pending or in flight are cancelled.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            futures  = list(self._pending) + [channel.future for channel
+                                              in self._busy]
+            self._pending.clear()
+        for future in futures:
+            if future is not None:
+                future.cancel()
+
+        if self._thread is None:
+            self._shutdown()
+        else:
+            self._wake()
+            if threading.current_thread() is not self._thread:
+                self._thread.join()
+
+    def _shutdown(self):
+        for channel in self._idle + self._busy:
+            channel.sock.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, 'x')
+        except OSError:
+            pass
+
+    def _run(self):
+        """I/O loop: send queued commands on idle sockets, read replies,
+        and expire commands past their deadline.
+        """
+        while True:
+            with self._lock:
+                if self._closed:
+                    break
+                failed = self._dispatch()
+                busy   = list(self._busy)
+            for future in failed:
+                future._finish([-2, ''])
+
+            now       = time.time()
+            deadlines = [channel.future._deadline for channel in busy
+                         if channel.future._deadline is not None]
+            wait      = max(0, min(deadlines) - now) if deadlines else None
+
+            readable = select.select([self._wake_r] + busy, [], [], wait)[0]
+            for channel in readable:
+                if channel is self._wake_r:
+                    os.read(self._wake_r, 4096)
+                else:
+                    self._receive(channel)
+
+            now = time.time()
+            for channel in busy:
+                future = channel.future
+                if future is not None and future._deadline is not None \
+                   and now >= future._deadline:
+                    self._drop(channel, future)
+
+        self._shutdown()
+
+    def _dispatch(self):
+        """Send pending commands on idle sockets. Must hold the lock.
+
+        Returns:
+            The pending commands to fail, when no socket is left
+            -> [XPSFuture]
+        """
+        if not self._idle and not self._busy:
+            failed = list(self._pending)
+            self._pending.clear()
+            return failed
+        while self._pending and self._idle:
+            future = self._pending.popleft()
+            if future.cancelled():
+                continue
+            channel = self._idle.pop()
+            try:
+                channel.sock.sendall(future.command)
+            except socket.error:
+                self._pending.appendleft(future)
+                self._replace(channel)
+                continue
+            future._sent = time.time()
+            if future._timeout is not None:
+                future._deadline = future._sent + future._timeout
+            channel.future = future
+            self._busy.append(channel)
+        return []
+
+    def _receive(self, channel):
+        future = channel.future
+        try:
+            channel.reader.fill()
+        except socket.error:
+            self._drop(channel, future)
+            return
+
+        reply = channel.reader.nextReply()
+        if reply is None:
+            return
+
+        with self._lock:
+            channel.future = None
+            self._busy.remove(channel)
+            self._idle.append(channel)
+
+        error, _, returnedString = reply.partition(',')
+        error = int(error)
+        if error != 0:
+            future._finish([error, returnedString])
+        else:
+            future._finish(future._spec.parse(error, returnedString,
+                                              future._args))
+
+    def _drop(self, channel, future):
+        """Fail the command of a timed out or broken socket the way the
+        blocking driver does ([-2, '']) and replace the socket, whose
+        stream is now out of sync.
+        """
+        with self._lock:
+            if channel in self._busy:
+                self._busy.remove(channel)
+            channel.future = None
+            self._replace(channel)
+        if future is not None:
+            future._finish([-2, ''])
+
+    def _replace(self, channel):
+        """Close a socket and reconnect it in the background, retrying with
+        the XPS.RECONNECT_BACKOFF delays until it succeeds or the client is
+        closed. Must hold the lock.
+        """
+        channel.sock.close()
+
+        def reconnect():
+            start = time.time()
+            for attempt in itertools.count():
+                if self._closed:
+                    return
+                try:
+                    fresh = _Channel(self._connect())
+                    break
+                except socket.error:
+                    if attempt == 0:
+                        logging.error('XPS asynchronous client lost a socket'
+                                      ' to %s:%d, reconnecting.'
+                                      % (self.host, self.port))
+                    backoff = XPS.RECONNECT_BACKOFF
+                    time.sleep(backoff[min(attempt, len(backoff) - 1)])
+            if attempt:
+                logging.info('XPS asynchronous client reconnected a socket in'
+                             ' %.3f s.' % (time.time() - start))
+            with self._lock:
+                if self._closed:
+                    fresh.sock.close()
+                    return
+                self._idle.append(fresh)
+            self._wake()
+
+        thread = threading.Thread(target=reconnect)
+        thread.daemon = True
+        thread.start()
+        #The I/O loop fails the queued commands if no socket is left.
+        self._wake()
@@ -0,0 +1,286 @@
+"""
+.. module:: xpspool
+   :platform: Unix
+   :synopsis: Pool of TCP sockets to the Newport XPS controller.
+
+"""
+
+import collections
+import contextlib
+import logging
+import threading
+import time
+
+from instrument.component import InstrumentError
+
+
+class XPSConnectionPool(object):
+    """Hands out XPS sockets on demand.
+
+    Every XPS call blocks its socket until the controller answers (a
+    GroupMoveAbsolute answers when the motion is over), so a socket must be
+    held exclusively for the duration of a call.  Instead of giving every
+    component a fixed slice of pre-opened sockets, components check a socket
+    out for one operation and check it back in afterwards.
+
+    The initial sockets are connected concurrently, so startup costs one
+    connect round trip. When every socket is busy the pool opens another
+    one, up to max_size, and after that callers wait for a checkin.
+
+    Lost connections are reconnected by the driver under the same socket
+    id. With a heartbeat the pool also pings its idle sockets (TestTCP)
+    every `heartbeat` seconds, so a dead connection is found and
+    reconnected before a component needs it. Sockets held for good, like
+    the dispatcher lanes, are pinged by their holders (see attach).
+
+    Read-only queries and pings time out after query_timeout seconds, so a
+    half-open connection is found instead of blocking its caller; motion
+    calls never time out.
+
+    Attributes:
+        controller -- XPS instance the sockets belong to.
+        host       -- Controller address.
+        port       -- Controller port.
+        timeout    -- Connection timeout in seconds.
+        max_size   -- Maximum number of sockets the pool may open.
+        heartbeat  -- Seconds between two checks of the idle sockets.
+        query_timeout -- Reply timeout of the read-only queries, seconds.
+    """
+
+    def __init__(self, controller, host, port, timeout=1, size=8,
+                 max_size=40, heartbeat=None, query_timeout=None):
+        """Build the pool and connect the initial sockets.
+
+        Arguments:
+            controller -- XPS instance -> XPS_C8_drivers.XPS
+            host       -- Controller address -> str
+            port       -- Controller port -> int
+            timeout    -- Connection timeout in seconds -> float
+            size       -- Number of sockets to open now -> int
+            max_size   -- Maximum number of sockets -> int
+            heartbeat  -- Seconds between two checks of the idle sockets,
+                          None for no checks -> float
+            query_timeout -- Reply timeout of the read-only queries, None
+                          waits forever -> float
+
+        Raises:
+            InstrumentError
+        """
+        self.controller = controller
+        self.host       = host
+        self.port       = port
+        self.timeout    = timeout
+        self.max_size   = max_size
+        self.query_timeout = query_timeout
+
+        self._free      = collections.deque()
+        self._in_use    = set()
+        self._opening   = 0
+        self._cond      = threading.Condition(threading.Lock())
+
+        self._peak      = 0
+        self._waits     = 0
+        self._checkouts = 0
+        self._holders   = []
+
+        self._connect(min(size, max_size))
+
+        self.heartbeat  = heartbeat
+        self._closed    = threading.Event()
+        if heartbeat:
+            thread = threading.Thread(name='XPSPoolHeartbeat',
+                                      target=self._beat)
+            thread.daemon = True
+            thread.start()
+
+    def _connect(self, count):
+        """Open count sockets concurrently and add them to the free list.
+        Raises InstrumentError (and closes the sockets that did connect)
+        if any of them fails.
+        """
+        results = [-1] * count
+
+        def connect(i):
+            results[i] = self.controller.TCP_ConnectToServer(
+                self.host, self.port, self.timeout)
+
+        start   = time.time()
+        threads = [threading.Thread(target=connect, args=(i,))
+                   for i in range(count)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join(self.timeout + 1)
+
+        opened = [socket for socket in results if socket != -1]
+        for socket in opened:
+            self.controller.TCP_SetQueryTimeout(socket, self.query_timeout)
+        if len(opened) != count:
+            for socket in opened:
+                self.controller.TCP_CloseSocket(socket)
+            raise InstrumentError('Only %d of %d Newport sockets could be'
+                                  ' opened to %s:%d!' % (len(opened), count,
+                                                         self.host,
+                                                         self.port))
+        with self._cond:
+            self._free.extend(opened)
+            self._cond.notify_all()
+
+        logging.debug('Opened %d XPS sockets in %.3f s.'
+                      % (count, time.time() - start))
+
+    @property
+    def size(self):
+        """Number of sockets opened (or being opened) by the pool."""
+        return len(self._free) + len(self._in_use) + self._opening
+
+    def checkout(self, timeout=None):
+        """Take a socket out of the pool.
+
+        Arguments:
+            timeout -- Seconds to wait for a socket when the pool is
+                       exhausted. None waits forever.
+
+        Raises:
+            InstrumentError
+
+        Returns:
+            socket -- XPS socket id -> int
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        waited   = False
+        with self._cond:
+            while not self._free:
+                if self.size < self.max_size:
+                    self._opening += 1
+                    break
+                if not waited:
+                    self._waits += 1
+                    waited = True
+                remaining = None if deadline is None else \
+                            deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise InstrumentError('No XPS socket became available'
+                                          ' within %s s!' % timeout)
+                self._cond.wait(remaining)
+            else:
+                return self._take(self._free.popleft())
+
+        # Grow the pool outside the lock; one connect round trip.
+        try:
+            self._connect(1)
+        finally:
+            with self._cond:
+                self._opening -= 1
+        return self.checkout(timeout)
+
+    def _take(self, socket):
+        """Mark a socket as in use. Must hold the condition lock."""
+        self._in_use.add(socket)
+        self._checkouts += 1
+        self._peak = max(self._peak, len(self._in_use))
+        return socket
+
+    def checkin(self, socket):
+        """Give a socket back to the pool.
+
+        Arguments:
+            socket -- XPS socket id from checkout -> int
+        """
+        with self._cond:
+            self._in_use.discard(socket)
+            self._free.append(socket)
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def socket(self, timeout=None):
+        """Context manager holding one socket for the enclosed block.
+
+            with pool.socket() as socket:
+                controller.GroupKill(socket, 'G1')
+        """
+        socket = self.checkout(timeout)
+        try:
+            yield socket
+        finally:
+            self.checkin(socket)
+
+    def attach(self, holder):
+        """Have the heartbeat call holder.ping() to check a socket the
+        holder keeps checked out. ping must not block, it only asks the
+        holder's own thread to ping its socket.
+        """
+        with self._cond:
+            self._holders.append(holder)
+
+    def detach(self, holder):
+        """Stop pinging the socket of a holder, see attach."""
+        with self._cond:
+            if holder in self._holders:
+                self._holders.remove(holder)
+
+    def check(self):
+        """Ping the idle sockets, and ask the holders of the other ones to
+        ping theirs. Dead ones start reconnecting (see XPS.TCP_Ping).
+
+        Returns:
+            Number of idle sockets found dead -> int
+        """
+        with self._cond:
+            holders = list(self._holders)
+        for holder in holders:
+            try:
+                holder.ping()
+            except Exception as e:
+                logging.error('Unable to ping the XPS socket of %s: %s'
+                              % (holder, e))
+        with self._cond:
+            sockets = list(self._free)
+        dead = 0
+        for socket in sockets:
+            with self._cond:
+                if socket not in self._free:
+                    continue
+                self._free.remove(socket)
+                self._in_use.add(socket)
+            try:
+                if not self.controller.TCP_Ping(socket):
+                    dead += 1
+            finally:
+                self.checkin(socket)
+        if dead:
+            logging.warning('%d idle XPS sockets were dead.' % dead)
+        return dead
+
+    def _beat(self):
+        while not self._closed.wait(self.heartbeat):
+            self.check()
+
+    @property
+    def utilisation(self):
+        """Snapshot of the pool usage.
+
+        Returns:
+            dict with the keys size, max_size, in_use, free, peak (most
+            sockets in use at once), checkouts and waits (checkouts that
+            had to wait for a checkin).
+        """
+        with self._cond:
+            return {'size'      : self.size,
+                    'max_size'  : self.max_size,
+                    'in_use'    : len(self._in_use),
+                    'free'      : len(self._free),
+                    'peak'      : self._peak,
+                    'checkouts' : self._checkouts,
+                    'waits'     : self._waits}
+
+    def close(self):
+        """Close every socket of the pool, including checked out ones."""
+        self._closed.set()
+        with self._cond:
+            sockets = list(self._free) + list(self._in_use)
+            self._free.clear()
+            self._in_use.clear()
+        for socket in sockets:
+            self.controller.TCP_CloseSocket(socket)
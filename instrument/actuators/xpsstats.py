@@ -0,0 +1,262 @@
+"""
+.. module:: xpsstats
+   :platform: Unix
+   :synopsis: XPS command statistics and periodic dump of the controller load.
+
+Importing the module installs an XPSStats as XPS.stats, the driver then
+records every API call in it.
+"""
+
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+
+from XPS_C8_drivers import XPS
+
+#Upper bounds of the latency histogram buckets, 10 us to ~84 s [s]
+LATENCY_BUCKETS = tuple([1e-5 * 2 ** i for i in range(24)])
+
+#Fields of ControllerMotionKernelTimeLoadGet
+KERNEL_LOAD = ('cpu_total', 'corrector', 'profiler', 'servitudes')
+#Fields of ControllerMotionKernelPeriodMinMaxGet
+KERNEL_PERIOD = ('min_corrector', 'max_corrector', 'min_profiler',
+                 'max_profiler', 'min_servitudes', 'max_servitudes')
+
+
+class XPSCommandStats(object):
+    """Counters of one API function on one socket."""
+
+    def __init__(self):
+        self.lock      = threading.Lock()
+        self.count     = 0
+        self.errors    = {}
+        self.bytes_out = 0
+        self.bytes_in  = 0
+        self.total     = 0.0
+        self.min       = None
+        self.max       = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, elapsed, error, bytes_out, bytes_in):
+        """Count one call.
+
+        Arguments:
+            elapsed   -- Seconds from the command to its reply -> float
+            error     -- XPS error code, 0 on success -> int
+            bytes_out -- Bytes sent -> int
+            bytes_in  -- Bytes received -> int
+        """
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, elapsed)
+        with self.lock:
+            self.count += 1
+            if error != 0:
+                self.errors[error] = self.errors.get(error, 0) + 1
+            self.bytes_out += bytes_out
+            self.bytes_in  += bytes_in
+            self.total     += elapsed
+            if self.min is None or elapsed < self.min:
+                self.min = elapsed
+            self.max = max(self.max, elapsed)
+            self.histogram[bucket] += 1
+
+    def merge(self, other):
+        """Add the counters of another XPSCommandStats."""
+        with other.lock:
+            self.count += other.count
+            for error, count in other.errors.items():
+                self.errors[error] = self.errors.get(error, 0) + count
+            self.bytes_out += other.bytes_out
+            self.bytes_in  += other.bytes_in
+            self.total     += other.total
+            if other.min is not None and (self.min is None or
+                                          other.min < self.min):
+                self.min = other.min
+            self.max = max(self.max, other.max)
+            self.histogram = [a + b for a, b in zip(self.histogram,
+                                                    other.histogram)]
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of the
+        calls, None without calls.
+        """
+        rank = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.histogram):
+            seen += count
+            if count and seen >= rank:
+                if bucket == len(LATENCY_BUCKETS):
+                    return self.max
+                return min(LATENCY_BUCKETS[bucket], self.max)
+        return None
+
+    def summary(self):
+        """Counters as a JSON friendly dict, latencies in seconds."""
+        return {'count'     : self.count,
+                'errors'    : dict(self.errors),
+                'bytes_out' : self.bytes_out,
+                'bytes_in'  : self.bytes_in,
+                'mean'      : self.total / self.count if self.count else None,
+                'min'       : self.min,
+                'max'       : self.max if self.count else None,
+                'p50'       : self.percentile(0.5),
+                'p90'       : self.percentile(0.9),
+                'p99'       : self.percentile(0.99),
+                'histogram' : list(self.histogram)}
+
+
+class XPSStats(object):
+    """Latency histogram, call count, error codes and bytes in/out of every
+    API function, per socket.
+
+    Recording costs one dict lookup, one bisect and one uncontended lock per
+    call. The latency is the time from sending the command to receiving its
+    reply, so it includes the network, the controller and, for motion
+    commands, the motion itself.
+
+    Attributes:
+        enabled -- False stops the recording.
+        since   -- time.time() of the last reset.
+    """
+
+    def __init__(self):
+        self.enabled  = True
+        self.since    = time.time()
+        self._records = {}
+        self._lock    = threading.Lock()
+
+    def record(self, name, socket, elapsed, error, bytes_out, bytes_in):
+        """Count one call of an API function, see XPSCommandStats.add."""
+        key   = (name, socket)
+        entry = self._records.get(key)
+        if entry is None:
+            with self._lock:
+                entry = self._records.setdefault(key, XPSCommandStats())
+        entry.add(elapsed, error, bytes_out, bytes_in)
+
+    def reset(self):
+        """Drop every counter."""
+        with self._lock:
+            self._records = {}
+            self.since    = time.time()
+
+    def commands(self):
+        """Summary per API function, all sockets merged.
+
+        Returns:
+            {name: XPSCommandStats.summary()}
+        """
+        merged = {}
+        for (name, socket), entry in self._records.items():
+            merged.setdefault(name, XPSCommandStats()).merge(entry)
+        return dict((name, entry.summary())
+                    for name, entry in merged.items())
+
+    def sockets(self):
+        """Summary per API function and socket.
+
+        Returns:
+            {(name, socket): XPSCommandStats.summary()}
+        """
+        return dict((key, entry.summary())
+                    for key, entry in self._records.items())
+
+    def report(self):
+        """Text table of commands(), slowest mean first."""
+        lines = ['%-40s %8s %6s %10s %10s %10s %10s %10s'
+                 % ('function', 'calls', 'errors', 'mean [ms]', 'p50 [ms]',
+                    'p99 [ms]', 'max [ms]', 'bytes')]
+        rows  = sorted(self.commands().items(),
+                       key=lambda item: -(item[1]['mean'] or 0))
+        for name, summary in rows:
+            lines.append('%-40s %8d %6d %10.3f %10.3f %10.3f %10.3f %10d'
+                         % (name, summary['count'],
+                            sum(summary['errors'].values()),
+                            1e3 * summary['mean'], 1e3 * summary['p50'],
+                            1e3 * summary['p99'], 1e3 * summary['max'],
+                            summary['bytes_out'] + summary['bytes_in']))
+        return '\n'.join(lines)
+
+
+#Statistics of every XPS instance, recorded by the driver
+XPS.stats = XPSStats()
+
+
+class XPSStatsLogger(object):
+    """Samples the controller motion kernel load and appends it, together
+    with XPS.stats, to a JSON lines file at a fixed period.
+
+    Each line holds the time, the kernel load and min/max periods since the
+    previous line (the min/max are reset after every sample), and the
+    per-command summaries of XPS.stats (see XPSStats.commands), so client
+    latency can be lined up with controller load.
+    """
+
+    def __init__(self, controller, pool, logdir='logfiles', period=60):
+        """Start the logger thread.
+
+        Arguments:
+            controller -- XPS instance -> XPS_C8_drivers.XPS
+            pool       -- Socket pool -> XPSConnectionPool
+            logdir     -- Directory of the xpsstats.log file -> str
+            period     -- Seconds between two samples -> float
+        """
+        self.controller = controller
+        self.pool       = pool
+        self.period     = float(period)
+        if not os.path.isdir(logdir):
+            os.makedirs(logdir)
+        self.path       = os.path.join(logdir, 'xpsstats.log')
+
+        self._stop   = threading.Event()
+        self._thread = threading.Thread(name='XPSStatsLogger',
+                                        target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def kernel(self):
+        """Read and reset the controller motion kernel load.
+
+        Returns:
+            dict of KERNEL_LOAD and KERNEL_PERIOD values, None for fields
+            that could not be read.
+        """
+        with self.pool.socket() as socket:
+            load   = self.controller.ControllerMotionKernelTimeLoadGet(socket)
+            period = self.controller.ControllerMotionKernelPeriodMinMaxGet(
+                socket)
+            self.controller.ControllerMotionKernelPeriodMinMaxReset(socket)
+
+        sample = {}
+        for names, ret in ((KERNEL_LOAD, load), (KERNEL_PERIOD, period)):
+            values = ret[1:] if ret[0] == 0 else [None] * len(names)
+            sample.update(zip(names, values))
+        return sample
+
+    def dump(self):
+        """Append one line to the log file."""
+        try:
+            kernel = self.kernel()
+        except Exception as e:
+            logging.error('Unable to sample the XPS kernel load: %s' % e)
+            kernel = None
+
+        line = {'time'     : time.time(),
+                'since'    : XPS.stats.since,
+                'kernel'   : kernel,
+                'commands' : XPS.stats.commands()}
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(line) + '\n')
+
+    def stop(self):
+        """Write a last line and stop."""
+        self._stop.set()
+        if threading.current_thread() is not self._thread:
+            self._thread.join(5)
+
+    def _run(self):
+        while not self._stop.wait(self.period):
+            self.dump()
+        self.dump()
@@ -1,15 +1,18 @@
+import contextlib
 import functools
 import logging
-from threading import Lock
+from threading import Condition, Lock
 
 
 class InstrumentComponent(object):
     """Abstract component to the NESSI instrument.
 
     Attributes:
-        lock       -- Thread lock for the object. Most components 
-                      interface with some form of hardware, so 
-                      synchronization becomes important.
+        lock       -- Reader/writer lock for the object (see RWLock).
+                      Most components interface with some form of
+                      hardware, so synchronization becomes important.
+                      `with self.lock:` is exclusive, `with
+                      self.lock.read():` may be shared by readers.
         instrument -- Copy of the instrument.
         
     """
@@ -21,13 +24,85 @@ class InstrumentComponent(object):
         Arguments:
            instrument -- copy of the NESSI instrument.
         """
-        self.lock       = Lock()
+        self.lock       = RWLock()
         self.instrument = instrument
         
     def kill(self):
         """Called by a kill_all."""
         pass
 
+class RWLock(object):
+    """Reader/writer lock. Any number of readers may hold it at once, a
+    writer holds it alone. Waiting writers go first, so a steady stream
+    of readers cannot starve them. Not reentrant.
+
+    Used directly as a context manager it is taken for writing, so it
+    can stand in for a threading.Lock:
+
+        with component.lock:            #exclusive
+            ...
+        with component.lock.read():     #shared
+            ...
+    """
+
+    def __init__(self):
+        self._cond    = Condition(Lock())
+        self._readers = 0
+        self._writer  = False
+        self._waiting = 0
+
+    def acquire_read(self):
+        with self._cond:
+            while self._writer or self._waiting:
+                self._cond.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        with self._cond:
+            self._waiting += 1
+            try:
+                while self._writer or self._readers:
+                    self._cond.wait()
+            finally:
+                self._waiting -= 1
+            self._writer = True
+
+    def release_write(self):
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def read(self):
+        """Hold the lock for reading for the enclosed block."""
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextlib.contextmanager
+    def write(self):
+        """Hold the lock for writing for the enclosed block."""
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+    def __enter__(self):
+        self.acquire_write()
+        return self
+
+    def __exit__(self, *exc):
+        self.release_write()
+
 class InstrumentError(Exception):
     """Base class for all exception that occur in the instrument.
     
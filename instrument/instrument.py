@@ -11,6 +11,8 @@ import logging
 import math
 import sys
 import os
+import threading
+import time
 #os.environ["NUMERIX"] = "numarray" # make pyfits use numarray
 
 from configobj import ConfigObj
@@ -21,13 +23,18 @@ import pywcs
 import PyGuide
 
 from   actuators.dewarwheel import DewarWheel
+from   actuators.gpio       import GPIOSampler
 from   actuators.kmirror    import KMirror
+import actuators.newport    as newport
+from   actuators.snapshot   import ControllerSnapshot
 from   actuators.thorlabs   import ThorlabsController
 import actuators.XPS_C8_drivers as xps
+from   actuators.xpspool    import XPSConnectionPool
+from   actuators.xpsstats   import XPSStatsLogger
 from   component            import InstrumentError, KillAllError
+from   keywordcache         import KeywordCache, KeywordSource
 from   sensors.lakeshore    import LakeshoreController
 from   sensors.flicam       import FLICam
-from   threadtools          import timeout, TimeoutError
 from   telescope.telescope  import Telescope
 
 class Instrument(object):
@@ -48,8 +55,15 @@ class Instrument(object):
         Configuration object.
     newport : xps Object
         Newport XPS controller.
-    open_sockets : [int]
-        List of open Newport Sockets.
+    xps_pool : XPSConnectionPool
+        Pool of Newport sockets, checked out by the components.
+    snapshot : ControllerSnapshot
+        Periodic snapshot of every Newport group and of the GPIO switches.
+    gpio : GPIOSampler
+        Fast shared sampler of the GPIO switches, used by the switch
+        checks of the wheel and FPA motions.
+    xps_stats : XPSStatsLogger
+        Periodic dump of the XPS command statistics and controller load.
     kmirror : KMirror Object
         Kmirro interface.
     mask_wheel : DewarWheel
@@ -67,6 +81,8 @@ class Instrument(object):
         Temperature sensor interface.
     guide_cam : FLICam
         Guide camera interface.
+    keyword_cache : KeywordCache
+        FITS keywords refreshed in the background, read by keywords.
 
     Methods
     -------
@@ -93,12 +109,17 @@ class Instrument(object):
         #Config object
         ################################################################
         self.cfg = cfg
+        newport.settings.watch(float(cfg['general'].get('settings reload',
+                                                         5)))
         
         #Define list of actuators
         ################################################################
         #Newport things
         self.newport       = None
-        self.open_sockets  = None
+        self.xps_pool      = None
+        self.snapshot      = None
+        self.gpio          = None
+        self.xps_stats     = None
         self.kmirror       = None        
         self.mask_wheel    = None
         self.filter1_wheel = None
@@ -117,10 +138,18 @@ class Instrument(object):
         ################################################################
         self.telescope = None
 
+        #FITS keywords, see keywords
+        ################################################################
+        self.keyword_cache = None
+
         #Init components
         ################################################################
         self._init_components()
 
+        #FITS keywords, refreshed in the background
+        ################################################################
+        self._init_keywords()
+
 
     def connectTelescope(self):
         try:
@@ -148,74 +177,46 @@ class Instrument(object):
         newport_good = False    #Flag for if the newport was initialized
 
         self.newport = xps.XPS()
-        self.open_sockets=[]
         logging.debug('Newport initialized!')
 
-        #Fill Sockets
+        #Open socket pool
         ################################################################
         try:
-            self._fill_socket_list()
-            logging.debug('Sockets filled!')
+            self._open_socket_pool()
+            logging.debug('Sockets opened!')
             newport_good = True
-        except TimeoutError:
-            logging.debug('Newport Sockets timed out!')
-            sys.exc_clear()
         except InstrumentError:
             logging.debug('Newport errored out initializing sockets!')
             sys.exc_clear()
 
-
-
         if newport_good:
-            #Kmirror
+            #Switch sampler
             ################
             try:
-                self.kmirror        = KMirror(self, self.newport, 
-                                             self.open_sockets[20:])
-                logging.debug('K-Mirror initialized!')
+                self.gpio = GPIOSampler(self.newport, self.xps_pool,
+                                        newport.settings)
+                newport.gpio_samplers[self.newport] = self.gpio
+                logging.debug('GPIO sampler started!')
             except InstrumentError:
                 sys.exc_clear()
 
-
-            #Mask
-            #################
-            try:
-                self.mask_wheel    = DewarWheel(self, 'mask',
-                                                self.open_sockets[0:4],
-                                                self.cfg['mask']['pos'])
-                logging.debug('Mask wheel initialized!')
-            except InstrumentError:
-                sys.exc_clear()
-            
-            #Filter 1
+            #Status snapshot, its GPIO4.DI word comes from the sampler
             ################
-            try:
-                self.filter1_wheel = DewarWheel(self, 'filter1',
-                                                self.open_sockets[5:9],
-                                                self.cfg['filter1']['pos'])
-                logging.debug('Filter1 wheel initialized!')
-            except InstrumentError:
-                sys.exc_clear()
+            self.snapshot = ControllerSnapshot(self.newport, self.xps_pool,
+                                               self.cfg, gpio=self.gpio)
+            logging.debug('Controller snapshot started!')
 
-            #Filter 2
+            #Statistics
             ################
-            try:
-                self.filter2_wheel = DewarWheel(self, 'filter2',
-                                                self.open_sockets[10:14],
-                                                self.cfg['filter2']['pos'])
-                logging.debug('Filter2 wheel initialized!')
-            except InstrumentError:
-                sys.exc_clear()
+            general        = self.cfg['general']
+            self.xps_stats = XPSStatsLogger(
+                self.newport, self.xps_pool,
+                logdir=general.get('stats dir', 'logfiles'),
+                period=float(general.get('stats period', 60)))
 
-            #Grism
+            #Kmirror and wheels, concurrently
             ################
-            try:
-                self.grism_wheel   = DewarWheel(self, 'grism',
-                                                self.open_sockets[15:19],
-                                                self.cfg['grism']['pos'])
-                logging.debug('Grism wheel initialized!')
-            except InstrumentError:
-                sys.exc_clear()
+            self._init_motors()
 
                 
         #Thorlabs components
@@ -252,65 +253,150 @@ class Instrument(object):
 
 
 
+    def _init_motors(self):
+        """Initialize the k-mirror and the dewar wheels concurrently.
+
+        Each motor is built in a thread of its own. Its constructor kills,
+        initializes and home searches its group on its own sockets, so the
+        groups come up together and start-up takes as long as the slowest
+        group instead of the sum. A motor that does not initialize is left
+        None and logged on its own, as the other components are.
+
+        Raises:
+            Any unexpected error of a motor, once every motor is done.
+
+        Returns:
+            Seconds taken by each motor, None for a failed one
+            -> {str: float}
+        """
+        motors = [('kmirror', 'K-Mirror',
+                   lambda: KMirror(self, self.newport, self.xps_pool))]
+        for name, attribute in self.WHEELS:
+            motors.append((attribute, '%s wheel' % name.capitalize(),
+                           lambda name=name: DewarWheel(
+                               self, name, self.xps_pool,
+                               self.cfg[name]['pos'])))
+
+        timing = {}
+        errors = []
+        start  = time.time()
+
+        def build(attribute, label, factory):
+            try:
+                setattr(self, attribute, factory())
+                timing[attribute] = time.time() - start
+                logging.debug('%s initialized in %.2f s!'
+                              % (label, timing[attribute]))
+            except InstrumentError:
+                timing[attribute] = None
+                logging.error('%s did not initialize (%.2f s)!'
+                              % (label, time.time() - start))
+            except Exception:
+                timing[attribute] = None
+                errors.append(sys.exc_info())
+
+        threads = [threading.Thread(name='init-%s' % motor[0],
+                                    target=build, args=motor)
+                   for motor in motors]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        logging.info('Newport motors initialized in %.2f s: %s'
+                     % (time.time() - start, timing))
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return timing
+
+    #FITS keywords that never change
+    STATIC_KEYWORDS = {
+        "OBSERVER" : "Observer",    #TODO: Get from somewhere
+        "INST"     : "NESSI",       
+        "TELESCOP" : "MRO 2.4m",    #TODO:Get from indi?
+        "FILENAME" : "default",     #TODO:Do these later?
+        "IMGTYPE"  : "imgtyp",      
+        "TELFOCUS" : "TCS down",    #TODO:Where is?
+        "GDATE"    : "TCS down",    #TODO:Generate
+        #"WINDVEL"  : self.telescope.wind_speed,
+        #"WINDGUST" : self.telescope.wind_gust,
+        #"WINDDIR"  : self.telescope.wind_direction,
+        "AGR"      : 0.0,           #focus position ???
+        "REI34"    : 0.0,           #focus position (Dewar focus)
+        "EXP"      : 0.0,           #??????????
+        "CTYPE1"   : "RA---TAN",    #?????????
+        "CTYPE2"   : "DEC--TAN",    #?????????
+        #The following two values are for the guide cam. They
+        #are overwritten by keywordsH2RG for the H2RG
+        "CRPIX1"   : 528.0,         # ref point pixel x
+        "CRPIX2"   : 513.5,         # ref point pixel y
+        "CDELT1"   : 0.000119444444,# deg per pixel x
+        "CDELT2"   : 0.000119444444,# deg per pixel y
+        "CRVAL1"   : 0.0,           #?????????
+        "CRVAL2"   : 0.0,           #?????????
+        }
+
+    #Telescope keywords and the Telescope attribute they are read from
+    TELESCOPE_KEYWORDS = (("RA",      "ra"),
+                          ("DEC",     "dec"),
+                          ("AIRMASS", "airmass"),
+                          ("TELALT",  "altitude"),
+                          ("TELAZ",   "azimuth"),
+                          ("PA",      "parallactic_angle"),
+                          ("JD",      "julian_date"))
+
+    #Wheel keywords and the wheel they are read from
+    WHEEL_KEYWORDS = (("MASK",    "mask_wheel"),
+                      ("FILTER1", "filter1_wheel"),
+                      ("FILTER2", "filter2_wheel"),
+                      ("GRISM",   "grism_wheel"))
+
+    def _init_keywords(self):
+        """Start refreshing the FITS keywords in the background, every
+        source on the period and ttl of its [keywords] settings.
+        """
+        settings = self.cfg.get('keywords', {})
+        def source(name, keys, read, period, ttl):
+            return KeywordSource(
+                name, keys, float(settings.get('%s period' % name, period)),
+                float(settings.get('%s ttl' % name, ttl)), read)
+
+        #TODO: Be sure to be getting decimal degrees
+        self.keyword_cache = KeywordCache(self.STATIC_KEYWORDS, [
+            source('telescope', [key for key, _ in self.TELESCOPE_KEYWORDS],
+                   self._telescopeKeywords, 1, 10),
+            source('wheels', [key for key, _ in self.WHEEL_KEYWORDS],
+                   self._wheelKeywords, 0.5, 5),
+            source('kmirror', ["CROTA2"], self._kmirrorKeywords, 1, 10),
+            source('camera', ["CAMTEMP"], self._cameraKeywords, 10, 60)])
+
+    def _telescopeKeywords(self):
+        telescope = self.telescope
+        return dict((key, getattr(telescope, name) if telescope else None)
+                    for key, name in self.TELESCOPE_KEYWORDS)
+
+    def _wheelKeywords(self):
+        wheels = [(key, getattr(self, name)) for key, name
+                  in self.WHEEL_KEYWORDS]
+        return dict((key, wheel.position if wheel else None)
+                    for key, wheel in wheels)
+
+    def _kmirrorKeywords(self):
+        #Image rotation value
+        return {"CROTA2" : self.kmirror.positionAngle * 2 + 180
+                           if self.kmirror else None}
+
+    def _cameraKeywords(self):
+        #Waits for the camera lock, during an exposure
+        return {"CAMTEMP" : self.guide_cam.getTemperature()
+                            if self.guide_cam else None}
+
     @property
     def keywords(self):
-        #Define keywords
-        ################################################################
-        #TODO: Be sure to be getting decimal degrees
-        keywords = {
-            "OBSERVER" : "Observer",    #TODO: Get from somewhere
-            "INST"     : "NESSI",       
-            "TELESCOP" : "MRO 2.4m",    #TODO:Get from indi?
-            "FILENAME" : "default",     #TODO:Do these later?
-            "IMGTYPE"  : "imgtyp",      
-            "RA"       : 
-            self.telescope.ra if self.telescope else None,
-            "DEC"      : 
-            self.telescope.dec if self.telescope else None,
-            "AIRMASS"  : 
-            self.telescope.airmass if self.telescope else None,
-            "TELALT"   : 
-            self.telescope.altitude if self.telescope else None,
-            "TELAZ"    : 
-            self.telescope.azimuth if self.telescope else None,
-            "TELFOCUS" : "TCS down",    #TODO:Where is?
-            "PA"       : 
-            self.telescope.parallactic_angle if self.telescope else None,
-            "JD"       : 
-            self.telescope.julian_date if self.telescope else None,
-            "GDATE"    : "TCS down",    #TODO:Generate
-            #"WINDVEL"  : self.telescope.wind_speed,
-            #"WINDGUST" : self.telescope.wind_gust,
-            #"WINDDIR"  : self.telescope.wind_direction,
-            "AGR"      : 0.0,           #focus position ???
-            "REI34"    : 0.0,           #focus position (Dewar focus)
-            "MASK"     : 
-            self.mask_wheel.position if self.mask_wheel else None,
-            "FILTER1"  : 
-            self.filter1_wheel.position if self.filter1_wheel else None,
-            "FILTER2"  : 
-            self.filter2_wheel.position if self.filter2_wheel else None,
-            "GRISM"    : 
-            self.grism_wheel.position if self.grism_wheel else None,
-            "EXP"      : 0.0,           #??????????
-            "CAMTEMP"  : 
-            self.guide_cam.getTemperature() if self.guide_cam else None,
-            "CTYPE1"   : "RA---TAN",    #?????????
-            "CTYPE2"   : "DEC--TAN",    #?????????
-            #The following two values are for the guide cam. They
-            #are overwritten in main.py KeywordTCPHandler for the
-            #H2RG
-            "CRPIX1"   : 528.0,         # ref point pixel x
-            "CRPIX2"   : 513.5,         # ref point pixel y
-            "CDELT1"   : 0.000119444444,# deg per pixel x
-            "CDELT2"   : 0.000119444444,# deg per pixel y
-            "CRVAL1"   : 0.0,           #?????????
-            "CRVAL2"   : 0.0,           #?????????
-            "CROTA2"   :                #Image rotation value
-            self.kmirror.positionAngle * 2 + 180 if self.kmirror else None
-            }
-        
-        return keywords
+        """FITS keywords, from the latest background refresh (see
+        KeywordCache). A new dictionary, the caller may change it.
+        """
+        return self.keyword_cache.keywords()
 
     @property
     def keywordsH2RG(self):
@@ -322,6 +408,101 @@ class Instrument(object):
         return keywords
 
 
+    #Wheels moved by configure, by their nessisettings.ini name
+    WHEELS = (('mask',    'mask_wheel'   ),
+              ('filter1', 'filter1_wheel'),
+              ('filter2', 'filter2_wheel'),
+              ('grism',   'grism_wheel'  ))
+
+    def configure(self, preset=None, **positions):
+        """Moves the dewar wheels to a new setup, all at once.
+
+        The wheels are on independent groups, so their moves are started
+        together and the setup takes as long as the slowest move instead
+        of the sum of the moves.
+
+        Arguments:
+            preset    -- Name of a [presets] subsection of
+                         nessisettings.ini giving positions for some of
+                         the wheels -> str
+            positions -- Position of each wheel to move, by name or by
+                         slot, e.g. filter2='K'. They override the
+                         preset. -> str or int
+
+        Raises:
+            InstrumentError -- Unknown preset, wheel or position, or a
+                               failed move (raised once every move is
+                               over).
+
+        Returns:
+            Seconds taken by each wheel move -> {str: float}
+        """
+        targets = {}
+        if preset is not None:
+            try:
+                targets.update(self.cfg['presets'][preset])
+            except KeyError:
+                raise InstrumentError('Unknown instrument preset %s!'
+                                      % preset)
+        targets.update(positions)
+
+        wheels = dict(self.WHEELS)
+        moves  = []
+        for name, position in sorted(targets.items()):
+            if name not in wheels:
+                raise InstrumentError('Unknown wheel %s!' % name)
+            wheel = getattr(self, wheels[name])
+            if wheel is None:
+                raise InstrumentError('The %s wheel is not available!'
+                                      % name)
+            moves.append((name, wheel, self._slot(wheel, position)))
+
+        timing = {}
+        start  = time.time()
+
+        def finished(name):
+            def callback(future):
+                timing[name] = time.time() - start
+            return callback
+
+        futures = []
+        for name, wheel, slot in moves:
+            future = wheel.moveAsync(slot)
+            future.add_done_callback(finished(name))
+            futures.append((name, future))
+
+        failures = []
+        for name, future in futures:
+            future.wait()
+            if future.exception() is not None:
+                failures.append('%s: %s' % (name, future.exception()))
+        logging.info('Instrument configured in %.2f s: %s'
+                     % (time.time() - start, timing))
+        if failures:
+            raise InstrumentError('The instrument setup failed...\n%s'
+                                  % '\n'.join(failures))
+        return timing
+
+    @staticmethod
+    def _slot(wheel, position):
+        """Slot of a wheel position given by name or by slot."""
+        if isinstance(position, int):
+            slot = position
+        elif str(position).isdigit():
+            slot = int(position)
+        elif position in wheel.positions:
+            slot = list(wheel.positions).index(position)
+        else:
+            names = [name.lower() for name in wheel.positions]
+            if position.lower() not in names:
+                raise InstrumentError('The %s wheel has no position %s!'
+                                      % (wheel, position))
+            slot = names.index(position.lower())
+        if not 0 <= slot < len(wheel.positions):
+            raise InstrumentError('The %s wheel has no slot %d!'
+                                  % (wheel, slot))
+        return slot
+
     @property
     def actuators(self):
         actuators = {
@@ -349,21 +530,37 @@ class Instrument(object):
         dictionary['Telescope'] = self.telescope
         return dictionary
         
-    @timeout(10)
-    def _fill_socket_list(self):
-        for i in range(40):
-            socket = self.newport.TCP_ConnectToServer(
-                '10.90.20.1',5001,1)
-            if socket is not -1:
-                self.open_sockets.append(socket)
-            else:
-                raise InstrumentError('Newport socket connection not opened'
-                                      ' at position %d!' % i)
+    def _open_socket_pool(self):
+        """Connect the initial Newport sockets concurrently. The pool
+        grows on demand up to [general] sockets.
+        """
+        general = self.cfg['general']
+        self.xps_pool = XPSConnectionPool(
+            self.newport, general.get('xps host', '10.90.20.1'),
+            int(general.get('xps port', 5001)), timeout=1,
+            size=int(general.get('initial sockets', 8)),
+            max_size=int(general['sockets']),
+            heartbeat=float(general.get('heartbeat', 5)),
+            query_timeout=float(general.get('query timeout', 2)))
     
-    @timeout(10)
     def _close_sockets(self):
-        for i in range(len(self.open_sockets)):
-            self.newport.TCP_CloseSocket(self.open_sockets[i])            
+        if self.keyword_cache is not None:
+            self.keyword_cache.stop()
+        if self.snapshot is not None:
+            self.snapshot.stop()
+        if self.gpio is not None:
+            newport.gpio_samplers.pop(self.newport, None)
+            self.gpio.stop()
+        if self.xps_stats is not None:
+            self.xps_stats.stop()
+        for component in (self.kmirror, self.mask_wheel, self.filter1_wheel,
+                          self.filter2_wheel, self.grism_wheel):
+            if component is not None:
+                component.dispatch.close()
+        if self.xps_pool is not None:
+            logging.debug('XPS socket pool usage: %s' 
+                          % self.xps_pool.utilisation)
+            self.xps_pool.close()
         
 
     def kill_all(self, msg=None):
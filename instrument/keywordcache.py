@@ -0,0 +1,148 @@
+"""
+.. module:: keywordcache
+   :platform: Unix
+   :synopsis: FITS keywords refreshed in the background, read from memory.
+
+"""
+
+import collections
+import logging
+import threading
+import time
+
+
+class KeywordSource(collections.namedtuple(
+        'KeywordSource', 'name keys period ttl read')):
+    """One source of keywords, e.g. the telescope.
+
+    Attributes:
+        name   -- Name of the source, used for the thread and the logs.
+        keys   -- Keywords the source reads, None until the first read.
+        period -- Seconds between two refreshes.
+        ttl    -- Seconds a refreshed value is good for; after that it reads
+                  None until the next successful refresh. None never
+                  expires.
+        read   -- Called with no argument, returns {keyword: value}. May
+                  block, it only holds up its own source.
+    """
+    __slots__ = ()
+
+
+class KeywordSnapshot(collections.namedtuple(
+        'KeywordSnapshot', 'sequence time items')):
+    """Immutable keywords at one instant.
+
+    Attributes:
+        sequence -- Increases by one with every published snapshot.
+        time     -- time.time() when it was published.
+        items    -- (keyword, value, stamp, expires) of every keyword; stamp
+                    is when the value was read, None before the first read,
+                    and expires when it stops being good, None for never.
+    """
+    __slots__ = ()
+
+    def dict(self, now=None):
+        """New {keyword: value} dictionary, with None for expired values."""
+        now = time.time() if now is None else now
+        return dict((key, value if expires is None or now < expires else None)
+                    for key, value, stamp, expires in self.items)
+
+    def stamp(self, key):
+        """time.time() the value of a keyword was read."""
+        for item in self.items:
+            if item[0] == key:
+                return item[2]
+        raise KeyError(key)
+
+
+class KeywordCache(object):
+    """Background refresher of the FITS keywords.
+
+    Every source is read in a thread of its own, every source period
+    seconds, and each successful read publishes a new KeywordSnapshot.
+    Consumers read `latest` or keywords() and never wait on the telescope,
+    the controller or a camera. A source that fails keeps its last values
+    until their ttl runs out.
+    """
+
+    def __init__(self, static, sources):
+        """Start refreshing.
+
+        Arguments:
+            static  -- {keyword: value} that never changes -> dict
+            sources -- Sources of the other keywords -> [KeywordSource]
+        """
+        now           = time.time()
+        self.sources  = tuple(sources)
+        self._values  = dict((key, (value, now, None))
+                             for key, value in static.items())
+        for source in self.sources:
+            for key in source.keys:
+                self._values[key] = (None, None, None)
+        self._lock    = threading.Lock()
+        self._stop    = threading.Event()
+        self._failing = set()
+        self._latest  = None
+        self._publish({}, None, now)
+
+        self._threads = []
+        for source in self.sources:
+            thread = threading.Thread(name='Keywords-%s' % source.name,
+                                      target=self._run, args=(source,))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    @property
+    def latest(self):
+        """Most recent KeywordSnapshot."""
+        return self._latest
+
+    def keywords(self):
+        """{keyword: value} of the latest snapshot, a new dictionary the
+        caller may change.
+        """
+        return self._latest.dict()
+
+    def refresh(self, name=None):
+        """Read a source, or every source, now and publish the result."""
+        for source in self.sources:
+            if name is None or source.name == name:
+                self._refresh(source)
+
+    def stop(self, timeout=2):
+        """Stop refreshing."""
+        self._stop.set()
+        for thread in self._threads:
+            if threading.current_thread() is not thread:
+                thread.join(timeout)
+
+    def _publish(self, values, ttl, now):
+        expires = None if ttl is None else now + ttl
+        with self._lock:
+            for key, value in values.items():
+                self._values[key] = (value, now, expires)
+            sequence = 0 if self._latest is None else \
+                       self._latest.sequence + 1
+            self._latest = KeywordSnapshot(
+                sequence, now,
+                tuple((key,) + entry
+                      for key, entry in sorted(self._values.items())))
+
+    def _refresh(self, source):
+        try:
+            values = source.read()
+        except Exception as e:
+            if source.name not in self._failing:
+                logging.error('Unable to read the %s keywords: %s'
+                              % (source.name, e))
+            self._failing.add(source.name)
+            return
+        self._failing.discard(source.name)
+        self._publish(values, source.ttl, time.time())
+
+    def _run(self, source):
+        while not self._stop.is_set():
+            start = time.time()
+            self._refresh(source)
+            self._stop.wait(max(0, source.period - (time.time() - start)))
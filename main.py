@@ -18,7 +18,6 @@ import sys
 import SocketServer
 import traceback
 
-from configobj import ConfigObj
 import ds9
 import wxversion
 wxversion.select('2.8')
@@ -26,6 +25,7 @@ import wx
 from wx.lib.agw import advancedsplash 
 
 from gui.gui import MainNessiFrame
+from instrument.actuators import motorconfig
 from instrument.instrument import Instrument
 from gui.logtab.log import wxLogHandler, EVT_WX_LOG_EVENT
 from threadtools import run_async, shutdown
@@ -62,9 +62,9 @@ def main(argv=None):
     ################################################################
     splash, splashHandler = buildSplash(SPLASH_BITMAP_PATH)
     
-    #Build configure object
+    #Build configure object, shared with the motion code
     ################################################################
-    cfg = ConfigObj(CONFIG_PATH)
+    cfg = motorconfig.load(CONFIG_PATH).cfg
 
     #Socket Server for sending keywords
     #Note this section must be beffore SIGABRT, in order for socket
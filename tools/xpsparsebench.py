@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""Microbenchmark of the XPS reply parsing.
+
+Compares the character scanning + eval() loop that every method of the old
+hand written XPS_C8_drivers.XPS used against the parsers compiled from the
+XPS_API signature table.  No controller is needed, the replies are canned.
+
+    python tools/xpsparsebench.py [iterations]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from instrument.actuators.XPS_C8_drivers import XPS
+
+
+def legacyParse(error, returnedString, nbParams):
+    """The reply parsing loop of the old generated driver."""
+    i, j, retList = 0, 0, [error]
+    for paramNb in range(nbParams):
+        while ((i+j) < len(returnedString) and returnedString[i+j] != ','):
+            j += 1
+        retList.append(eval(returnedString[i:i+j]))
+        i, j = i+j+1, 0
+    return retList
+
+# (method, arguments, canned reply)
+CASES = [
+    ('GPIODigitalGet', ('GPIO4.DI',), '65279'),
+    ('GroupPositionCurrentGet', ('M', 1), '-41.52738716'),
+    ('PositionerSGammaParametersGet', ('M.P1',),
+     '10,200,0.005,0.05'),
+    ('GroupJogParametersGet', ('M', 1), '-0.00212,400'),
+    ('PositionerCorrectorPIDFFVelocityGet', ('G1.P1',),
+     '1,1500,20,0,0.5,0,0,0,0,0.0001,0,0'),
+]
+
+
+def main(number=20000):
+    print '%-36s %12s %12s %8s' % ('method', 'eval [us]', 'typed [us]',
+                                   'speedup')
+    for name, args, reply in CASES:
+        spec = XPS.signatures[name]
+        nbParams = len(spec.parse(0, reply, args)) - 1
+        assert legacyParse(0, reply, nbParams) == spec.parse(0, reply, args)
+
+        old = timeit.timeit(lambda: legacyParse(0, reply, nbParams),
+                            number=number)
+        new = timeit.timeit(lambda: spec.parse(0, reply, args),
+                            number=number)
+        print '%-36s %12.2f %12.2f %7.1fx' % (name, 1e6*old/number,
+                                              1e6*new/number, old/new)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,605 @@
+#!/usr/bin/env python
+"""Simulated Newport XPS-C8 controller.
+
+A local TCP stand-in for the controller that speaks the XPS text protocol
+(',EndOfAPI' framed replies), so newport.py, KMirror, DewarWheel and the
+panels can be run and benchmarked without the hardware:
+
+    python tools/xpssim.py [port] [latency] [jitter]
+
+and point [general] xps host / xps port of nessisettings.ini at it.  It can
+also run inside a benchmark or test:
+
+    sim = XPSSimulator(port=0, latency=0.0005, jitter=0.0002, seed=1)
+    sim.start()
+    ... connect to sim.address ...
+    sim.stop()
+
+Model
+-----
+* Groups G1-G5 and M, one positioner each (G1.P1, ...), with trapezoidal
+  motion (SGamma velocity and acceleration, jerk ignored), jog, spin,
+  kill, initialize, home search and motion abort.  Motion commands block
+  their socket until the motion is over, like the controller.
+* GPIO4.DI is computed from the positions using the switch bits of
+  nessisettings.ini: the wheel position switch is set on every slot (every
+  SLOT_PITCH degrees), the home switch on slot 0, and the FPA limits at
+  both ends of its travel.
+* GPIO4.DI edge events (EventExtendedWait, and MoveAbort actions started
+  with EventExtendedStart).
+* Replies are delayed by a gaussian latency (seeded, so runs repeat).
+
+Only the functions NESSI uses are simulated; the others answer
+ERR_NOT_SIMULATED.
+"""
+import SocketServer
+import math
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+from configobj import ConfigObj
+
+SETTINGS = os.path.join(os.path.dirname(__file__), '..', 'nessisettings.ini')
+
+# Error codes (XPS-C8 programmer's manual)
+SUCCESS              = 0
+ERR_WRONG_FORMAT     = -7
+ERR_POSITIONER_NAME  = -18
+ERR_GROUP_NAME       = -19
+ERR_NOT_ALLOWED      = -22
+ERR_MOVE_ABORTED     = -27
+ERR_NOT_SIMULATED    = -200
+
+ERRORS = {SUCCESS             : 'Success',
+          ERR_WRONG_FORMAT    : 'Wrong format in the command string',
+          ERR_POSITIONER_NAME : 'Positioner Name doesn\'t exist or unknown'
+                                ' command',
+          ERR_GROUP_NAME      : 'GroupName doesn\'t exist or unknown command',
+          ERR_NOT_ALLOWED     : 'Not allowed action',
+          ERR_MOVE_ABORTED    : 'Move Aborted',
+          ERR_NOT_SIMULATED   : 'Function not simulated'}
+
+# Group states
+NOT_INIT       = 7
+NOT_REFERENCED = 42
+READY          = 12
+MOVING         = 44
+JOGGING        = 47
+SPINNING       = 81
+
+# Degrees of wheel rotation between two slots (two 340 deg approach moves
+# plus a slow search, see NewportWheelMoveSteps)
+SLOT_PITCH = 720.0
+# Angular width of a wheel switch [deg]
+SWITCH_WIDTH = 8.0
+# FPA travel [deg]: 15000 um at 0.576 deg/um
+FPA_TRAVEL = 15000 * 0.576
+
+
+class Group(object):
+    """Kinematic state of one single-positioner group.
+
+    The motion is stored as a piecewise profile from which the position and
+    velocity are computed for any time, so nothing needs to be integrated.
+    """
+
+    def __init__(self, name, position=0.0):
+        self.name         = name
+        self.state        = NOT_INIT
+        self.velocity_max = 200.0
+        self.acceleration = 800.0
+        self.jerk         = (0.005, 0.05)
+        self.jog          = False
+        self.abort        = threading.Event()
+        self.done         = threading.Event()
+        self.done.set()
+        self._set(position, 0.0, time.time())
+
+    def _set(self, position, velocity, t0, target=None, duration=0.0,
+             accel=0.0):
+        self._p0, self._v0, self._t0 = position, velocity, t0
+        self._target, self._duration, self._accel = target, duration, accel
+
+    def kinematics(self, now=None):
+        """(position, velocity) at time now."""
+        now = time.time() if now is None else now
+        t   = now - self._t0
+        if self._target is None:
+            return self._p0 + self._v0 * t, self._v0
+        # Trapezoid (or triangle) from rest to rest
+        distance = self._target - self._p0
+        sign     = 1 if distance >= 0 else -1
+        a, T     = self._accel, self._duration
+        vpeak    = min(self.velocity_max, math.sqrt(abs(distance) * a))
+        ramp     = vpeak / a if a else 0
+        if t >= T:
+            return self._target, 0.0
+        if t < ramp:
+            return self._p0 + sign * 0.5 * a * t * t, sign * a * t
+        if t < T - ramp:
+            return (self._p0 + sign * (0.5 * a * ramp * ramp +
+                                       vpeak * (t - ramp)), sign * vpeak)
+        left = T - t
+        return self._target - sign * 0.5 * a * left * left, sign * a * left
+
+    @property
+    def position(self):
+        return self.kinematics()[0]
+
+    def hold(self, now=None):
+        """Freeze the group where it is."""
+        position = self.kinematics(now)[0]
+        self._set(position, 0.0, time.time())
+
+    def move(self, target):
+        """Start a move to target; returns its duration."""
+        now      = time.time()
+        position = self.kinematics(now)[0]
+        distance = abs(target - position)
+        a, v     = self.acceleration, self.velocity_max
+        if distance * a <= v * v:
+            duration = 2 * math.sqrt(distance / a)
+        else:
+            duration = distance / v + v / a
+        self._set(position, 0.0, now, target, duration, a)
+        self.state = MOVING
+        self.abort.clear()
+        self.done.clear()
+        return duration
+
+    def run(self, velocity):
+        """Constant velocity motion (jog and spin)."""
+        now = time.time()
+        self._set(self.kinematics(now)[0], velocity, now)
+
+    def stop(self, state=READY):
+        self.hold()
+        self.state = state
+        self.abort.set()
+        self.done.set()
+
+
+class Controller(object):
+    """The simulated controller: groups, switches, events."""
+
+    def __init__(self, cfg):
+        self.cfg     = cfg
+        self.lock    = threading.RLock()
+        self.groups  = {}
+        self.wheels  = {}   # group -> (slots, posbit, posval, homebit, homeval)
+        self.limits  = None # (group, direction, lowerbit, lowerval,
+                            #  upperbit, upperval)
+        self.events  = {}   # id -> (bit, val, group)
+        self.eventId = 0
+
+        for section in cfg.sections:
+            if 'group' not in cfg[section]:
+                continue
+            group = cfg[section]['group']
+            self.groups[group] = Group(group)
+            if 'position' in cfg[section] and 'home' in cfg[section]:
+                self.wheels[group] = (
+                    int(cfg[section].get('slots', 8)),
+                    int(cfg[section]['position']['bit']),
+                    int(cfg[section]['position']['val']),
+                    int(cfg[section]['home']['bit']),
+                    int(cfg[section]['home']['val']))
+            if 'lower' in cfg[section] and 'upper' in cfg[section]:
+                self.limits = (group,
+                               int(cfg[section].get('direction', 1)),
+                               int(cfg[section]['lower']['bit']),
+                               int(cfg[section]['lower']['val']),
+                               int(cfg[section]['upper']['bit']),
+                               int(cfg[section]['upper']['val']))
+
+        self._watch = threading.Thread(target=self._watchEvents)
+        self._watch.daemon = True
+        self._watch.start()
+
+    def gpio(self, now=None):
+        """GPIO4.DI word at time now."""
+        bits = {}
+        for group, (slots, posbit, posval, homebit, homeval) in \
+                self.wheels.items():
+            angle  = self.groups[group].kinematics(now)[0]
+            slot   = round(angle / SLOT_PITCH)
+            onSlot = abs(angle - slot * SLOT_PITCH) <= SWITCH_WIDTH / 2
+            home   = onSlot and int(slot) % slots == 0
+            bits[posbit]  = posval if onSlot else 1 - posval
+            bits[homebit] = homeval if home else 1 - homeval
+
+        if self.limits is not None:
+            group, direction, lowerbit, lowerval, upperbit, upperval = \
+                self.limits
+            travel = self.groups[group].kinematics(now)[0] * direction
+            bits[lowerbit] = lowerval if travel <= -FPA_TRAVEL / 2 \
+                             else 1 - lowerval
+            bits[upperbit] = upperval if travel >= FPA_TRAVEL / 2 \
+                             else 1 - upperval
+
+        word = 0xffff
+        for bit, value in bits.items():
+            word = (word & ~(1 << bit)) | (int(value) << bit)
+        return word
+
+    def bit(self, bit, now=None):
+        return (self.gpio(now) >> bit) & 1
+
+    def waitEdge(self, bit, val, timeout=None):
+        """Block until GPIO4.DI bit goes to val."""
+        deadline = None if timeout is None else time.time() + timeout
+        last     = self.bit(bit)
+        while deadline is None or time.time() < deadline:
+            time.sleep(0.001)
+            now = self.bit(bit)
+            if now != last and now == val:
+                return True
+            last = now
+        return False
+
+    def _watchEvents(self):
+        """Fire the started MoveAbort events, at 1 kHz."""
+        last = {}
+        while True:
+            time.sleep(0.001)
+            with self.lock:
+                events = self.events.items()
+            for id, (bit, val, group) in events:
+                now = self.bit(bit)
+                if last.get(id, now) != now and now == val:
+                    target = self.groups[group]
+                    if target.state == MOVING:
+                        target.stop()
+                last[id] = now
+
+
+class Session(SocketServer.BaseRequestHandler):
+    """One controller socket: reads commands, answers in order."""
+
+    def handle(self):
+        self.trigger = None
+        self.action  = None
+        self.server.simulator.sessions.add(self)
+        try:
+            self.serve()
+        finally:
+            self.server.simulator.sessions.discard(self)
+
+    def serve(self):
+        buf = ''
+        while True:
+            try:
+                data = self.request.recv(4096)
+            except Exception:
+                return
+            if not data:
+                return
+            buf += data
+            while ')' in buf:
+                command, buf = buf.split(')', 1)
+                reply = self.server.simulator.execute(self, command + ')')
+                self.server.simulator.delay()
+                self.request.sendall(reply + ',EndOfAPI')
+
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads      = True
+    allow_reuse_address = True
+
+
+class XPSSimulator(object):
+    """TCP server wrapping a simulated Controller.
+
+    Attributes:
+        address    -- (host, port) the server listens on.
+        controller -- The simulated Controller.
+        latency    -- Mean reply delay [s].
+        jitter     -- Standard deviation of the reply delay [s].
+    """
+
+    def __init__(self, host='127.0.0.1', port=5001, latency=0.0, jitter=0.0,
+                 seed=None, settings=SETTINGS):
+        self.controller = Controller(ConfigObj(infile=settings))
+        self.latency    = latency
+        self.jitter     = jitter
+        self._random    = random.Random(seed)
+        self._randomLock = threading.Lock()
+        self._server    = _Server((host, port), Session)
+        self._server.simulator = self
+        self.address    = self._server.server_address
+        self._thread    = None
+        self.sessions   = set()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def drop(self):
+        """Reset every open connection, like a network failure."""
+        for session in list(self.sessions):
+            try:
+                session.request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def delay(self):
+        if self.latency or self.jitter:
+            with self._randomLock:
+                wait = self._random.gauss(self.latency, self.jitter)
+            time.sleep(max(0.0, wait))
+
+    def execute(self, session, command):
+        """Run one command string, e.g. 'GroupStatusGet(G1,int *)', and
+        return the reply without its terminator.
+        """
+        name, _, args = command.partition('(')
+        args = [arg.strip() for arg in args[:-1].split(',')
+                if arg.strip() and '*' not in arg]
+        handler = getattr(self, 'do' + name, None)
+        if handler is None:
+            return '%d,' % ERR_NOT_SIMULATED
+        try:
+            result = handler(session, *args)
+        except (TypeError, ValueError):
+            return '%d,' % ERR_WRONG_FORMAT
+        except KeyError:
+            return '%d,' % ERR_GROUP_NAME
+        if isinstance(result, int):
+            return '%d,' % result
+        return ','.join([str(SUCCESS)] + [_format(value) for value in result])
+
+    # Helpers ----------------------------------------------------------------
+
+    def _group(self, name):
+        return self.controller.groups[name.split('.')[0]]
+
+    def _waitMotion(self, group, duration):
+        """Block a motion command until its motion ends or is aborted."""
+        if group.abort.wait(duration):
+            return ERR_MOVE_ABORTED
+        with self.controller.lock:
+            group.hold()
+            if group.state == MOVING:
+                group.state = READY
+            group.done.set()
+        return SUCCESS
+
+    def _move(self, group, target):
+        with self.controller.lock:
+            if group.state not in (READY, MOVING):
+                return ERR_NOT_ALLOWED
+            duration = group.move(target)
+        return self._waitMotion(group, duration)
+
+    # Functions --------------------------------------------------------------
+
+    def doTestTCP(self, session, text):
+        return [text]
+
+    def doErrorStringGet(self, session, code):
+        return [ERRORS.get(int(code), 'Unknown error %s' % code)]
+
+    def doKillAll(self, session):
+        with self.controller.lock:
+            for group in self.controller.groups.values():
+                group.stop(NOT_INIT)
+        return SUCCESS
+
+    def doGroupKill(self, session, name):
+        with self.controller.lock:
+            group = self._group(name)
+            group.jog = False
+            group.stop(NOT_INIT)
+        return SUCCESS
+
+    def doGroupInitialize(self, session, name):
+        with self.controller.lock:
+            group = self._group(name)
+            if group.state != NOT_INIT:
+                return ERR_NOT_ALLOWED
+            group.state = NOT_REFERENCED
+        return SUCCESS
+
+    def doGroupHomeSearch(self, session, name):
+        group = self._group(name)
+        with self.controller.lock:
+            if group.state != NOT_REFERENCED:
+                return ERR_NOT_ALLOWED
+            group.state = READY
+        return self._move(group, 0.0)
+
+    def doGroupHomeSearchAndRelativeMove(self, session, name, offset):
+        error = self.doGroupHomeSearch(session, name)
+        if error != SUCCESS:
+            return error
+        return self._move(self._group(name), float(offset))
+
+    def doGroupMoveAbsolute(self, session, name, target):
+        return self._move(self._group(name), float(target))
+
+    def doGroupMoveRelative(self, session, name, offset):
+        group = self._group(name)
+        return self._move(group, group.position + float(offset))
+
+    def doGroupMoveAbort(self, session, name):
+        with self.controller.lock:
+            group = self._group(name)
+            if group.state not in (MOVING, JOGGING):
+                return ERR_NOT_ALLOWED
+            group.stop()
+        return SUCCESS
+
+    def doGroupStatusGet(self, session, name):
+        return [self._group(name).state]
+
+    def doGroupMotionStatusGet(self, session, name, count='1'):
+        group = self._group(name)
+        moving = group.state == MOVING or group.kinematics()[1] != 0
+        return [int(moving)]
+
+    def doGroupPositionCurrentGet(self, session, name, count='1'):
+        return [self._group(name).position]
+
+    doGroupPositionSetpointGet = doGroupPositionCurrentGet
+
+    def doGroupPositionTargetGet(self, session, name, count='1'):
+        group = self._group(name)
+        target = group._target
+        return [group.position if target is None else target]
+
+    def doGroupVelocityCurrentGet(self, session, name, count='1'):
+        return [self._group(name).kinematics()[1]]
+
+    def doPositionerSGammaParametersSet(self, session, name, velocity,
+                                        acceleration, minJerk, maxJerk):
+        with self.controller.lock:
+            group = self._group(name)
+            group.velocity_max = float(velocity)
+            group.acceleration = float(acceleration)
+            group.jerk         = (float(minJerk), float(maxJerk))
+        return SUCCESS
+
+    def doPositionerSGammaParametersGet(self, session, name):
+        group = self._group(name)
+        return [group.velocity_max, group.acceleration] + list(group.jerk)
+
+    def doGroupJogModeEnable(self, session, name):
+        with self.controller.lock:
+            group = self._group(name)
+            if group.jog or group.state != READY:
+                return ERR_NOT_ALLOWED
+            group.jog   = True
+            group.state = JOGGING
+        return SUCCESS
+
+    def doGroupJogModeDisable(self, session, name):
+        with self.controller.lock:
+            group = self._group(name)
+            if not group.jog:
+                return ERR_NOT_ALLOWED
+            if group.kinematics()[1] != 0:
+                return ERR_NOT_ALLOWED
+            group.jog   = False
+            group.state = READY
+        return SUCCESS
+
+    def doGroupJogParametersSet(self, session, name, velocity, acceleration):
+        with self.controller.lock:
+            group = self._group(name)
+            if not group.jog:
+                return ERR_NOT_ALLOWED
+            group.run(float(velocity))
+        return SUCCESS
+
+    def doGroupJogParametersGet(self, session, name, count='1'):
+        return [self._group(name)._v0, self._group(name).acceleration]
+
+    def doGroupJogCurrentGet(self, session, name, count='1'):
+        velocity = self._group(name).kinematics()[1]
+        return [velocity, 0.0]
+
+    def doGroupSpinParametersSet(self, session, name, velocity,
+                                 acceleration):
+        with self.controller.lock:
+            group = self._group(name)
+            if group.state not in (READY, SPINNING):
+                return ERR_NOT_ALLOWED
+            group.state = SPINNING
+            group.run(float(velocity))
+        return SUCCESS
+
+    def doGroupSpinModeStop(self, session, name, acceleration):
+        with self.controller.lock:
+            group = self._group(name)
+            if group.state != SPINNING:
+                return ERR_NOT_ALLOWED
+            group.stop()
+        return SUCCESS
+
+    def doControllerMotionKernelTimeLoadGet(self, session):
+        # Fixed base load plus a share per group in motion
+        with self.controller.lock:
+            moving = len([group for group in self.controller.groups.values()
+                          if group.state in (MOVING, JOGGING, SPINNING)])
+        corrector = 0.10 + 0.02 * moving
+        profiler  = 0.02 + 0.01 * moving
+        return [corrector + profiler + 0.05, corrector, profiler, 0.05]
+
+    def doControllerMotionKernelPeriodMinMaxGet(self, session):
+        return [1.25e-4, 1.25e-4, 1e-3, 1e-3, 1e-2, 1e-2]
+
+    def doControllerMotionKernelPeriodMinMaxReset(self, session):
+        return SUCCESS
+
+    def doGPIODigitalGet(self, session, name):
+        if name != 'GPIO4.DI':
+            return 0
+        return [self.controller.gpio()]
+
+    def doEventExtendedConfigurationTriggerSet(self, session, event, bit,
+                                               *parameters):
+        prefix, _, edge = event.rpartition('.')
+        if prefix != 'GPIO4.DI' or edge not in ('DILowHigh', 'DIHighLow'):
+            return ERR_NOT_SIMULATED
+        session.trigger = (int(bit), 1 if edge == 'DILowHigh' else 0)
+        return SUCCESS
+
+    def doEventExtendedConfigurationActionSet(self, session, action,
+                                              *parameters):
+        group, _, name = action.rpartition('.')
+        if name != 'MoveAbort':
+            return ERR_NOT_SIMULATED
+        self._group(group)
+        session.action = group
+        return SUCCESS
+
+    def doEventExtendedStart(self, session):
+        if session.trigger is None or session.action is None:
+            return ERR_NOT_ALLOWED
+        with self.controller.lock:
+            self.controller.eventId += 1
+            id = self.controller.eventId
+            self.controller.events[id] = session.trigger + (session.action,)
+        return [id]
+
+    def doEventExtendedRemove(self, session, id):
+        with self.controller.lock:
+            if self.controller.events.pop(int(id), None) is None:
+                return ERR_NOT_ALLOWED
+        return SUCCESS
+
+    def doEventExtendedWait(self, session):
+        if session.trigger is None:
+            return ERR_NOT_ALLOWED
+        self.controller.waitEdge(*session.trigger)
+        return SUCCESS
+
+
+def _format(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def main(port=5001, latency=0.0, jitter=0.0):
+    sim = XPSSimulator('0.0.0.0', int(port), float(latency), float(jitter))
+    sim.start()
+    print 'Simulated XPS listening on %s:%d' % sim.address
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        sim.stop()
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
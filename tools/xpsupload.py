@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+"""Install the NESSI TCL scripts on the XPS controller.
+
+The scripts in instrument/actuators/tcl are copied by FTP to the controller
+script folder, where TCLScriptExecute* can find them.
+
+    python tools/xpsupload.py [host] [user] [password]
+"""
+import ftplib
+import glob
+import os
+import sys
+
+SCRIPTS = os.path.join(os.path.dirname(__file__), '..', 'instrument',
+                       'actuators', 'tcl')
+
+
+def main(host='10.90.20.1', user='Administrator', password='Administrator'):
+    ftp = ftplib.FTP(host, user, password)
+    try:
+        ftp.cwd('/Admin/Public/Scripts')
+        for path in sorted(glob.glob(os.path.join(SCRIPTS, '*.tcl'))):
+            with open(path, 'rb') as script:
+                ftp.storbinary('STOR ' + os.path.basename(path), script)
+            print 'Installed ' + os.path.basename(path)
+    finally:
+        ftp.quit()
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])